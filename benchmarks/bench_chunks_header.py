@@ -0,0 +1,37 @@
+"""Microbenchmark of the chunks header parser.
+
+Compares the regex based parser the proxy used to run on every request with the current
+single-pass parser, both on a cold (unique headers) and a warm (repeated header) workload.
+
+Usage, with zarr-proxy installed (e.g. ``pip install -e .``): python benchmarks/bench_chunks_header.py
+"""
+
+import re
+import timeit
+
+from zarr_proxy.logic import _parse_chunks_header, parse_chunks_header
+
+HEADER = (
+    'time=6443, analysed_sst=30,100,100, analysis_error=30,100,100, mask=30,100,100, '
+    'sea-ice-fraction=30,100,100, sea surface temperate=30,30'
+)
+
+
+def parse_chunks_header_regex(chunks: str) -> dict[str, tuple[int, ...]]:
+    parsed_dict = {}
+    for item in re.findall(r'([\w\s\._-]+=[\d,]+)\b', chunks):
+        key, value = item.strip().split('=')
+        parsed_dict[key] = tuple(map(int, value.strip(',').split(',')))
+    return parsed_dict
+
+
+def bench(label: str, func, number: int = 100_000) -> None:
+    seconds = min(timeit.repeat(func, number=number, repeat=5))
+    print(f'{label:<32} {seconds / number * 1e9:>8.0f} ns/call')
+
+
+if __name__ == '__main__':
+    assert parse_chunks_header_regex(HEADER) == parse_chunks_header(HEADER)
+    bench('regex (before)', lambda: parse_chunks_header_regex(HEADER))
+    bench('single pass, uncached', lambda: _parse_chunks_header.__wrapped__(HEADER))
+    bench('single pass, memoized (after)', lambda: parse_chunks_header(HEADER))
@@ -0,0 +1,96 @@
+"""Benchmark of the import time and cold start of the proxy.
+
+Each run starts a fresh interpreter that imports ``zarr_proxy.main``, then sends a first request
+straight to the ASGI application (no server, no HTTP client), which is what a serverless function
+does on a cold start. The slowest imports of the last run are listed to track regressions, e.g. a
+module importing zarr or aiohttp at the top level again.
+
+Usage, with zarr-proxy installed (e.g. ``pip install -e .``):
+
+    python benchmarks/bench_startup.py [--path /health] [--runs 10]
+
+Pass the path of a chunk, e.g. ``--path /{host}/{dataset}/{variable}/0.0``, to include the lazy
+imports and the upstream requests of a first chunk read.
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+
+COLD_START = """
+import asyncio, sys, time
+
+start = time.perf_counter()
+from zarr_proxy.main import app
+imported = time.perf_counter()
+
+async def request(path):
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'root_path': '',
+        'query_string': b'', 'headers': [], 'client': ('bench', 0), 'server': ('bench', 80),
+    }
+    status = None
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+
+    await app(scope, receive, send)
+    return status
+
+status = asyncio.run(request(sys.argv[1]))
+print(imported - start, time.perf_counter() - start, status)
+"""
+
+
+def run(path: str) -> tuple[float, float, int]:
+    output = subprocess.run(
+        [sys.executable, '-c', COLD_START, path], capture_output=True, text=True, check=True
+    ).stdout
+    import_time, cold_start, status = output.split()[-3:]
+    return float(import_time), float(cold_start), int(status)
+
+
+def slowest_imports(count: int = 10) -> list[tuple[float, str]]:
+    """Return the packages with the largest cumulative import time, in seconds."""
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import zarr_proxy.main'],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    times = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        name = name.strip()
+        # the third-party packages and the modules of the proxy
+        if '.' not in name or name.startswith('zarr_proxy.'):
+            times.append((int(cumulative) / 1e6, name))
+    return sorted(times, reverse=True)[:count]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--path', default='/health', help='path of the first request')
+    parser.add_argument('--runs', type=int, default=10, help='number of fresh interpreters')
+    args = parser.parse_args()
+
+    results = [run(args.path) for _ in range(args.runs)]
+    import_times, cold_starts, statuses = zip(*results)
+    print(f'first request: GET {args.path} -> {statuses[-1]}')
+    for label, values in [('import', import_times), ('cold start', cold_starts)]:
+        print(
+            f'{label:<12} median {statistics.median(values) * 1e3:>7.1f} ms'
+            f'   min {min(values) * 1e3:>7.1f} ms   max {max(values) * 1e3:>7.1f} ms'
+        )
+    print('slowest imports of zarr_proxy.main:')
+    for seconds, name in slowest_imports():
+        print(f'  {name:<40} {seconds * 1e3:>7.1f} ms')
@@ -1,10 +1,24 @@
+import asyncio
 import logging
 
 from mangum import Mangum
 
+from zarr_proxy.config import get_settings
 from zarr_proxy.main import app
+from zarr_proxy.warmup import warm_up
 
 logging.getLogger('mangum.lifespan').setLevel(logging.ERROR)
 logging.getLogger('mangum.http').setLevel(logging.ERROR)
 
+# Warm up during the init phase of the function, which runs before its first invocation with the
+# full CPU allocation, rather than during the first request. The startup event of the application
+# then skips the datasets warmed up here.
+settings = get_settings()
+if settings.zarr_proxy_warmup_datasets or settings.zarr_proxy_warmup_imports:
+    asyncio.run(
+        warm_up(
+            settings.zarr_proxy_warmup_datasets, import_modules=settings.zarr_proxy_warmup_imports
+        )
+    )
+
 handler = Mangum(app, lifespan='auto')
@@ -1,7 +1,55 @@
+import json
+
+import numpy as np
 import pytest
+import zarr
 from fastapi.testclient import TestClient
 
+from zarr_proxy.config import reload_settings
+from zarr_proxy.helpers import filesystem_cache, metadata_cache, store_cache
 from zarr_proxy.main import create_application
+from zarr_proxy.multiscales import pyramid_cache
+from zarr_proxy.prefetch import prefetcher
+from zarr_proxy.reader import chunk_cache, level_cache, prefetch_buffer
+from zarr_proxy.store import missing_zarr_json
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    store_cache.clear()
+    filesystem_cache.clear()
+    metadata_cache.clear()
+    chunk_cache.clear()
+    prefetch_buffer.clear()
+    level_cache.clear()
+    pyramid_cache.clear()
+    missing_zarr_json.clear()
+    prefetcher.clear()
+    yield
+
+
+def write_offline_dataset(url: str, data: np.ndarray) -> None:
+    group = zarr.open_group(zarr.storage.FSStore(url), mode='w')
+    air = group.create_dataset('air', data=data, chunks=(7, 8))
+    air.attrs['_ARRAY_DIMENSIONS'] = ['lat', 'lon']
+    zarr.consolidate_metadata(zarr.storage.FSStore(url))
+
+
+@pytest.fixture
+def offline_dataset(monkeypatch, tmp_path):
+    """An ``offline.zarr`` dataset served by the ``memory`` and ``local`` (file) hosts.
+
+    Its ``air`` array of shape (20, 30) and chunks (7, 8) is returned.
+    """
+    data = np.arange(20 * 30, dtype='<f4').reshape(20, 30)
+    write_offline_dataset('memory://offline.zarr', data)
+    write_offline_dataset(f'file://{tmp_path}/offline.zarr', data)
+    hosts = {'memory': {'url': 'memory://'}, 'local': {'url': f'file://{tmp_path}'}}
+    monkeypatch.setenv('ZARR_PROXY_UPSTREAM_HOSTS', json.dumps(hosts))
+    reload_settings()
+    yield data
+    monkeypatch.undo()
+    reload_settings()
 
 
 @pytest.fixture(scope='module')
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+DATA = np.arange(20 * 30, dtype='<f4').reshape(20, 30)
+
+
+@pytest.mark.parametrize('host', ['memory', 'local'])
+def test_zmetadata(test_app, offline_dataset, host):
+    response = test_app.get(f'/{host}/offline.zarr/.zmetadata', headers={'chunks': 'air=10,10'})
+    assert response.status_code == 200
+    assert response.json()['metadata']['air/.zarray']['chunks'] == [10, 10]
+
+
+@pytest.mark.parametrize('host', ['memory', 'local'])
+@pytest.mark.parametrize('chunk_key, expected', [('0.0', DATA[:10, :10]), ('1.2', DATA[10:, 20:])])
+def test_chunk(test_app, offline_dataset, host, chunk_key, expected):
+    response = test_app.get(
+        f'/{host}/offline.zarr/air/{chunk_key}', headers={'chunks': 'air=10,10'}
+    )
+    assert response.status_code == 200
+    np.testing.assert_array_equal(np.frombuffer(response.content, '<f4').reshape(10, 10), expected)
+
+
+@pytest.mark.parametrize(
+    'path',
+    [
+        '%2e%2e/secret/.zattrs',
+        'offline.zarr/%2e%2e/%2e%2e/secret/.zattrs',
+        'offline.zarr/%2e/air/.zarray',
+    ],
+)
+def test_paths_escaping_the_mapped_url_are_rejected(test_app, offline_dataset, tmp_path, path):
+    (tmp_path.parent / 'secret').mkdir(exist_ok=True)
+    (tmp_path.parent / 'secret' / '.zattrs').write_text('{"secret": 1}')
+    assert test_app.get(f'/local/{path}').status_code == 400
+
+
+def test_missing_dataset(test_app, offline_dataset):
+    assert test_app.get('/memory/missing.zarr/.zmetadata').status_code == 404
+
+
+def test_hosts_outside_the_mapping_are_rejected(test_app, offline_dataset):
+    response = test_app.get('/storage.googleapis.com/offline.zarr/.zmetadata')
+    assert response.status_code == 403
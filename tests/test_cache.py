@@ -0,0 +1,163 @@
+import asyncio
+import os
+from unittest.mock import patch
+
+import pytest
+
+from zarr_proxy.cache import DiskCache, LRUCache, SingleFlight
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.stats()['evictions'] == 1
+
+
+def test_lru_cache_ttl():
+    cache = LRUCache(ttl=10)
+    with patch('zarr_proxy.cache.time.monotonic', return_value=100.0):
+        cache.set('a', 1)
+    with patch('zarr_proxy.cache.time.monotonic', return_value=105.0):
+        assert cache.get('a') == 1
+    with patch('zarr_proxy.cache.time.monotonic', return_value=111.0):
+        assert cache.get('a') is None
+
+
+def test_lru_cache_get_or_create_counts_hits_and_misses():
+    cache = LRUCache(maxsize=4)
+    calls = []
+
+    def factory():
+        calls.append(1)
+        return object()
+
+    value = cache.get_or_create('key', factory)
+    assert cache.get_or_create('key', factory) is value
+    assert len(calls) == 1
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['hit_ratio']) == (1, 1, 0.5)
+
+
+def test_lru_cache_byte_budget():
+    cache = LRUCache(maxbytes=10)
+    cache.set('a', b'12345')
+    cache.set('b', b'1234')
+    cache.set('c', b'123')
+
+    assert 'a' not in cache
+    assert cache.nbytes == 7
+    # values larger than the whole budget are not cached
+    cache.set('d', b'12345678901')
+    assert 'd' not in cache
+    assert cache.stats()['nbytes'] == 7
+
+
+def test_disk_cache_roundtrip(tmp_path):
+    cache = DiskCache(directory=str(tmp_path), maxbytes=100)
+    assert cache.get('https://example.com/data.zarr/air/0.0') is None
+    cache.set('https://example.com/data.zarr/air/0.0', b'chunk')
+
+    assert cache.get('https://example.com/data.zarr/air/0.0') == b'chunk'
+    # a new instance (e.g. after a restart) sees the same values
+    assert DiskCache(directory=str(tmp_path), maxbytes=100).nbytes == 5
+    assert not list(tmp_path.rglob('.tmp-*'))
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    cache = DiskCache(directory=str(tmp_path), maxbytes=25)
+    for index, key in enumerate(['a', 'b', 'c']):
+        cache.set(key, b'x' * 10)
+        # make the modification times distinct
+        os.utime(cache._path(key), (index, index))
+
+    assert cache.get('a') is None
+    assert cache.get('b') == b'x' * 10
+    assert cache.nbytes == 20
+    assert cache.stats()['evictions'] == 1
+
+
+def test_disk_cache_overwrites_are_counted_once(tmp_path):
+    cache = DiskCache(directory=str(tmp_path), maxbytes=100)
+    # e.g. concurrent misses on the same key in several requests or workers
+    cache.set('a', b'x' * 10)
+    cache.set('a', b'y' * 10)
+    cache.set('a', b'z' * 5)
+
+    assert cache.nbytes == 5
+    assert cache.get('a') == b'z' * 5
+
+
+def test_single_flight_shares_concurrent_calls():
+    single_flight = SingleFlight()
+    calls = []
+
+    async def factory():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return len(calls)
+
+    async def run():
+        first = await asyncio.gather(*(single_flight.do('key', factory) for _ in range(5)))
+        # the result is not kept once the call completes
+        second = await single_flight.do('key', factory)
+        return first, second
+
+    assert asyncio.run(run()) == ([1] * 5, 2)
+    assert single_flight.stats() == {'inflight': 0, 'calls': 2, 'coalesced': 4}
+
+
+def test_single_flight_reports_coalesced_calls():
+    coalesced = []
+    single_flight = SingleFlight(on_coalesce=lambda: coalesced.append(1))
+
+    async def factory():
+        await asyncio.sleep(0.01)
+
+    async def run():
+        await asyncio.gather(*(single_flight.do('key', factory) for _ in range(3)))
+
+    asyncio.run(run())
+    assert len(coalesced) == 2
+
+
+def test_single_flight_shares_exceptions():
+    single_flight = SingleFlight()
+
+    async def factory():
+        await asyncio.sleep(0.01)
+        raise KeyError('key')
+
+    async def run():
+        return await asyncio.gather(
+            *(single_flight.do('key', factory) for _ in range(3)), return_exceptions=True
+        )
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, KeyError) for result in results)
+    assert len(single_flight) == 0
+
+
+def test_single_flight_survives_cancelled_callers():
+    single_flight = SingleFlight()
+
+    async def factory():
+        await asyncio.sleep(0.01)
+        return 'value'
+
+    async def run():
+        leader = asyncio.ensure_future(single_flight.do('key', factory))
+        follower = asyncio.ensure_future(single_flight.do('key', factory))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(run()) == 'value'
@@ -0,0 +1,109 @@
+import json
+
+import pydantic
+import pytest
+
+from zarr_proxy.config import Settings, get_settings, reload_settings
+
+
+@pytest.fixture
+def restore_settings():
+    yield
+    reload_settings()
+
+
+def test_get_settings_is_cached():
+    assert get_settings() is get_settings()
+
+
+def test_settings_are_immutable():
+    with pytest.raises(pydantic.ValidationError):
+        get_settings().zarr_proxy_payload_size_limit = 1
+
+
+def test_reload_settings(monkeypatch, restore_settings):
+    before = get_settings()
+    monkeypatch.setenv('ZARR_PROXY_PAYLOAD_SIZE_LIMIT', '5mb')
+    monkeypatch.setenv('ZARR_PROXY_READ_TIMEOUT', '5')
+
+    settings = reload_settings()
+    assert settings is not before
+    assert settings is get_settings()
+    assert settings.zarr_proxy_payload_size_limit == 5_000_000
+    assert settings.zarr_proxy_read_timeout == 5.0
+
+
+@pytest.mark.parametrize(
+    'value, expected', [(1024, 1024), ('2 mb', 2_000_000), ('1KiB', 1024), ('3gb', 3_000_000_000)]
+)
+def test_byte_size_settings(value, expected):
+    assert Settings(zarr_proxy_chunk_cache_size=value).zarr_proxy_chunk_cache_size == expected
+
+
+def test_invalid_byte_size_setting():
+    with pytest.raises(pydantic.ValidationError, match='zarr_proxy_chunk_cache_size'):
+        Settings(zarr_proxy_chunk_cache_size='lots')
+
+
+def test_get_upstream_host():
+    settings = Settings(
+        zarr_proxy_request_timeout=30,
+        zarr_proxy_upstream_hosts={
+            'storage.googleapis.com': {'connection_limit': 8},
+            '*.s3.amazonaws.com': {'request_timeout': None},
+        },
+    )
+    google = settings.get_upstream_host('storage.googleapis.com')
+    assert google.connection_limit == 8
+    assert google.request_timeout == 30
+    assert settings.get_upstream_host('bucket.s3.amazonaws.com').request_timeout is None
+    assert settings.get_upstream_host('example.com') is None
+
+
+def test_get_upstream_host_is_memoized_per_host():
+    settings = Settings(zarr_proxy_upstream_hosts={'*.s3.amazonaws.com': {}})
+    upstream = settings.get_upstream_host('bucket.s3.amazonaws.com')
+    assert settings.get_upstream_host('bucket.s3.amazonaws.com') is upstream
+    assert settings.get_upstream_host('other.s3.amazonaws.com') is not upstream
+    # new settings resolve the host again
+    assert Settings().get_upstream_host('bucket.s3.amazonaws.com') is not upstream
+    copy = settings.model_copy(update={'zarr_proxy_retries': 7})
+    assert copy.get_upstream_host('bucket.s3.amazonaws.com').retries == 7
+
+
+@pytest.mark.parametrize(
+    'host',
+    [
+        'evil.com?.s3.amazonaws.com',
+        'evil.com#.s3.amazonaws.com',
+        'evil.com@bucket.s3.amazonaws.com',
+        'evil.com/.s3.amazonaws.com',
+    ],
+)
+@pytest.mark.parametrize('upstream_hosts', [None, {'*.s3.amazonaws.com': {}}])
+def test_get_upstream_host_rejects_hosts_that_are_not_host_names(host, upstream_hosts):
+    settings = Settings(zarr_proxy_upstream_hosts=upstream_hosts)
+    assert settings.get_upstream_host(host) is None
+
+
+def test_get_upstream_host_accepts_ports():
+    settings = Settings(zarr_proxy_upstream_hosts={'localhost:*': {}})
+    assert settings.get_upstream_host('localhost:8000').url == 'https://localhost:8000'
+
+
+def test_get_upstream_host_allows_any_host_by_default():
+    upstream = Settings(zarr_proxy_retries=5).get_upstream_host('example.com')
+    assert upstream.retries == 5
+    assert upstream.connection_limit == Settings().zarr_proxy_connection_limit
+
+
+@pytest.mark.parametrize('separator', ['%3F', '%23', '%40', '%2F'])
+def test_hosts_escaping_the_allowlist_are_rejected(test_app, monkeypatch, separator):
+    monkeypatch.setenv('ZARR_PROXY_UPSTREAM_HOSTS', json.dumps({'*.s3.amazonaws.com': {}}))
+    reload_settings()
+    try:
+        response = test_app.get(f'/evil.com{separator}.s3.amazonaws.com/dataset.zarr/.zmetadata')
+    finally:
+        monkeypatch.undo()
+        reload_settings()
+    assert response.status_code == 403
@@ -0,0 +1,49 @@
+import io
+
+import numpy as np
+import pytest
+
+from zarr_proxy.formats import arrow_ipc, check_chunk_format, negotiate_chunk_format, npy_header
+
+
+@pytest.mark.parametrize(
+    'accept, expected',
+    [
+        (None, 'raw'),
+        ('*/*', 'raw'),
+        ('text/html', 'raw'),
+        ('application/x-npy', 'npy'),
+        ('application/vnd.apache.arrow.stream', 'arrow'),
+        ('application/x-npy;q=0.5, application/vnd.apache.arrow.stream', 'arrow'),
+        ('application/x-npy, application/vnd.apache.arrow.stream', 'npy'),
+        ('application/x-npy;q=0, */*', 'raw'),
+    ],
+)
+def test_negotiate_chunk_format(accept, expected):
+    assert negotiate_chunk_format(accept) == expected
+
+
+@pytest.mark.parametrize('dtype', ['<f4', '>i8', 'u1'])
+def test_npy_header(dtype):
+    data = np.arange(12, dtype=dtype).reshape(3, 4)
+    body = npy_header(shape=data.shape, dtype=data.dtype) + data.tobytes()
+
+    np.testing.assert_array_equal(np.load(io.BytesIO(body)), data)
+
+
+def test_check_chunk_format():
+    check_chunk_format('raw', dtype=np.dtype(object))
+    check_chunk_format('npy', dtype=np.dtype('f8'))
+    with pytest.raises(ValueError):
+        check_chunk_format('npy', dtype=np.dtype(object))
+
+
+@pytest.mark.parametrize('dtype', ['<f4', '>f8'])
+def test_arrow_ipc(dtype):
+    pa = pytest.importorskip('pyarrow')
+    data = np.arange(12, dtype=dtype).reshape(3, 4)
+
+    table = pa.ipc.open_stream(arrow_ipc(data, name='air')).read_all()
+
+    assert table.schema.metadata[b'shape'] == b'3,4'
+    np.testing.assert_array_equal(table.column('air').to_numpy().reshape(3, 4), data)
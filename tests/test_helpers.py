@@ -1,12 +1,32 @@
+import asyncio
 import logging
-from unittest.mock import MagicMock, patch
+from unittest.mock import ANY, AsyncMock, MagicMock, patch
 
 import aiohttp
+import fsspec.implementations.http
 import pytest
 import zarr
+from aiohttp import web
+from aiohttp.test_utils import TestServer
 
+from zarr_proxy.cache import DiskCache
+from zarr_proxy.config import Settings
 from zarr_proxy.exceptions import ZarrProxyHTTPException
-from zarr_proxy.helpers import load_metadata_file, open_store
+from zarr_proxy.helpers import (
+    _get_client,
+    _retry_middleware,
+    etag_matches,
+    fetch_bytes,
+    fetch_chunk_bytes,
+    filesystem_cache,
+    load_metadata_file,
+    load_metadata_file_async,
+    make_etag,
+    open_filesystem,
+    open_store,
+    settings,
+    store_cache,
+)
 
 
 @pytest.fixture
@@ -21,14 +41,146 @@ def logger_mock():
     return MagicMock(spec=logging.Logger)
 
 
-def test_load_metadata_file_success(store_mock, logger_mock):
-    store_mock.__getitem__.return_value = b'{"test_key": "test_value"}'
+@pytest.fixture
+def fetch_mock():
+    with patch('zarr_proxy.helpers._fetch_metadata', AsyncMock()) as fetch:
+        yield fetch
+
+
+def test_load_metadata_file_success(store_mock, logger_mock, fetch_mock):
+    fetch_mock.return_value = (b'{"test_key": "test_value"}', None)
     result = load_metadata_file(store=store_mock, key='metadata_key', logger=logger_mock)
     assert result == {'test_key': 'test_value'}
 
 
-def test_load_metadata_file_key_error(store_mock, logger_mock):
-    store_mock.__getitem__.side_effect = KeyError('metadata_key')
+def test_load_metadata_file_is_cached(store_mock, logger_mock, fetch_mock):
+    fetch_mock.return_value = (b'{"test_key": "test_value"}', None)
+    first = load_metadata_file(store=store_mock, key='metadata_key', logger=logger_mock)
+    first['test_key'] = 'modified'
+    second = load_metadata_file(store=store_mock, key='metadata_key', logger=logger_mock)
+
+    assert second == {'test_key': 'test_value'}
+    assert fetch_mock.call_count == 1
+
+
+@pytest.mark.parametrize('etag, expected_fetches', [('"v1"', 1), ('"v2"', 2)])
+def test_load_metadata_file_revalidates_stale_entries(
+    store_mock, logger_mock, etag, expected_fetches
+):
+    upstream = {'etag': '"v1"'}
+    fetches = []
+
+    async def fetch_metadata(*, store, key, validator=None):
+        if validator == upstream['etag']:
+            return None, validator
+        fetches.append(key)
+        return b'{"test_key": "test_value"}', upstream['etag']
+
+    with patch('zarr_proxy.helpers._fetch_metadata', fetch_metadata):
+        load_metadata_file(store=store_mock, key='metadata_key', logger=logger_mock)
+        upstream['etag'] = etag
+        stale_settings = settings.model_copy(update={'zarr_proxy_metadata_cache_ttl': -1})
+        with patch('zarr_proxy.helpers.get_settings', return_value=stale_settings):
+            load_metadata_file(store=store_mock, key='metadata_key', logger=logger_mock)
+
+    assert len(fetches) == expected_fetches
+
+
+def test_metadata_is_fetched_and_revalidated_with_one_conditional_get(logger_mock):
+    requests = []
+
+    async def handler(request):
+        requests.append(request.headers.get('If-None-Match'))
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304)
+        return web.Response(body=b'{"units": "K"}', headers={'ETag': '"v1"'})
+
+    async def load_twice():
+        app = web.Application()
+        app.router.add_get('/data.zarr/.zattrs', handler)
+        async with TestServer(app) as server:
+            fs = fsspec.implementations.http.HTTPFileSystem(skip_instance_cache=True)
+            store = zarr.storage.FSStore(str(server.make_url('/data.zarr')), fs=fs)
+            first = await load_metadata_file_async(store=store, key='.zattrs', logger=logger_mock)
+            stale_settings = settings.model_copy(update={'zarr_proxy_metadata_cache_ttl': -1})
+            with patch('zarr_proxy.helpers.get_settings', return_value=stale_settings):
+                second = await load_metadata_file_async(
+                    store=store, key='.zattrs', logger=logger_mock
+                )
+        return first, second
+
+    assert asyncio.run(load_twice()) == ({'units': 'K'}, {'units': 'K'})
+    # the validator comes with the body, and revalidation is a single conditional GET
+    assert requests == [None, '"v1"']
+
+
+def test_load_metadata_file_async(logger_mock):
+    store = zarr.storage.FSStore('memory://test_load_metadata_file_async')
+    store['.zattrs'] = b'{"units": "K"}'
+
+    assert asyncio.run(
+        load_metadata_file_async(store=store, key='.zattrs', logger=logger_mock)
+    ) == {'units': 'K'}
+    with pytest.raises(ZarrProxyHTTPException) as exc_info:
+        asyncio.run(load_metadata_file_async(store=store, key='.zarray', logger=logger_mock))
+    assert exc_info.value.status_code == 404
+
+
+def test_fetch_bytes_missing_key():
+    store = zarr.storage.FSStore('memory://test_fetch_bytes_missing_key')
+    with pytest.raises(KeyError):
+        asyncio.run(fetch_bytes(store=store, key='0.0'))
+
+
+def test_fetch_bytes_coalesces_concurrent_requests():
+    store = zarr.storage.FSStore('memory://test_fetch_bytes_coalesces_concurrent_requests')
+    calls = []
+
+    async def call_filesystem(fs, method, *args, **kwargs):
+        calls.append((method, args, kwargs))
+        await asyncio.sleep(0.01)
+        return b'chunk'
+
+    async def fetch_all():
+        return await asyncio.gather(
+            *(fetch_bytes(store=store, key='0.0') for _ in range(10)),
+            fetch_bytes(store=store, key='0.0', start=0, end=2),
+        )
+
+    with patch('zarr_proxy.helpers.call_filesystem', call_filesystem):
+        assert asyncio.run(fetch_all()) == [b'chunk'] * 11
+
+    # one request for the whole chunk and one for the byte range
+    assert len(calls) == 2
+
+
+def test_fetch_chunk_bytes_uses_disk_cache(tmp_path):
+    store = zarr.storage.FSStore('memory://test_fetch_chunk_bytes_uses_disk_cache')
+    store['0.0'] = b'chunk'
+    disk_cache = DiskCache(directory=str(tmp_path), maxbytes=100)
+
+    with patch('zarr_proxy.helpers.disk_cache', disk_cache):
+        assert asyncio.run(fetch_chunk_bytes(store=store, key='0.0')) == b'chunk'
+        del store['0.0']
+        assert asyncio.run(fetch_chunk_bytes(store=store, key='0.0')) == b'chunk'
+
+    assert disk_cache.stats()['hits'] == 1
+
+
+def test_fetch_chunk_bytes_disk_cache_is_keyed_by_metadata_identity(tmp_path):
+    store = zarr.storage.FSStore('memory://test_fetch_chunk_bytes_disk_cache_identity')
+    store['0.0'] = b'old'
+    disk_cache = DiskCache(directory=str(tmp_path), maxbytes=100)
+
+    with patch('zarr_proxy.helpers.disk_cache', disk_cache):
+        assert asyncio.run(fetch_chunk_bytes(store=store, key='0.0', identity='v1')) == b'old'
+        store['0.0'] = b'new'
+        assert asyncio.run(fetch_chunk_bytes(store=store, key='0.0', identity='v2')) == b'new'
+        assert asyncio.run(fetch_chunk_bytes(store=store, key='0.0', identity='v1')) == b'old'
+
+
+def test_load_metadata_file_key_error(store_mock, logger_mock, fetch_mock):
+    fetch_mock.side_effect = KeyError('metadata_key')
     with pytest.raises(ZarrProxyHTTPException) as exc_info:
         load_metadata_file(store=store_mock, key='metadata_key', logger=logger_mock)
     assert exc_info.value.status_code == 404
@@ -36,7 +188,7 @@ def test_load_metadata_file_key_error(store_mock, logger_mock):
     assert message == 'metadata_key not found in store: /test/store/path'
 
 
-def test_load_metadata_file_client_response_error(store_mock, logger_mock):
+def test_load_metadata_file_client_response_error(store_mock, logger_mock, fetch_mock):
     request_info_mock = MagicMock()
     request_info_mock.real_url = 'http://example.com'
     history_mock = MagicMock()
@@ -44,14 +196,14 @@ def test_load_metadata_file_client_response_error(store_mock, logger_mock):
         request_info=request_info_mock, history=history_mock, status=500
     )
 
-    store_mock.__getitem__.side_effect = response_error
+    fetch_mock.side_effect = response_error
     with pytest.raises(ZarrProxyHTTPException) as exc_info:
         load_metadata_file(store=store_mock, key='metadata_key', logger=logger_mock)
     assert exc_info.value.status_code == 500
 
 
-def test_load_metadata_file_general_error(store_mock, logger_mock):
-    store_mock.__getitem__.side_effect = Exception('Unexpected error')
+def test_load_metadata_file_general_error(store_mock, logger_mock, fetch_mock):
+    fetch_mock.side_effect = Exception('Unexpected error')
     with pytest.raises(ZarrProxyHTTPException) as exc_info:
         load_metadata_file(store=store_mock, key='metadata_key', logger=logger_mock)
     assert exc_info.value.status_code == 500
@@ -64,4 +216,88 @@ def test_open_store(logger_mock):
         with patch('zarr.storage.FSStore', return_value=fsstore_mock) as fsstore_constructor:
             result = open_store(host='example.com', path='test_path', logger=logger_mock)
             assert result == fsstore_mock
-            fsstore_constructor.assert_called_once_with(base_url)
+            fsstore_constructor.assert_called_once_with(base_url, fs=ANY)
+
+            # a second request for the same store is served from the registry
+            assert open_store(host='example.com', path='test_path', logger=logger_mock) is result
+            fsstore_constructor.assert_called_once()
+            assert store_cache.stats()['hits'] == 1
+
+
+def test_open_filesystem_is_shared_per_host():
+    fs = open_filesystem(host='example.com')
+    assert open_filesystem(host='example.com') is fs
+    assert open_filesystem(host='example.org') is not fs
+
+
+def test_open_store_rejects_disallowed_hosts(logger_mock):
+    allowlist = Settings(zarr_proxy_upstream_hosts={'example.com': {}})
+    with patch('zarr_proxy.helpers.get_settings', return_value=allowlist):
+        assert open_store(host='example.com', path='test_path', logger=logger_mock) is not None
+        with pytest.raises(ZarrProxyHTTPException) as exc_info:
+            open_store(host='example.org', path='test_path', logger=logger_mock)
+
+    assert exc_info.value.status_code == 403
+    assert ('example.org', 'test_path') not in store_cache
+    assert 'example.org' not in filesystem_cache
+
+
+def test_get_client_applies_upstream_settings():
+    upstream = Settings(
+        zarr_proxy_upstream_hosts={'example.com': {'connection_limit': 7, 'read_timeout': 3}}
+    ).get_upstream_host('example.com')
+
+    async def get_client_settings():
+        async with await _get_client(upstream=upstream) as client:
+            return client.connector.limit, client.timeout.sock_read
+
+    assert asyncio.run(get_client_settings()) == (7, 3)
+
+
+@pytest.mark.parametrize(
+    'outcomes, expected_calls, expected_status',
+    [([200], 1, 200), ([503, 200], 2, 200), ([503, 503, 503], 3, 503), ([404], 1, 404)],
+)
+def test_retry_middleware(outcomes, expected_calls, expected_status):
+    responses = iter(outcomes)
+    calls = 0
+
+    async def handler(request):
+        nonlocal calls
+        calls += 1
+        return MagicMock(status=next(responses))
+
+    middleware = _retry_middleware(retries=2, backoff=0)
+    response = asyncio.run(middleware(MagicMock(), handler))
+    assert response.status == expected_status
+    assert calls == expected_calls
+
+
+def test_retry_middleware_connection_errors():
+    async def handler(request):
+        raise aiohttp.ClientConnectionError()
+
+    with pytest.raises(aiohttp.ClientConnectionError):
+        asyncio.run(_retry_middleware(retries=1, backoff=0)(MagicMock(), handler))
+
+
+def test_make_etag_depends_on_all_parts():
+    etag = make_etag('https://example.com/data.zarr', '.zarray', '"abc"', (10, 10))
+    assert etag == make_etag('https://example.com/data.zarr', '.zarray', '"abc"', (10, 10))
+    assert etag != make_etag('https://example.com/data.zarr', '.zarray', '"abc"', (5, 5))
+    assert etag.startswith('"') and etag.endswith('"')
+
+
+@pytest.mark.parametrize(
+    'if_none_match, expected',
+    [
+        (None, False),
+        ('"a"', True),
+        ('"b", "a"', True),
+        ('W/"a"', True),
+        ('*', True),
+        ('"b"', False),
+    ],
+)
+def test_etag_matches(if_none_match, expected):
+    assert etag_matches(if_none_match, '"a"') is expected
@@ -0,0 +1,65 @@
+import asyncio
+import io
+import json
+import logging
+
+import pytest
+
+from zarr_proxy.log import (
+    AccessLogMiddleware,
+    JSONFormatter,
+    Sampler,
+    TextFormatter,
+    add_access_log_fields,
+)
+
+
+def make_record(**fields):
+    record = logging.LogRecord('zarr-proxy', logging.INFO, __file__, 1, 'GET %s', ('/x',), None)
+    record.fields = fields
+    return record
+
+
+def test_text_formatter_appends_fields():
+    line = TextFormatter().format(make_record(status=200, chunk_key='0.0'))
+    assert line.endswith('GET /x status=200 chunk_key=0.0')
+
+
+def test_json_formatter():
+    entry = json.loads(JSONFormatter().format(make_record(status=200)))
+    assert entry['message'] == 'GET /x'
+    assert entry['level'] == 'INFO'
+    assert entry['status'] == 200
+
+
+@pytest.mark.parametrize('rate, expected', [(0, 0), (1, 100)])
+def test_sampler(rate, expected):
+    sample = Sampler(rate)
+    assert sum(sample() for _ in range(100)) == expected
+
+
+def test_access_log_middleware():
+    stream = io.StringIO()
+    logger = logging.getLogger('zarr-proxy-test-access-log')
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JSONFormatter())
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+    async def app(scope, receive, send):
+        add_access_log_fields(chunk_key='1.2')
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b'abcd'})
+
+    async def send(message):
+        pass
+
+    middleware = AccessLogMiddleware(app, logger=logger)
+    asyncio.run(middleware({'type': 'http', 'method': 'GET', 'path': '/a/b/1.2'}, None, send))
+
+    (line,) = stream.getvalue().splitlines()
+    entry = json.loads(line)
+    assert entry['message'] == 'GET /a/b/1.2'
+    assert entry['status'] == 200
+    assert entry['bytes'] == 4
+    assert entry['chunk_key'] == '1.2'
@@ -1,6 +1,24 @@
+import numpy as np
 import pytest
 
-from zarr_proxy.logic import chunk_id_to_slice, parse_chunks_header, validate_chunks_info
+from zarr_proxy.logic import (
+    canonical_chunks_header,
+    chunk_byte_ranges,
+    chunk_id_to_slice,
+    chunk_key_encoding_v3,
+    compressor_codec_v3,
+    get_chunk_grid,
+    merge_byte_ranges,
+    parse_chunks_header,
+    parse_codecs_v3,
+    parse_compressor_header,
+    parse_region,
+    parse_step,
+    source_chunk_key,
+    source_chunk_selections,
+    validate_chunks_info,
+    virtual_zarr_json,
+)
 
 
 @pytest.mark.parametrize(
@@ -46,6 +64,227 @@ def test_chunk_id_to_slice():
     assert chunk_id_to_slice('1.1', shape=shape, chunks=chunks) == (slice(1, 2), slice(2, 4))
 
 
+@pytest.mark.parametrize('chunk_key', ['2.0', '0.-1', '0', '0.0.0'])
+def test_chunk_id_to_slice_invalid(chunk_key):
+    with pytest.raises(IndexError):
+        chunk_id_to_slice(chunk_key, shape=(2, 4), chunks=(1, 2))
+
+
+def test_chunk_grid():
+    grid = get_chunk_grid(shape=(9, 4), chunks=(6, 3), source_chunks=(4, 5))
+
+    assert grid is get_chunk_grid(shape=(9, 4), chunks=(6, 3), source_chunks=(4, 5))
+    assert grid.chunks_block_shape == (2, 2)
+    assert grid.num_chunks == 4
+    assert grid.chunk_slice(grid.parse_key('1.1')) == (slice(6, 9), slice(3, 4))
+    for chunk_key in ['0.0', '0.1', '1.0', '1.1']:
+        chunk_index = grid.parse_key(chunk_key)
+        assert grid.selections(chunk_index) == source_chunk_selections(
+            grid.chunk_slice(chunk_index), source_chunks=(4, 5)
+        )
+
+
+def test_chunk_grid_of_many_chunks_is_built_lazily():
+    # a grid chosen by a client may have more chunks than could ever be enumerated
+    grid = get_chunk_grid(shape=(10**12,), chunks=(1,), source_chunks=(1000,))
+
+    assert grid.num_chunks == 10**12
+    assert grid.chunk_slice((123_456_789,)) == (slice(123_456_789, 123_456_790),)
+    assert grid.selections((123_456_789,)) == [((123_456,), (slice(789, 790),), (slice(0, 1),))]
+
+
+def test_chunk_grid_chunk_slices():
+    grid = get_chunk_grid(shape=(9, 4), chunks=(6, 3))
+    chunk_keys = ['0.0', '1.1', '0.1']
+
+    assert grid.chunk_slices(chunk_keys) == [
+        chunk_id_to_slice(chunk_key, shape=(9, 4), chunks=(6, 3)) for chunk_key in chunk_keys
+    ]
+    assert grid.chunk_slices(['1/0'], delimiter='/') == [(slice(6, 9), slice(0, 3))]
+    assert get_chunk_grid(shape=(), chunks=()).chunk_slices(['0']) == [()]
+    with pytest.raises(IndexError):
+        grid.chunk_slices(['0.0', '2.0'])
+    with pytest.raises(IndexError):
+        grid.chunk_slices(['0.0', '0'])
+    with pytest.raises(IndexError):
+        grid.chunk_slices(['99999999999999999999999.0'])
+
+
+def test_source_chunk_selections():
+    selections = source_chunk_selections((slice(3, 9), slice(0, 4)), source_chunks=(4, 5))
+
+    assert selections == [
+        ((0, 0), (slice(3, 4), slice(0, 4)), (slice(0, 1), slice(0, 4))),
+        ((1, 0), (slice(0, 4), slice(0, 4)), (slice(1, 5), slice(0, 4))),
+        ((2, 0), (slice(0, 1), slice(0, 4)), (slice(5, 6), slice(0, 4))),
+    ]
+
+
+def test_source_chunk_selections_with_step():
+    selections = source_chunk_selections((slice(1, 12, 5),), source_chunks=(4,))
+
+    # position 6 is skipped: the chunk 1 (positions 4-7) holds it, the chunk 2 holds 11
+    assert selections == [
+        ((0,), (slice(1, 2, 5),), (slice(0, 1),)),
+        ((1,), (slice(2, 3, 5),), (slice(1, 2),)),
+        ((2,), (slice(3, 4, 5),), (slice(2, 3),)),
+    ]
+    assert source_chunk_selections((slice(0, 12, 10),), source_chunks=(4,)) == [
+        ((0,), (slice(0, 1, 10),), (slice(0, 1),)),
+        ((2,), (slice(2, 3, 10),), (slice(1, 2),)),
+    ]
+
+
+@pytest.mark.parametrize(
+    'region, expected',
+    [
+        (None, (slice(0, 10), slice(0, 20))),
+        ('2:5,:', (slice(2, 5), slice(0, 20))),
+        (':3, 15:100', (slice(0, 3), slice(15, 20))),
+    ],
+)
+def test_parse_region(region, expected):
+    assert parse_region(region, shape=(10, 20)) == expected
+
+
+@pytest.mark.parametrize('region', ['0:5', '5:2,:', 'a:b,:', '3,:', '-1:2,:', '10:,:'])
+def test_parse_region_invalid(region):
+    with pytest.raises(ValueError):
+        parse_region(region, shape=(10, 20))
+
+
+@pytest.mark.parametrize(
+    'step, expected', [(None, (1, 1, 1)), ('4', (4, 4, 4)), ('1,2,3', (1, 2, 3))]
+)
+def test_parse_step(step, expected):
+    assert parse_step(step, ndim=3) == expected
+
+
+@pytest.mark.parametrize('step', ['0', '1,2', 'x', '2,-1,2'])
+def test_parse_step_invalid(step):
+    with pytest.raises(ValueError):
+        parse_step(step, ndim=3)
+
+
+def test_source_chunk_selections_zero_dimensional():
+    assert source_chunk_selections((), source_chunks=()) == [((), (), ())]
+
+
+@pytest.mark.parametrize(
+    'chunk_index, delimiter, expected',
+    [((1, 3, 2), '.', '1.3.2'), ((1, 3, 2), '/', '1/3/2'), ((), '.', '0')],
+)
+def test_source_chunk_key(chunk_index, delimiter, expected):
+    assert source_chunk_key(chunk_index, delimiter=delimiter) == expected
+
+
+@pytest.mark.parametrize(
+    'chunk_index, expected', [((1, 3, 2), 'c/1/3/2'), ((0,), 'c/0'), ((), 'c')]
+)
+def test_source_chunk_key_prefix(chunk_index, expected):
+    assert source_chunk_key(chunk_index, delimiter='/', prefix='c') == expected
+
+
+@pytest.mark.parametrize(
+    'encoding, expected',
+    [
+        (None, ('c', '/')),
+        ({'name': 'default', 'configuration': {'separator': '.'}}, ('c', '.')),
+        ({'name': 'v2'}, ('', '.')),
+        ({'name': 'v2', 'configuration': {'separator': '/'}}, ('', '/')),
+    ],
+)
+def test_chunk_key_encoding_v3(encoding, expected):
+    metadata = {} if encoding is None else {'chunk_key_encoding': encoding}
+    assert chunk_key_encoding_v3(metadata) == expected
+
+
+def test_parse_codecs_v3():
+    parts = parse_codecs_v3(
+        [
+            {'name': 'transpose', 'configuration': {'order': [2, 1, 0]}},
+            {'name': 'bytes', 'configuration': {'endian': 'big'}},
+            {'name': 'gzip', 'configuration': {'level': 1}},
+            {'name': 'crc32c'},
+        ]
+    )
+    assert parts == {
+        'order': 'F',
+        'endian': 'big',
+        'codecs': [
+            {'name': 'gzip', 'configuration': {'level': 1}},
+            {'name': 'crc32c', 'configuration': {}},
+        ],
+        'sharding': None,
+    }
+
+
+@pytest.mark.parametrize(
+    'codecs',
+    [
+        [{'name': 'transpose', 'configuration': {'order': [1, 0, 2]}}, {'name': 'bytes'}],
+        [{'name': 'vlen-utf8'}],
+    ],
+)
+def test_parse_codecs_v3_unsupported(codecs):
+    with pytest.raises(ValueError):
+        parse_codecs_v3(codecs)
+
+
+@pytest.mark.parametrize(
+    'compressor, expected',
+    [
+        (
+            {'id': 'zstd', 'level': 3},
+            {'name': 'zstd', 'configuration': {'level': 3, 'checksum': False}},
+        ),
+        (
+            {'id': 'blosc', 'cname': 'lz4', 'clevel': 5, 'shuffle': 1},
+            {
+                'name': 'blosc',
+                'configuration': {
+                    'cname': 'lz4',
+                    'clevel': 5,
+                    'shuffle': 'shuffle',
+                    'typesize': 4,
+                    'blocksize': 0,
+                },
+            },
+        ),
+        ({'id': 'zlib', 'level': 1}, {'name': 'numcodecs.zlib', 'configuration': {'level': 1}}),
+    ],
+)
+def test_compressor_codec_v3(compressor, expected):
+    assert compressor_codec_v3(compressor, itemsize=4) == expected
+
+
+def test_virtual_zarr_json_of_sharded_array():
+    metadata = {
+        'zarr_format': 3,
+        'node_type': 'array',
+        'shape': [20, 30],
+        'data_type': 'int16',
+        'chunk_grid': {'name': 'regular', 'configuration': {'chunk_shape': [10, 16]}},
+        'chunk_key_encoding': {'name': 'v2', 'configuration': {'separator': '.'}},
+        'fill_value': 0,
+        'codecs': [
+            {
+                'name': 'sharding_indexed',
+                'configuration': {
+                    'chunk_shape': [5, 8],
+                    'codecs': [{'name': 'bytes', 'configuration': {'endian': 'big'}}],
+                    'index_codecs': [{'name': 'bytes', 'configuration': {'endian': 'little'}}],
+                },
+            }
+        ],
+    }
+    virtual = virtual_zarr_json(metadata, chunks=None, compressor=None)
+    assert virtual['chunk_grid']['configuration']['chunk_shape'] == [5, 8]
+    assert virtual['chunk_key_encoding'] == {'name': 'default', 'configuration': {'separator': '/'}}
+    assert virtual['codecs'] == [{'name': 'bytes', 'configuration': {'endian': 'big'}}]
+    assert virtual['shape'] == [20, 30]
+
+
 @pytest.mark.parametrize(
     'chunks, expected_output',
     [
@@ -83,6 +322,31 @@ def test_parse_chunks_header(chunks, expected_output):
     assert output == expected_output
 
 
+@pytest.mark.parametrize(
+    'chunks, expected_output',
+    [
+        ('a=1,2,', {'a': (1, 2)}),
+        ('a=1,0,b=2', {'b': (2,)}),
+        ('a=1,x,b=2', {'b': (2,)}),
+        ('a=1,b=,c=3', {'a': (1,), 'c': (3,)}),
+        ('1,2,a=3', {'a': (3,)}),
+        ('a=1,a=2,2', {'a': (2, 2)}),
+    ],
+)
+def test_parse_chunks_header_skips_invalid_entries(chunks, expected_output):
+    assert parse_chunks_header(chunks) == expected_output
+
+
+def test_parse_chunks_header_returns_a_new_dict():
+    parse_chunks_header('a=1').clear()
+    assert parse_chunks_header('a=1') == {'a': (1,)}
+
+
+def test_canonical_chunks_header():
+    assert canonical_chunks_header('prec=20, 20, bed=10,10,lat=five') == 'bed=10,10,prec=20,20'
+    assert canonical_chunks_header('') == ''
+
+
 def test_input_with_mixed_delimiters():
     chunks = 'bed=10 10,prec=20;20,lat=5'
     expected = {'bed': (10, 10), 'prec': (20, 20), 'lat': (5,)}
@@ -94,3 +358,70 @@ def test_input_with_invalid_characters():
     chunks = 'bed#=10,10,prec$=20,20,lat^=5'
     expected = {}
     assert parse_chunks_header(chunks) == expected
+
+
+@pytest.mark.parametrize(
+    'compressor, expected',
+    [
+        ('none', None),
+        ('zstd', {'id': 'zstd', 'level': 1}),
+        ('ZLIB:9', {'id': 'zlib', 'level': 9}),
+        ('lz4', {'id': 'lz4', 'acceleration': 1}),
+        ('blosc', {'id': 'blosc', 'cname': 'lz4', 'clevel': 5, 'shuffle': 1}),
+        ('blosc:zstd:3', {'id': 'blosc', 'cname': 'zstd', 'clevel': 3, 'shuffle': 1}),
+    ],
+)
+def test_parse_compressor_header(compressor, expected):
+    assert parse_compressor_header(compressor) == expected
+
+
+@pytest.mark.parametrize('compressor', ['bz2', 'zstd:fast', 'zlib:1:2', 'blosc:snappy'])
+def test_parse_compressor_header_invalid(compressor):
+    with pytest.raises(ValueError):
+        parse_compressor_header(compressor)
+
+
+@pytest.mark.parametrize(
+    'compressor',
+    ['zlib:99', 'gzip:10', 'zstd:23', 'blosc:lz4:99', 'lz4:0', 'lz4:99999999999999999999'],
+)
+def test_parse_compressor_header_level_out_of_range(compressor):
+    with pytest.raises(ValueError, match='must be between'):
+        parse_compressor_header(compressor)
+
+
+@pytest.mark.parametrize('order', ['C', 'F'])
+@pytest.mark.parametrize(
+    'chunk_selection',
+    [
+        (slice(0, 6), slice(0, 4)),
+        (slice(2, 3), slice(0, 4)),
+        (slice(0, 6), slice(1, 3)),
+        (slice(1, 5, 2), slice(3, 4)),
+        (slice(0, 6, 5), slice(0, 4)),
+    ],
+)
+def test_chunk_byte_ranges(chunk_selection, order):
+    chunk = np.arange(24, dtype='<i2').reshape(6, 4)
+    raw = np.frombuffer(chunk.tobytes(order=order), dtype=np.uint8)
+    ranges = chunk_byte_ranges(chunk_selection, chunks=(6, 4), itemsize=2, order=order)
+
+    # the ranges hold exactly the selected elements
+    selected = np.concatenate([raw[start:stop] for start, stop in ranges]).view('<i2')
+    expected = chunk[chunk_selection]
+    assert sorted(selected) == sorted(expected.reshape(-1))
+
+
+def test_chunk_byte_ranges_limit():
+    selection = (slice(0, 10), slice(5, 6))
+    assert chunk_byte_ranges(selection, chunks=(10, 10), itemsize=1, limit=10).shape == (10, 2)
+    assert chunk_byte_ranges(selection, chunks=(10, 10), itemsize=1, limit=9) is None
+
+
+@pytest.mark.parametrize(
+    'gap, expected',
+    [(0, [(0, 5), (10, 30), (40, 50)]), (9, [(0, 30), (40, 50)]), (100, [(0, 50)])],
+)
+def test_merge_byte_ranges(gap, expected):
+    ranges = np.array([[10, 20], [0, 5], [18, 30], [40, 50], [12, 14]])
+    assert merge_byte_ranges(ranges, gap=gap) == expected
@@ -0,0 +1,58 @@
+import pytest
+
+from zarr_proxy.metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_counter_and_gauge_render():
+    registry = Registry()
+    counter = registry.register(Counter('requests_total', 'Requests', labelnames=('status',)))
+    gauge = registry.register(Gauge('in_flight', 'In flight'))
+    counter.inc(status=200)
+    counter.inc(2, status=200)
+    counter.inc(status=404)
+    gauge.inc()
+    gauge.dec()
+
+    assert counter.get(status=200) == 3
+    assert registry.render() == (
+        '# HELP requests_total Requests\n'
+        '# TYPE requests_total counter\n'
+        'requests_total{status="200"} 3.0\n'
+        'requests_total{status="404"} 1.0\n'
+        '# HELP in_flight In flight\n'
+        '# TYPE in_flight gauge\n'
+        'in_flight 0.0\n'
+    )
+
+
+def test_histogram_render():
+    histogram = Histogram('duration_seconds', 'Duration', labelnames=('stage',), buckets=(0.1, 1))
+    histogram.observe(0.05, stage='fetch')
+    histogram.observe(0.5, stage='fetch')
+    histogram.observe(5, stage='fetch')
+
+    assert histogram.count(stage='fetch') == 3
+    assert histogram.render().splitlines()[2:] == [
+        'duration_seconds_bucket{stage="fetch",le="0.1"} 1.0',
+        'duration_seconds_bucket{stage="fetch",le="1.0"} 2.0',
+        'duration_seconds_bucket{stage="fetch",le="+Inf"} 3.0',
+        'duration_seconds_sum{stage="fetch"} 5.55',
+        'duration_seconds_count{stage="fetch"} 3.0',
+    ]
+
+
+def test_metric_labels_are_checked():
+    counter = Counter('requests_total', 'Requests', labelnames=('status',))
+    with pytest.raises(ValueError):
+        counter.inc(endpoint='get_chunk')
+
+
+def test_metrics_endpoint(test_app):
+    test_app.get('/health')
+    response = test_app.get('/metrics')
+
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain')
+    assert 'zarr_proxy_requests_total{endpoint="ping",method="GET",status="200"}' in response.text
+    assert 'zarr_proxy_cache_hit_ratio{cache="chunks"}' in response.text
+    assert '# TYPE zarr_proxy_upstream_requests_coalesced_total counter' in response.text
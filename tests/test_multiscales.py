@@ -0,0 +1,147 @@
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+import zarr
+
+from zarr_proxy import multiscales
+from zarr_proxy.config import reload_settings
+from zarr_proxy.multiscales import fit_chunks, level_factors, level_zarray, pyramid_zmetadata
+
+
+def _zarray(shape, chunks, dtype='<f4'):
+    return {
+        'zarr_format': 2,
+        'shape': shape,
+        'chunks': chunks,
+        'dtype': dtype,
+        'fill_value': None,
+        'order': 'C',
+        'compressor': {'id': 'zlib', 'level': 1},
+        'filters': None,
+    }
+
+
+@pytest.fixture
+def zmetadata():
+    return {
+        'zarr_consolidated_format': 1,
+        'metadata': {
+            '.zgroup': {'zarr_format': 2},
+            '.zattrs': {'title': 'air temperature'},
+            'air/.zarray': _zarray([10, 25, 53], [5, 10, 10], dtype='<i2'),
+            'air/.zattrs': {'_ARRAY_DIMENSIONS': ['time', 'lat', 'lon']},
+            'lat/.zarray': _zarray([25], [25]),
+            'lat/.zattrs': {'_ARRAY_DIMENSIONS': ['lat']},
+            'time/.zarray': _zarray([10], [10], dtype='<i8'),
+            'time/.zattrs': {'_ARRAY_DIMENSIONS': ['time']},
+            'name/.zarray': _zarray([10], [10], dtype='|O'),
+            'name/.zattrs': {'_ARRAY_DIMENSIONS': ['time']},
+        },
+    }
+
+
+@pytest.mark.parametrize(
+    'variable, level, expected',
+    [('air', 0, (1, 1, 1)), ('air', 2, (1, 4, 4)), ('lat', 1, (2,)), ('time', 3, (1,))],
+)
+def test_level_factors(zmetadata, variable, level, expected):
+    assert level_factors(zmetadata, variable, level) == expected
+
+
+def test_level_factors_without_dimension_names(zmetadata):
+    del zmetadata['metadata']['air/.zattrs']['_ARRAY_DIMENSIONS']
+    assert level_factors(zmetadata, 'air', 1) == (1, 2, 2)
+
+
+def test_level_zarray():
+    zarray = level_zarray(_zarray([10, 25, 53], [5, 10, 10], dtype='<i2'), (1, 4, 4))
+    assert zarray['shape'] == [10, 7, 14]
+    assert zarray['chunks'] == [5, 7, 10]
+    assert zarray['dtype'] == '<f8'
+    assert zarray['fill_value'] == 'NaN'
+    assert zarray['compressor'] is None
+
+
+def test_level_zarray_chunks_fit_in_max_nbytes():
+    zarray = level_zarray(
+        _zarray([10, 25, 53], [5, 10, 10], dtype='<i2'), (1, 4, 4), max_nbytes=1000
+    )
+    assert zarray['chunks'] == [5, 4, 5]
+
+
+@pytest.mark.parametrize(
+    'chunks, max_nbytes, expected',
+    [([4, 4], 128, [4, 4]), ([4, 4], 64, [2, 4]), ([100, 3], 8, [1, 1]), ([1, 1], 4, [1, 1])],
+)
+def test_fit_chunks(chunks, max_nbytes, expected):
+    assert fit_chunks(chunks, itemsize=8, max_nbytes=max_nbytes) == expected
+
+
+def test_level_zarray_unreduced_keeps_dtype():
+    zarray = level_zarray(_zarray([10, 25], [5, 10], dtype='<i2'), (1, 1))
+    assert zarray['shape'] == [10, 25]
+    assert zarray['dtype'] == '<i2'
+    assert zarray['fill_value'] is None
+
+
+def test_level_zarray_object_dtype():
+    assert level_zarray(_zarray([10], [10], dtype='|O'), (1,)) is None
+
+
+def test_pyramid_zmetadata(zmetadata):
+    metadata = pyramid_zmetadata(zmetadata, levels=3)['metadata']
+    (multiscales,) = metadata['.zattrs']['multiscales']
+    assert metadata['.zattrs']['title'] == 'air temperature'
+    assert [dataset['path'] for dataset in multiscales['datasets']] == ['0', '1', '2']
+    assert multiscales['metadata']['spatial_dimensions'] == ['lat', 'lon']
+    assert metadata['2/air/.zarray']['shape'] == [10, 7, 14]
+    assert metadata['2/lat/.zarray']['shape'] == [7]
+    assert metadata['2/time/.zarray']['shape'] == [10]
+    assert metadata['1/air/.zattrs'] == {'_ARRAY_DIMENSIONS': ['time', 'lat', 'lon']}
+    assert '0/name/.zarray' not in metadata
+    assert '3/.zgroup' not in metadata
+
+
+def test_multiscales_pyramid_is_built_once(test_app, offline_dataset):
+    with patch.object(
+        multiscales, 'pyramid_zmetadata', wraps=multiscales.pyramid_zmetadata
+    ) as pyramid_zmetadata:
+        for key in ['.zmetadata', '1/air/.zarray', '1/air/0.0', '1/air/0.0']:
+            response = test_app.get(f'/memory/offline.zarr/.multiscales/{key}')
+            assert response.status_code == 200
+    assert pyramid_zmetadata.call_count == 1
+    level = np.frombuffer(response.content, '<f4').reshape(7, 8)
+    np.testing.assert_allclose(level[0, 0], offline_dataset[:2, :2].mean())
+
+
+def test_multiscales_chunks_fit_in_the_payload_limit(test_app, offline_dataset, monkeypatch):
+    monkeypatch.setenv('ZARR_PROXY_PAYLOAD_SIZE_LIMIT', '200b')
+    reload_settings()
+    zarray = test_app.get('/memory/offline.zarr/.multiscales/1/air/.zarray').json()
+    assert zarray['chunks'] == [7, 4]
+    response = test_app.get('/memory/offline.zarr/.multiscales/1/air/0.1')
+    assert response.status_code == 200
+    level = np.frombuffer(response.content, '<f4').reshape(7, 4)
+    np.testing.assert_allclose(level[0, 0], offline_dataset[:2, 8:10].mean())
+
+
+def test_level_chunks_of_an_older_version_of_the_dataset_are_not_reused(
+    test_app, offline_dataset, monkeypatch
+):
+    monkeypatch.setenv('ZARR_PROXY_METADATA_CACHE_TTL', '0')
+    reload_settings()
+    first = test_app.get('/memory/offline.zarr/.multiscales/1/air/0.0')
+    level = np.frombuffer(first.content, '<f4').reshape(7, 8)
+    np.testing.assert_allclose(level[0, 0], offline_dataset[:2, :2].mean())
+
+    group = zarr.open_group(zarr.storage.FSStore('memory://offline.zarr'), mode='a')
+    air = group.create_dataset(
+        'air', data=offline_dataset + 1000, chunks=(7, 8), fill_value=-1, overwrite=True
+    )
+    air.attrs['_ARRAY_DIMENSIONS'] = ['lat', 'lon']
+    zarr.consolidate_metadata(zarr.storage.FSStore('memory://offline.zarr'))
+    second = test_app.get('/memory/offline.zarr/.multiscales/1/air/0.0')
+    assert second.headers['ETag'] != first.headers['ETag']
+    level = np.frombuffer(second.content, '<f4').reshape(7, 8)
+    np.testing.assert_allclose(level[0, 0], offline_dataset[:2, :2].mean() + 1000)
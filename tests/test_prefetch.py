@@ -0,0 +1,95 @@
+import asyncio
+import json
+import uuid
+from unittest.mock import patch
+
+import numpy as np
+import zarr
+
+from zarr_proxy.config import reload_settings
+from zarr_proxy.logic import get_chunk_grid
+from zarr_proxy.prefetch import Prefetcher
+from zarr_proxy.reader import SourceArray, chunk_cache, prefetch_buffer
+
+
+def make_source_array():
+    store = zarr.storage.FSStore(f'memory://test_prefetch/{uuid.uuid4().hex}')
+    arr = zarr.open_array(store, mode='w', shape=(4, 12), chunks=(4, 2), dtype='f4')
+    arr[:] = np.arange(48, dtype='f4').reshape(4, 12)
+    return arr, SourceArray(store=store, zarray=json.loads(store['.zarray']))
+
+
+async def observe(prefetcher, source_array, grid, chunk_keys):
+    for chunk_key in chunk_keys:
+        prefetcher.observe(source_array, grid, grid.parse_key(chunk_key))
+    await asyncio.gather(*prefetcher._pending.values())
+
+
+def test_prefetcher_reads_ahead_along_a_stride():
+    arr, source_array = make_source_array()
+    grid = get_chunk_grid(shape=(4, 12), chunks=(4, 2), source_chunks=(4, 2))
+    prefetcher = Prefetcher(depth=2, concurrency=4)
+
+    asyncio.run(observe(prefetcher, source_array, grid, ['0.0', '0.1']))
+    # a single step is not a pattern yet
+    assert len(prefetch_buffer) == 0
+
+    asyncio.run(observe(prefetcher, source_array, grid, ['0.2']))
+    assert len(prefetch_buffer) == 2
+    assert (
+        source_array.cache_key('0.3') in prefetch_buffer
+        and source_array.cache_key('0.4') in prefetch_buffer
+    )
+
+    # reading a prefetched chunk moves it to the chunk cache
+    data = asyncio.run(source_array.read(grid.chunk_slice((0, 3))))
+    np.testing.assert_array_equal(data, arr[:, 6:8])
+    assert source_array.cache_key('0.3') in chunk_cache
+    assert source_array.cache_key('0.3') not in prefetch_buffer
+
+
+def test_prefetcher_stops_at_the_edge_of_the_array():
+    _, source_array = make_source_array()
+    grid = get_chunk_grid(shape=(4, 12), chunks=(4, 2), source_chunks=(4, 2))
+    prefetcher = Prefetcher(depth=4, concurrency=4)
+
+    asyncio.run(observe(prefetcher, source_array, grid, ['0.1', '0.2', '0.3']))
+    assert len(prefetch_buffer) == 2
+    assert (
+        source_array.cache_key('0.4') in prefetch_buffer
+        and source_array.cache_key('0.5') in prefetch_buffer
+    )
+
+
+def test_prefetcher_respects_concurrency():
+    _, source_array = make_source_array()
+    grid = get_chunk_grid(shape=(4, 12), chunks=(4, 2), source_chunks=(4, 2))
+    prefetcher = Prefetcher(depth=3, concurrency=1)
+
+    asyncio.run(observe(prefetcher, source_array, grid, ['0.0', '0.1', '0.2']))
+    assert prefetcher.stats()['scheduled'] == 1
+    assert prefetcher.stats()['skipped'] == 2
+
+
+def test_prefetcher_disabled():
+    _, source_array = make_source_array()
+    grid = get_chunk_grid(shape=(4, 12), chunks=(4, 2), source_chunks=(4, 2))
+    prefetcher = Prefetcher(depth=0, concurrency=4)
+
+    asyncio.run(observe(prefetcher, source_array, grid, ['0.0', '0.1', '0.2']))
+    assert prefetcher.stats()['scheduled'] == 0
+
+
+def test_only_chunks_that_are_read_are_observed(test_app, offline_dataset, monkeypatch):
+    url = '/memory/offline.zarr/air/0.0'
+    with patch('zarr_proxy.store.prefetcher.observe') as observe:
+        response = test_app.get(url)
+        assert response.status_code == 200
+        # revalidations don't read the chunk
+        not_modified = test_app.get(url, headers={'If-None-Match': response.headers['ETag']})
+        assert not_modified.status_code == 304
+        # neither do chunks rejected for their size
+        monkeypatch.setenv('ZARR_PROXY_PAYLOAD_SIZE_LIMIT', '100b')
+        reload_settings()
+        assert test_app.get(url).status_code == 400
+    assert observe.call_count == 1
@@ -0,0 +1,274 @@
+import asyncio
+import json
+import uuid
+from unittest.mock import patch
+
+import numcodecs
+import numpy as np
+import pytest
+import zarr
+
+from zarr_proxy import metrics
+from zarr_proxy.config import get_settings, reload_settings
+from zarr_proxy.logic import chunk_id_to_slice
+from zarr_proxy.reader import SourceArray, as_buffer, block_mean, chunk_cache, fill_value_v3
+
+
+@pytest.fixture
+def source(request):
+    store = zarr.storage.FSStore(f'memory://test_reader/{uuid.uuid4().hex}')
+    arr = zarr.open_array(
+        store,
+        mode='w',
+        shape=(10, 7),
+        chunks=(4, 3),
+        dtype='f4',
+        fill_value=-1,
+        **request.param,
+    )
+    arr[:] = np.arange(70, dtype='f4').reshape(10, 7)
+    return store, arr
+
+
+@pytest.mark.parametrize(
+    'source',
+    [
+        {},
+        {'compressor': None},
+        {'compressor': numcodecs.Zlib(level=1), 'order': 'F'},
+        {'filters': [numcodecs.Delta(dtype='f4')], 'dimension_separator': '/'},
+    ],
+    indirect=True,
+)
+@pytest.mark.parametrize('chunk_key', ['0.0', '1.1', '1.2'])
+def test_source_array_read(source, chunk_key):
+    store, arr = source
+    data_slice = chunk_id_to_slice(chunk_key, chunks=(5, 3), shape=arr.shape)
+
+    source_array = SourceArray(store=store, zarray=json.loads(store['.zarray']))
+    data = asyncio.run(source_array.read(data_slice))
+
+    np.testing.assert_array_equal(data, arr[data_slice])
+
+
+@pytest.mark.parametrize('source', [{}], indirect=True)
+def test_source_array_read_missing_chunks(source):
+    store, arr = source
+    del store['0.0']
+
+    source_array = SourceArray(store=store, zarray=json.loads(store['.zarray']))
+    data = asyncio.run(source_array.read((slice(0, 5), slice(0, 4))))
+
+    assert (data[:4, :3] == -1).all()
+    np.testing.assert_array_equal(data[4:, :], arr[4:5, 0:4])
+
+
+@pytest.mark.parametrize('source', [{}], indirect=True)
+def test_source_array_read_uses_chunk_cache(source):
+    store, arr = source
+    source_array = SourceArray(store=store, zarray=json.loads(store['.zarray']))
+    expected = arr[1:3, 1:3]
+    asyncio.run(source_array.read((slice(0, 4), slice(0, 3))))
+    assert chunk_cache.stats()['misses'] == 1
+
+    # the source chunk is now served from the cache even though it is gone upstream
+    del store['0.0']
+    data = asyncio.run(source_array.read((slice(1, 3), slice(1, 3))))
+
+    np.testing.assert_array_equal(data, expected)
+    assert chunk_cache.stats()['hits'] == 1
+
+
+@pytest.mark.parametrize('source', [{}], indirect=True)
+@pytest.mark.parametrize(
+    'data_slice, chunks_read',
+    [
+        ((slice(0, 10), slice(0, 7)), 9),
+        ((slice(1, 3), slice(1, 3)), 1),
+        ((slice(0, 10, 4), slice(0, 7, 3)), 9),
+        ((slice(0, 10, 5), slice(0, 7, 6)), 4),
+        ((slice(0, 10, 2), slice(2, 4)), 6),
+        ((slice(3, 3), slice(0, 7)), 0),
+    ],
+)
+def test_source_array_source_nbytes(source, data_slice, chunks_read):
+    store, _ = source
+    source_array = SourceArray(store=store, zarray=json.loads(store['.zarray']))
+    assert source_array.source_nbytes(data_slice) == chunks_read * 4 * 3 * 4
+
+
+@pytest.mark.parametrize('source', [{}], indirect=True)
+def test_source_array_iter_slabs(source):
+    store, arr = source
+    source_array = SourceArray(store=store, zarray=json.loads(store['.zarray']))
+    data_slice = (slice(2, 10), slice(1, 6))
+
+    async def collect():
+        return [slab async for slab in source_array.iter_slabs(data_slice)]
+
+    slabs = asyncio.run(collect())
+
+    # one slab per source chunk row: rows 2-4 and 4-8 and 8-10
+    assert [slab.shape for slab in slabs] == [(2, 5), (4, 5), (2, 5)]
+    body = b''.join(as_buffer(slab) for slab in slabs)
+    assert body == arr[data_slice].tobytes()
+
+
+@pytest.mark.parametrize('source', [{}], indirect=True)
+def test_source_array_read_many_shares_source_chunks(source):
+    store, arr = source
+    source_array = SourceArray(store=store, zarray=json.loads(store['.zarray']))
+    data_slices = [
+        (slice(0, 2), slice(0, 3)),
+        (slice(2, 4), slice(0, 3)),
+        (slice(0, 4), slice(3, 5)),
+    ]
+    data = asyncio.run(source_array.read_many(data_slices))
+
+    for out, data_slice in zip(data, data_slices):
+        np.testing.assert_array_equal(out, arr[data_slice])
+    # the first two regions share the source chunk 0.0, which is read only once
+    assert chunk_cache.stats()['misses'] == 2
+
+
+@pytest.mark.parametrize('source', [{}], indirect=True)
+def test_source_array_read_strided(source):
+    store, arr = source
+    source_array = SourceArray(store=store, zarray=json.loads(store['.zarray']))
+    data = asyncio.run(source_array.read((slice(1, 10, 4), slice(0, 7, 5))))
+
+    np.testing.assert_array_equal(data, arr[1:10:4, 0:7:5])
+    # only the source chunks holding rows 1, 5 and 9 and columns 0 and 5 are read
+    assert chunk_cache.stats()['misses'] == 6
+
+
+def test_block_mean():
+    data = np.arange(20, dtype='f4').reshape(4, 5)
+    data[0, 0] = np.nan
+
+    reduced = block_mean(data, (2, 2))
+
+    assert reduced.dtype == np.float32
+    np.testing.assert_allclose(
+        reduced,
+        [[np.mean([1, 5, 6]), np.mean([2, 3, 7, 8]), np.mean([4, 9])], [13, 15, 16.5]],
+    )
+    assert block_mean(np.arange(6, dtype='i2'), (4,)).tolist() == [1.5, 4.5]
+
+
+@pytest.mark.parametrize('source', [{}], indirect=True)
+@pytest.mark.parametrize('band_nbytes', [1, 10**6])
+def test_source_array_read_block_mean(source, band_nbytes):
+    store, arr = source
+    source_array = SourceArray(store=store, zarray=json.loads(store['.zarray']))
+    data = asyncio.run(
+        source_array.read_block_mean((slice(1, 10), slice(0, 7)), (3, 2), band_nbytes=band_nbytes)
+    )
+
+    np.testing.assert_allclose(data, block_mean(arr[1:10, 0:7], (3, 2)))
+
+
+@pytest.mark.parametrize(
+    'source', [{'compressor': None}, {'compressor': None, 'order': 'F'}], indirect=True
+)
+@pytest.mark.parametrize(
+    'data_slice, max_ranges, expected_partial_reads',
+    [
+        # a thin slab of rows is one range in C order, and three in F order
+        ((slice(1, 2), slice(0, 7)), 16, 3),
+        # a column is one range per row in C order, too many to be worth it
+        ((slice(0, 10), slice(4, 5)), 1, {'C': 0, 'F': 3}),
+        ((slice(0, 10), slice(4, 5)), 16, 3),
+        # whole chunks
+        ((slice(0, 8), slice(0, 6)), 16, 0),
+    ],
+)
+def test_source_array_partial_reads(source, data_slice, max_ranges, expected_partial_reads):
+    store, arr = source
+    settings = get_settings().model_copy(
+        update={'zarr_proxy_partial_read_max_ranges': max_ranges, 'zarr_proxy_partial_read_gap': 0}
+    )
+    before = metrics.partial_reads.get()
+
+    source_array = SourceArray(store=store, zarray=json.loads(store['.zarray']))
+    with patch('zarr_proxy.reader.get_settings', return_value=settings):
+        data = asyncio.run(source_array.read(data_slice))
+
+    np.testing.assert_array_equal(data, arr[data_slice])
+    if isinstance(expected_partial_reads, dict):
+        expected_partial_reads = expected_partial_reads[arr.order]
+    assert metrics.partial_reads.get() - before == expected_partial_reads
+
+
+@pytest.mark.parametrize('source', [{'compressor': None}], indirect=True)
+def test_source_array_partial_reads_without_range_support(source):
+    store, arr = source
+
+    async def fetch_bytes(*, store, key, start=None, end=None):
+        # the whole chunk, whatever the range
+        return store[key]
+
+    source_array = SourceArray(store=store, zarray=json.loads(store['.zarray']))
+    with patch('zarr_proxy.reader.fetch_bytes', fetch_bytes):
+        data = asyncio.run(source_array.read((slice(1, 2), slice(0, 7))))
+
+    np.testing.assert_array_equal(data, arr[1:2, :])
+
+
+@pytest.mark.parametrize(
+    'value, dtype, expected',
+    [
+        ('NaN', 'f4', np.nan),
+        ('-Infinity', 'f8', -np.inf),
+        ('0x7fc00000', 'f4', np.nan),
+        (3, 'i2', 3),
+        (True, 'bool', True),
+        ([1.0, 'NaN'], 'c16', complex(1, np.nan)),
+    ],
+)
+def test_fill_value_v3(value, dtype, expected):
+    fill_value = fill_value_v3(value, dtype=np.dtype(dtype))
+    assert fill_value.dtype == np.dtype(dtype)
+    np.testing.assert_equal(fill_value, expected)
+
+
+def test_chunks_cached_for_an_older_version_of_the_array_are_not_reused(
+    test_app, offline_dataset, monkeypatch
+):
+    monkeypatch.setenv('ZARR_PROXY_METADATA_CACHE_TTL', '0')
+    reload_settings()
+    response = test_app.get('/memory/offline.zarr/air/0.0')
+    np.testing.assert_array_equal(
+        np.frombuffer(response.content, '<f4'), offline_dataset[:7, :8].ravel()
+    )
+
+    group = zarr.open_group(zarr.storage.FSStore('memory://offline.zarr'), mode='a')
+    group.create_dataset(
+        'air', data=offline_dataset + 1, chunks=(7, 8), fill_value=-1, overwrite=True
+    )
+    response = test_app.get('/memory/offline.zarr/air/0.0')
+    np.testing.assert_array_equal(
+        np.frombuffer(response.content, '<f4'), offline_dataset[:7, :8].ravel() + 1
+    )
+
+
+def test_cached_chunks_expire_after_the_chunk_cache_ttl(test_app, offline_dataset, monkeypatch):
+    assert chunk_cache.ttl == get_settings().zarr_proxy_chunk_cache_ttl
+    monkeypatch.setenv('ZARR_PROXY_METADATA_CACHE_TTL', '0')
+    reload_settings()
+    test_app.get('/memory/offline.zarr/air/0.0')
+
+    # the data is rewritten in place, so the metadata of the array stays byte-identical
+    zarr.open_array(zarr.storage.FSStore('memory://offline.zarr/air'), mode='r+')[:] = (
+        offline_dataset + 1
+    )
+    response = test_app.get('/memory/offline.zarr/air/0.0')
+    np.testing.assert_array_equal(
+        np.frombuffer(response.content, '<f4'), offline_dataset[:7, :8].ravel()
+    )
+
+    monkeypatch.setattr(chunk_cache, 'ttl', 0.0)
+    response = test_app.get('/memory/offline.zarr/air/0.0')
+    np.testing.assert_array_equal(
+        np.frombuffer(response.content, '<f4'), offline_dataset[:7, :8].ravel() + 1
+    )
@@ -1,6 +1,8 @@
+from unittest.mock import patch
+
 import pytest
 
-from zarr_proxy.config import Settings, get_settings
+from zarr_proxy.config import Settings, get_settings, reload_settings
 
 
 @pytest.mark.parametrize(
@@ -145,3 +147,73 @@ def test_store_array_payload_size_limit(test_app):
 
     assert response.status_code == 400
     assert "exceeds server's payload size limit of 5 B" in response.json()['message']
+
+
+def test_compressed_chunks_are_limited_before_being_read(test_app, offline_dataset, monkeypatch):
+    monkeypatch.setenv('ZARR_PROXY_DECODED_SIZE_LIMIT', '399b')
+    reload_settings()
+    headers = {'chunks': 'air=10,10', 'compressor': 'zstd'}
+    with patch('zarr_proxy.reader.SourceArray.read_many') as read_many:
+        response = test_app.get('/memory/offline.zarr/air/0.0', headers=headers)
+        batch = test_app.post('/memory/offline.zarr/air/.batch', json=['0.0'], headers=headers)
+    assert response.status_code == batch.status_code == 400
+    assert 'decoded size limit of 399 B' in response.json()['message']
+    read_many.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    'key, vary',
+    [
+        ('.zmetadata', 'chunks, compressor'),
+        ('air/.zarray', 'chunks, compressor'),
+        ('air/0.0', 'chunks, compressor, Accept'),
+    ],
+)
+def test_responses_vary_on_the_headers_they_depend_on(test_app, offline_dataset, key, vary):
+    response = test_app.get(f'/memory/offline.zarr/{key}', headers={'chunks': 'air=10,10'})
+    assert response.status_code == 200
+    assert response.headers['Vary'] == vary
+    not_modified = test_app.get(
+        f'/memory/offline.zarr/{key}',
+        headers={'chunks': 'air=10,10', 'If-None-Match': response.headers['ETag']},
+    )
+    assert not_modified.status_code == 304
+    assert not_modified.headers['Vary'] == vary
+
+
+def test_batches_are_limited_in_total_before_being_read(test_app, offline_dataset, monkeypatch):
+    monkeypatch.setenv('ZARR_PROXY_BATCH_PAYLOAD_SIZE_LIMIT', '1000b')
+    reload_settings()
+    url, headers = '/memory/offline.zarr/air/.batch', {'chunks': 'air=10,10'}
+    with patch('zarr_proxy.reader.SourceArray.read_many') as read_many:
+        response = test_app.post(url, json=['0.0', '0.1', '0.2'], headers=headers)
+    assert response.status_code == 400
+    assert 'batch payload size limit of 0.98 kiB' in response.json()['message']
+    read_many.assert_not_called()
+    assert test_app.post(url, json=['0.0', '0.1'], headers=headers).status_code == 200
+
+
+def test_batch_with_out_of_range_chunk_keys(test_app, offline_dataset):
+    response = test_app.post(
+        '/memory/offline.zarr/air/.batch', json=['0.0', '99999999999999999999999.0']
+    )
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize('key', ['.zmetadata', 'air/.zarray', 'air/0.0'])
+def test_compressor_levels_out_of_range_are_rejected(test_app, offline_dataset, key):
+    response = test_app.get(f'/memory/offline.zarr/{key}', headers={'compressor': 'zlib:99'})
+    assert response.status_code == 400
+
+
+def test_subsets_are_limited_by_the_source_chunks_they_read(test_app, offline_dataset, monkeypatch):
+    monkeypatch.setenv('ZARR_PROXY_SUBSET_SOURCE_SIZE_LIMIT', '2000b')
+    reload_settings()
+    url = '/memory/offline.zarr/air/.subset'
+    with patch('zarr_proxy.reader.SourceArray.read_block_mean') as read_block_mean:
+        response = test_app.get(url, params={'step': '10', 'method': 'mean'})
+    assert response.status_code == 400
+    assert 'subset source size limit' in response.json()['message']
+    read_block_mean.assert_not_called()
+    response = test_app.get(url, params={'region': '0:7,0:16', 'step': '7', 'method': 'mean'})
+    assert response.status_code == 200
@@ -0,0 +1,235 @@
+import asyncio
+import json
+from unittest.mock import patch
+
+import fsspec
+import numcodecs
+import numpy as np
+import pytest
+import zarr
+
+from zarr_proxy import helpers, reader
+from zarr_proxy.config import reload_settings
+from zarr_proxy.exceptions import ZarrProxyHTTPException
+from zarr_proxy.reader import SourceArray
+
+AIR = np.arange(20 * 30, dtype='<f8').reshape(20, 30)
+SHARDED = np.arange(20 * 30, dtype='<i4').reshape(20, 30)
+# the last chunk of the last shard is missing, and read as the fill value
+SHARDED[15:, 24:] = -1
+ZSTD = numcodecs.Zstd(level=1)
+
+
+def array_metadata(data, *, chunks, codecs, fill_value):
+    return {
+        'zarr_format': 3,
+        'node_type': 'array',
+        'shape': list(data.shape),
+        'data_type': data.dtype.name,
+        'chunk_grid': {'name': 'regular', 'configuration': {'chunk_shape': list(chunks)}},
+        'chunk_key_encoding': {'name': 'default', 'configuration': {'separator': '/'}},
+        'fill_value': fill_value,
+        'codecs': codecs,
+        'attributes': {},
+        'dimension_names': ['lat', 'lon'],
+    }
+
+
+def encode_chunk(data, index, chunks, fill_value):
+    chunk = np.full(chunks, fill_value, dtype=data.dtype)
+    block = data[tuple(slice(i * c, (i + 1) * c) for i, c in zip(index, chunks))]
+    chunk[tuple(slice(0, size) for size in block.shape)] = block
+    return ZSTD.encode(chunk.tobytes())
+
+
+def write_dataset(fs, root):
+    bytes_zstd = [
+        {'name': 'bytes', 'configuration': {'endian': 'little'}},
+        {'name': 'zstd', 'configuration': {'level': 1, 'checksum': False}},
+    ]
+    air = array_metadata(AIR, chunks=(7, 8), codecs=bytes_zstd, fill_value='NaN')
+    for i in range(3):
+        for j in range(4):
+            fs.pipe(f'{root}/air/c/{i}/{j}', encode_chunk(AIR, (i, j), (7, 8), np.nan))
+
+    sharding = {
+        'name': 'sharding_indexed',
+        'configuration': {
+            'chunk_shape': [5, 8],
+            'codecs': bytes_zstd,
+            'index_codecs': [
+                {'name': 'bytes', 'configuration': {'endian': 'little'}},
+                {'name': 'crc32c'},
+            ],
+            'index_location': 'end',
+        },
+    }
+    sharded = array_metadata(SHARDED, chunks=(10, 16), codecs=[sharding], fill_value=-1)
+    for i in range(2):
+        for j in range(2):
+            body, index = b'', np.full((2, 2, 2), 2**64 - 1, dtype='<u8')
+            for k in range(2):
+                for m in range(2):
+                    if (i, j, k, m) == (1, 1, 1, 1):
+                        continue
+                    chunk = encode_chunk(SHARDED, (2 * i + k, 2 * j + m), (5, 8), -1)
+                    index[k, m] = len(body), len(chunk)
+                    body += chunk
+            # the checksum of the index is not verified by the proxy
+            fs.pipe(f'{root}/sharded/c/{i}/{j}', body + index.tobytes() + b'\0' * 4)
+
+    for name, metadata in [('air', air), ('sharded', sharded)]:
+        fs.pipe(f'{root}/{name}/zarr.json', json.dumps(metadata).encode())
+    group = {
+        'zarr_format': 3,
+        'node_type': 'group',
+        'attributes': {'title': 'v3'},
+        'consolidated_metadata': {
+            'kind': 'inline',
+            'must_understand': False,
+            'metadata': {'air': air, 'sharded': sharded},
+        },
+    }
+    fs.pipe(f'{root}/zarr.json', json.dumps(group).encode())
+
+
+@pytest.fixture
+def v3_dataset(monkeypatch):
+    fs = fsspec.filesystem('memory')
+    write_dataset(fs, '/v3.zarr')
+    monkeypatch.setenv('ZARR_PROXY_UPSTREAM_HOSTS', json.dumps({'memory': {'url': 'memory://'}}))
+    reload_settings()
+    yield fs
+    monkeypatch.undo()
+    reload_settings()
+
+
+def test_group_zarr_json(test_app, v3_dataset):
+    response = test_app.get(
+        '/memory/v3.zarr/zarr.json', headers={'chunks': 'air=10,10', 'compressor': 'zstd'}
+    )
+    assert response.status_code == 200
+    metadata = response.json()
+    assert metadata['attributes'] == {'title': 'v3'}
+    arrays = metadata['consolidated_metadata']['metadata']
+    assert arrays['air']['chunk_grid']['configuration']['chunk_shape'] == [10, 10]
+    # sharded arrays are served by their inner chunks
+    assert arrays['sharded']['chunk_grid']['configuration']['chunk_shape'] == [5, 8]
+    assert arrays['sharded']['codecs'] == [
+        {'name': 'bytes', 'configuration': {'endian': 'little'}},
+        {'name': 'zstd', 'configuration': {'level': 1, 'checksum': False}},
+    ]
+
+
+def test_group_zarr_json_unknown_variable(test_app, v3_dataset):
+    response = test_app.get('/memory/v3.zarr/zarr.json', headers={'chunks': 'prec=10,10'})
+    assert response.status_code == 400
+
+
+def test_array_zarr_json(test_app, v3_dataset):
+    response = test_app.get('/memory/v3.zarr/air/zarr.json', headers={'chunks': 'air=10,10'})
+    assert response.status_code == 200
+    metadata = response.json()
+    assert metadata['chunk_grid']['configuration']['chunk_shape'] == [10, 10]
+    assert metadata['chunk_key_encoding'] == {
+        'name': 'default',
+        'configuration': {'separator': '/'},
+    }
+    assert metadata['codecs'] == [{'name': 'bytes', 'configuration': {'endian': 'little'}}]
+    assert metadata['dimension_names'] == ['lat', 'lon']
+
+
+@pytest.mark.parametrize(
+    'variable, chunk_key, expected',
+    [
+        ('air', '0/0', AIR[:10, :10]),
+        ('air', '1/2', AIR[10:, 20:]),
+        ('sharded', '0/0', SHARDED[:10, :10]),
+        ('sharded', '1/2', SHARDED[10:, 20:]),
+    ],
+)
+def test_chunk(test_app, v3_dataset, variable, chunk_key, expected):
+    response = test_app.get(
+        f'/memory/v3.zarr/{variable}/c/{chunk_key}', headers={'chunks': f'{variable}=10,10'}
+    )
+    assert response.status_code == 200
+    chunk = np.frombuffer(response.content, expected.dtype).reshape(10, 10)
+    np.testing.assert_array_equal(chunk, expected)
+
+
+def test_edge_chunks_are_padded(test_app, v3_dataset):
+    response = test_app.get('/memory/v3.zarr/air/c/1/1', headers={'chunks': 'air=15,20'})
+    assert response.status_code == 200
+    chunk = np.frombuffer(response.content, '<f8').reshape(15, 20)
+    np.testing.assert_array_equal(chunk[:5, :10], AIR[15:, 20:])
+    assert np.isnan(chunk[5:]).all() and np.isnan(chunk[:, 10:]).all()
+
+
+def test_v2_array_named_c(test_app, v3_dataset):
+    group = zarr.open_group(zarr.storage.FSStore('memory://v2.zarr'), mode='w')
+    group.create_dataset('c', data=AIR, chunks=(10, 10))
+    response = test_app.get('/memory/v2.zarr/c/1.2')
+    assert response.status_code == 200
+    np.testing.assert_array_equal(
+        np.frombuffer(response.content, '<f8').reshape(10, 10), AIR[10:, 20:]
+    )
+
+
+def test_v2_array_named_c_is_looked_up_as_v3_once(test_app, v3_dataset):
+    group = zarr.open_group(zarr.storage.FSStore('memory://v2.zarr'), mode='w')
+    group.create_dataset('c', data=AIR, chunks=(10, 10))
+    keys = []
+    fetch_bytes = helpers.fetch_bytes
+
+    async def recording_fetch_bytes(*, store, key, start=None, end=None):
+        keys.append(key)
+        return await fetch_bytes(store=store, key=key, start=start, end=end)
+
+    with patch('zarr_proxy.helpers.fetch_bytes', recording_fetch_bytes):
+        for chunk_key in ['0.0', '1.2', '0.0']:
+            assert test_app.get(f'/memory/v2.zarr/c/{chunk_key}').status_code == 200
+    assert keys.count('zarr.json') == 1
+
+
+def test_v2_array_named_c_behind_access_denied_zarr_json(test_app, v3_dataset):
+    group = zarr.open_group(zarr.storage.FSStore('memory://v2.zarr'), mode='w')
+    group.create_dataset('c', data=AIR, chunks=(10, 10))
+    load_metadata_file_async = helpers.load_metadata_file_async
+
+    async def forbidden_zarr_json(*, store, key, **kwargs):
+        # S3 answers 403 for missing keys of buckets that can't be listed
+        if key == 'zarr.json':
+            raise ZarrProxyHTTPException(status_code=403, message='Access denied')
+        return await load_metadata_file_async(store=store, key=key, **kwargs)
+
+    with patch('zarr_proxy.store.load_metadata_file_async', forbidden_zarr_json):
+        response = test_app.get('/memory/v2.zarr/c/1.2')
+    assert response.status_code == 200
+    np.testing.assert_array_equal(
+        np.frombuffer(response.content, '<f8').reshape(10, 10), AIR[10:, 20:]
+    )
+
+
+def test_sharded_source_reads_only_the_chunks_needed(v3_dataset):
+    store = zarr.storage.FSStore('memory://v3.zarr/sharded')
+    arr = SourceArray(store=store, zarray=json.loads(store['zarr.json']))
+    assert (arr.chunks, arr.shards, arr.byte_addressable) == ((5, 8), (10, 16), False)
+
+    ranges = []
+    fetch_bytes = reader.fetch_bytes
+
+    async def recording_fetch_bytes(*, store, key, start=None, end=None):
+        ranges.append((key, start, end))
+        return await fetch_bytes(store=store, key=key, start=start, end=end)
+
+    with patch('zarr_proxy.reader.fetch_bytes', recording_fetch_bytes):
+        data = asyncio.run(arr.read((slice(0, 10), slice(0, 8))))
+        missing = asyncio.run(arr.read((slice(15, 20), slice(24, 30))))
+
+    np.testing.assert_array_equal(data, SHARDED[:10, :8])
+    np.testing.assert_array_equal(missing, -1)
+    # the index of the shards, read with a suffix range, then only the two chunks needed
+    index_reads = {(key, start, end) for key, start, end in ranges if start < 0}
+    chunk_reads = {(key, start, end) for key, start, end in ranges if start >= 0}
+    assert index_reads == {('c/0/0', -(2 * 2 * 16 + 4), None), ('c/1/1', -(2 * 2 * 16 + 4), None)}
+    assert len(chunk_reads) == 2 and {key for key, _, _ in chunk_reads} == {'c/0/0'}
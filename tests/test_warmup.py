@@ -0,0 +1,70 @@
+import asyncio
+import logging
+import subprocess
+import sys
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from zarr_proxy.exceptions import ZarrProxyHTTPException
+from zarr_proxy.helpers import store_cache
+from zarr_proxy.warmup import warm_up
+
+ZMETADATA = {
+    'zarr_consolidated_format': 1,
+    'metadata': {
+        '.zgroup': {'zarr_format': 2},
+        'air/.zarray': {
+            'zarr_format': 2,
+            'shape': [10, 10],
+            'chunks': [5, 5],
+            'dtype': '<f4',
+            'fill_value': None,
+            'order': 'C',
+            'compressor': {'id': 'zlib', 'level': 1},
+            'filters': None,
+        },
+    },
+}
+
+
+def test_lazy_imports():
+    code = (
+        'import sys, zarr_proxy.main; '
+        "print(sorted(m for m in ('zarr', 'numcodecs', 'fsspec', 'aiohttp') if m in sys.modules))"
+    )
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+    assert output.stdout.splitlines()[-1] == '[]'
+
+
+def test_warm_up_imports_modules_on_request():
+    code = (
+        'import asyncio, sys; from zarr_proxy.warmup import warm_up; '
+        'asyncio.run(warm_up()); print("zarr" in sys.modules); '
+        'asyncio.run(warm_up(import_modules=True)); print("zarr" in sys.modules)'
+    )
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+    assert output.stdout.splitlines()[-2:] == ['False', 'True']
+
+
+def test_warm_up():
+    load = AsyncMock(return_value=ZMETADATA)
+    with patch('zarr_proxy.warmup.load_metadata_file_async', load):
+        asyncio.run(warm_up(['example.com/data.zarr']))
+        asyncio.run(warm_up(['example.com/data.zarr']))
+
+    assert load.call_count == 1
+    assert ('example.com', 'data.zarr') in store_cache
+    assert ('example.com', 'data.zarr/air') in store_cache
+    assert 'zarr' in sys.modules
+
+
+def test_warm_up_errors_are_logged():
+    logger = MagicMock(spec=logging.Logger)
+    load = AsyncMock(side_effect=ZarrProxyHTTPException(status_code=404, message='not found'))
+    with patch('zarr_proxy.warmup.load_metadata_file_async', load):
+        asyncio.run(warm_up(['example.com/missing.zarr'], logger=logger))
+        asyncio.run(warm_up(['example.com/missing.zarr'], logger=logger))
+
+    assert load.call_count == 2
+    logger.warning.assert_called_with(
+        'Failed to warm up %s: %s', 'example.com/missing.zarr', 'not found'
+    )
@@ -0,0 +1,332 @@
+"""In-memory caches shared by the zarr proxy"""
+
+import asyncio
+import collections
+import contextlib
+import functools
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import typing
+
+
+class LRUCache:
+    """A thread-safe least-recently-used cache with an optional time-to-live and byte budget.
+
+    Parameters
+    ----------
+    maxsize: int, optional
+        The maximum number of entries to keep. ``None`` means unbounded.
+    ttl: float, optional
+        The number of seconds an entry stays valid after it was inserted.
+        ``None`` means entries never expire.
+    maxbytes: int, optional
+        The maximum total size of the entries, as measured by ``sizeof``. ``None`` means unbounded.
+    sizeof: callable, optional
+        Returns the size in bytes of a value. Defaults to ``len``.
+    """
+
+    def __init__(
+        self,
+        *,
+        maxsize: typing.Optional[int] = None,
+        ttl: typing.Optional[float] = None,
+        maxbytes: typing.Optional[int] = None,
+        sizeof: typing.Callable[[typing.Any], int] = len,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self._data: collections.OrderedDict = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: typing.Hashable) -> bool:
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def _expired(self, inserted_at: float) -> bool:
+        return self.ttl is not None and (time.monotonic() - inserted_at) > self.ttl
+
+    def _lookup(self, key: typing.Hashable) -> typing.Optional[tuple[typing.Any, float, int]]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if self._expired(item[1]):
+            self._remove(key)
+            self.evictions += 1
+            return None
+        self._data.move_to_end(key)
+        return item
+
+    def _remove(self, key: typing.Hashable) -> tuple[typing.Any, float, int]:
+        item = self._data.pop(key)
+        self.nbytes -= item[2]
+        return item
+
+    def _insert(self, key: typing.Hashable, value: typing.Any) -> None:
+        if key in self._data:
+            self._remove(key)
+        size = self.sizeof(value) if self.maxbytes is not None else 0
+        if self.maxbytes is not None and size > self.maxbytes:
+            # never let a single value flush the whole cache
+            return
+        self._data[key] = (value, time.monotonic(), size)
+        self.nbytes += size
+        self._evict()
+
+    def _evict(self) -> None:
+        while (self.maxsize is not None and len(self._data) > self.maxsize) or (
+            self.maxbytes is not None and self.nbytes > self.maxbytes
+        ):
+            self._remove(next(iter(self._data)))
+            self.evictions += 1
+
+    def get(self, key: typing.Hashable, default: typing.Any = None) -> typing.Any:
+        """Return the value for ``key`` if it is cached and not expired, else ``default``."""
+        with self._lock:
+            item = self._lookup(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return item[0]
+
+    def peek(self, key: typing.Hashable, default: typing.Any = None) -> typing.Any:
+        """Like ``get``, but without updating the recency of the entry or the counters."""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or self._expired(item[1]):
+                return default
+            return item[0]
+
+    def set(self, key: typing.Hashable, value: typing.Any) -> None:
+        """Insert ``value`` under ``key``, evicting the least recently used entries if needed."""
+        with self._lock:
+            self._insert(key, value)
+
+    def get_or_create(
+        self, key: typing.Hashable, factory: typing.Callable[[], typing.Any]
+    ) -> typing.Any:
+        """Return the cached value for ``key``, creating it with ``factory`` on a miss."""
+        with self._lock:
+            item = self._lookup(key)
+            if item is not None:
+                self.hits += 1
+                return item[0]
+            self.misses += 1
+            value = factory()
+            self._insert(key, value)
+            return value
+
+    def pop(self, key: typing.Hashable, default: typing.Any = None) -> typing.Any:
+        """Remove ``key`` from the cache and return its value."""
+        with self._lock:
+            if key not in self._data:
+                return default
+            return self._remove(key)[0]
+
+    def clear(self) -> None:
+        """Remove all entries and reset the counters."""
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> dict[str, typing.Union[int, float, None]]:
+        """Return the cache counters, e.g. for the health endpoint."""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'nbytes': self.nbytes,
+            'maxbytes': self.maxbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+
+class DiskCache:
+    """A size-capped least-recently-used cache of bytes stored in a local directory.
+
+    Values are written to a temporary file and atomically renamed into place, so several worker
+    processes can safely share one directory. Recency is tracked with file modification times,
+    which are bumped on every hit.
+
+    Parameters
+    ----------
+    directory: str
+        The directory holding the cached values. It is created if needed.
+    maxbytes: int
+        The maximum total size of the cached values. When it is exceeded, the least recently used
+        values are removed until the cache is back under 90% of this size.
+    """
+
+    def __init__(self, *, directory: str, maxbytes: int):
+        self.directory = directory
+        self.maxbytes = maxbytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.nbytes = sum(size for _, _, size in self._scan())
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _path(self, key: str) -> str:
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _scan(self) -> typing.Iterator[tuple[str, float, int]]:
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.startswith('.tmp-'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # removed by another worker
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+    def get(self, key: str) -> typing.Optional[bytes]:
+        """Return the bytes cached under ``key``, or ``None``."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def set(self, key: str, value: bytes) -> None:
+        """Store ``value`` under ``key``, evicting the least recently used values if needed."""
+        if len(value) > self.maxbytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            with self._lock:
+                # concurrent misses on the same key overwrite each other's file
+                try:
+                    replaced = os.stat(path).st_size
+                except FileNotFoundError:
+                    replaced = 0
+                os.replace(tmp_path, path)
+                self.nbytes += len(value) - replaced
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        with self._lock:
+            if self.nbytes > self.maxbytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        # other workers share the directory, so the real size is only known after a scan
+        entries = sorted(self._scan(), key=lambda entry: entry[1])
+        self.nbytes = sum(size for _, _, size in entries)
+        target = 0.9 * self.maxbytes
+        for path, _, size in entries:
+            if self.nbytes <= target:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            self.nbytes -= size
+            self.evictions += 1
+
+    def clear(self) -> None:
+        """Remove all cached values and reset the counters."""
+        with self._lock:
+            for path, _, _ in self._scan():
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(path)
+            self.nbytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> dict[str, typing.Union[int, float, str]]:
+        """Return the cache counters, e.g. for the health endpoint."""
+        lookups = self.hits + self.misses
+        return {
+            'directory': self.directory,
+            'nbytes': self.nbytes,
+            'maxbytes': self.maxbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+
+class SingleFlight:
+    """Deduplicate concurrent calls of the same asynchronous operation.
+
+    While a call for a key is in flight, later calls with the same key await its result instead
+    of starting their own, so a burst of identical requests results in a single upstream request.
+    Results are not kept once the call completes; caching is left to the caller.
+
+    Parameters
+    ----------
+    on_coalesce: callable, optional
+        Called whenever a call is answered by the one already in flight, e.g. to count them.
+    """
+
+    def __init__(self, *, on_coalesce: typing.Optional[typing.Callable[[], None]] = None):
+        self._inflight: dict[typing.Hashable, asyncio.Future] = {}
+        self._on_coalesce = on_coalesce
+        self.calls = 0
+        self.coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    async def do(
+        self, key: typing.Hashable, factory: typing.Callable[[], typing.Awaitable[typing.Any]]
+    ) -> typing.Any:
+        """Return the result of ``factory()``, sharing it with concurrent calls for ``key``.
+
+        The shared call is shielded from cancellation, so a caller going away (e.g. a client
+        disconnecting) does not abort it for the callers still waiting on it.
+        """
+        future = self._inflight.get(key)
+        if future is None or future.get_loop() is not asyncio.get_running_loop():
+            self.calls += 1
+            future = asyncio.ensure_future(factory())
+            self._inflight[key] = future
+            future.add_done_callback(functools.partial(self._done, key))
+        else:
+            self.coalesced += 1
+            if self._on_coalesce is not None:
+                self._on_coalesce()
+        return await asyncio.shield(future)
+
+    def _done(self, key: typing.Hashable, future: asyncio.Future) -> None:
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        if not future.cancelled():
+            # mark the exception as retrieved, all callers may have gone away
+            future.exception()
+
+    def stats(self) -> dict[str, int]:
+        """Return the counters, e.g. for the health endpoint."""
+        return {'inflight': len(self._inflight), 'calls': self.calls, 'coalesced': self.coalesced}
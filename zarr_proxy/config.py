@@ -1,3 +1,7 @@
+import fnmatch
+import functools
+import os
+import re
 import typing
 
 import pydantic
@@ -7,6 +11,10 @@ from .log import get_logger
 
 logger = get_logger()
 
+# A bare host name, optionally with a port. Anything else, e.g. "?", "#", "@" or "/", would change
+# the URL built from the host and let a request escape the allowed hosts.
+_HOST = re.compile(r'[A-Za-z0-9.-]+(:[0-9]+)?')
+
 byte_sizes = {
     'kb': 1_000,
     'mb': 1_000**2,
@@ -40,11 +48,180 @@ def format_bytes(num: int) -> str:
     )
 
 
+class UpstreamHost(pydantic.BaseModel):
+    """Connection settings of an upstream host, see ``Settings.zarr_proxy_upstream_hosts``.
+
+    ``url`` is where the datasets of the host live: ``https://{host}`` by default, or the URL of
+    another fsspec filesystem, e.g. ``s3://my-bucket``, ``gs://my-bucket``, ``file:///data`` or
+    ``memory://``, which is then created with ``storage_options``. The connection settings only
+    apply to HTTP(S) hosts. Those left unset take the value of the ``zarr_proxy_*`` setting of the
+    same name.
+    """
+
+    model_config = pydantic.ConfigDict(frozen=True, extra='forbid')
+
+    url: typing.Optional[str] = None
+    storage_options: dict[str, typing.Any] = {}
+
+    connection_limit: typing.Optional[int] = None
+    keepalive_timeout: typing.Optional[float] = None
+    dns_cache_ttl: typing.Optional[int] = None
+    connect_timeout: typing.Optional[float] = None
+    read_timeout: typing.Optional[float] = None
+    request_timeout: typing.Optional[float] = None
+    retries: typing.Optional[int] = None
+    retry_backoff: typing.Optional[float] = None
+
+
 class Settings(pydantic_settings.BaseSettings):
+    """Settings of the proxy, read from ``ZARR_PROXY_*`` environment variables.
+
+    Settings are immutable: they are loaded once by ``get_settings`` and replaced as a whole by
+    ``reload_settings``.
+    """
+
+    model_config = pydantic_settings.SettingsConfigDict(frozen=True)
+
     zarr_proxy_payload_size_limit: int = '2 mb'
+    # chunks compressed at the request of the client are limited to the payload size limit once
+    # compressed, and to this size before, which bounds the memory a single chunk can take
+    zarr_proxy_decoded_size_limit: int = '32 mb'
+    # maximum decoded size of the source chunks a single subset request may read
+    zarr_proxy_subset_source_size_limit: int = '256 mb'
+    # number of stores/filesystems kept open and how long (in seconds) they are reused
+    zarr_proxy_store_cache_size: int = 256
+    zarr_proxy_store_cache_ttl: float = 600.0
+    # maximum number of simultaneous connections to a single upstream host, and how long (in
+    # seconds) idle connections and DNS lookups are kept
+    zarr_proxy_connection_limit: int = 100
+    zarr_proxy_keepalive_timeout: float = 30.0
+    zarr_proxy_dns_cache_ttl: int = 300
+    # timeouts (in seconds) for connecting to the upstream, for reading from it, and for a whole
+    # upstream request (None means no limit)
+    zarr_proxy_connect_timeout: float = 10.0
+    zarr_proxy_read_timeout: float = 60.0
+    zarr_proxy_request_timeout: typing.Optional[float] = None
+    # number of times an upstream request failing with a connection error, a timeout or a 429/5xx
+    # status is retried, and the base delay (in seconds) of the exponential backoff between tries
+    zarr_proxy_retries: int = 2
+    zarr_proxy_retry_backoff: float = 0.1
+    # upstream hosts the proxy may read from, e.g. {"storage.googleapis.com": {},
+    # "*.s3.amazonaws.com": {"connection_limit": 200}}, with optional connection settings per host
+    # (see ``UpstreamHost``). Keys can be glob patterns. None allows any host.
+    zarr_proxy_upstream_hosts: typing.Optional[dict[str, UpstreamHost]] = None
+    # number of parsed metadata documents to keep and how long (in seconds) before revalidating them
+    zarr_proxy_metadata_cache_size: int = 1024
+    zarr_proxy_metadata_cache_ttl: float = 60.0
+    # number of source chunks fetched concurrently per request
+    zarr_proxy_fetch_concurrency: int = 16
+    # number of threads decoding, slicing and encoding chunks
+    zarr_proxy_codec_workers: int = min(32, (os.cpu_count() or 1) + 4)
+    # memory budget for decoded source chunks shared between requests, and how long (in seconds) they
+    # are reused before being read again, so that data rewritten in place is eventually served
+    zarr_proxy_chunk_cache_size: int = '256 mb'
+    zarr_proxy_chunk_cache_ttl: float = 600.0
+    # optional on-disk tier for raw upstream chunks, e.g. /tmp/zarr-proxy on AWS Lambda
+    zarr_proxy_disk_cache_dir: typing.Optional[str] = None
+    zarr_proxy_disk_cache_size: int = '1 gb'
+    # chunks larger than this are streamed slab by slab instead of being built in memory
+    zarr_proxy_streaming_threshold: int = '1 mb'
+    # uncompressed source chunks are read in part, with byte-range requests, when the bytes needed
+    # are less than this fraction of the chunk (0 disables partial reads) and fit in at most
+    # ``max_ranges`` ranges. Ranges less than ``gap`` bytes apart are merged into one.
+    zarr_proxy_partial_read_ratio: float = 0.5
+    zarr_proxy_partial_read_max_ranges: int = 32
+    zarr_proxy_partial_read_gap: int = '16 kb'
+    # Cache-Control header sent with every metadata and chunk response
+    zarr_proxy_cache_control: str = 'public, max-age=3600'
+    # maximum number of chunk keys in a single batch request, and the maximum decoded size of all
+    # of its chunks together, which bounds the memory a single batch can take
+    zarr_proxy_batch_size_limit: int = 256
+    zarr_proxy_batch_payload_size_limit: int = '32 mb'
+    # number of chunks read ahead along a detected access pattern (0 disables prefetching), the
+    # maximum number of source chunks being prefetched at once, and the memory budget for them
+    zarr_proxy_prefetch_depth: int = 0
+    zarr_proxy_prefetch_concurrency: int = 4
+    zarr_proxy_prefetch_buffer_size: int = '64 mb'
+    # number of levels of the virtual multiscale pyramids, and memory budget of their chunks
+    zarr_proxy_multiscales_levels: int = 4
+    zarr_proxy_multiscales_cache_size: int = '128 mb'
+    # datasets ("{host}/{path}") opened when the application starts, so that their first requests
+    # find the metadata cached and a connection to their host open
+    zarr_proxy_warmup_datasets: list[str] = []
+    # import the modules the proxy loads on first use when it starts, rather than on first request
+    zarr_proxy_warmup_imports: bool = False
+    # minimum level of the log records to write, and their format: text or json
+    zarr_proxy_log_level: str = 'INFO'
+    zarr_proxy_log_format: typing.Literal['text', 'json'] = 'text'
+    # write one access log line per request
+    zarr_proxy_access_log: bool = True
+    # fraction of the frequent, per-chunk debug events that are logged
+    zarr_proxy_log_sample_rate: float = 0.01
+
+    # resolved connection settings per host, see ``get_upstream_host``
+    _upstream_hosts: typing.Callable[[str], typing.Optional[UpstreamHost]] = pydantic.PrivateAttr()
 
-    @pydantic.field_validator('zarr_proxy_payload_size_limit', mode='before')
-    def _validate_zarr_proxy_payload_size_limit(cls, value: typing.Union[int, str]) -> int:
+    def model_post_init(self, context: typing.Any) -> None:
+        # settings are immutable, so the connection settings of a host never change
+        self._upstream_hosts = functools.lru_cache(maxsize=1024)(self._resolve_upstream_host)
+
+    def model_copy(self, *, update: typing.Optional[dict] = None, deep: bool = False) -> 'Settings':
+        copy = super().model_copy(update=update, deep=deep)
+        # the copy must not share the connection settings resolved with the values it overrides
+        copy.model_post_init(None)
+        return copy
+
+    def get_upstream_host(self, host: str) -> typing.Optional[UpstreamHost]:
+        """Return the connection settings of ``host``, or None if it is not an allowed host.
+
+        Hosts that are not a bare host name, optionally followed by a port, are never allowed. The
+        result is memoized per host, and shared by all the requests for that host.
+        """
+        return self._upstream_hosts(host)
+
+    def _resolve_upstream_host(self, host: str) -> typing.Optional[UpstreamHost]:
+        if not _HOST.fullmatch(host):
+            return None
+        if self.zarr_proxy_upstream_hosts is None:
+            configured = UpstreamHost()
+        elif host in self.zarr_proxy_upstream_hosts:
+            configured = self.zarr_proxy_upstream_hosts[host]
+        else:
+            configured = next(
+                (
+                    value
+                    for pattern, value in self.zarr_proxy_upstream_hosts.items()
+                    if fnmatch.fnmatchcase(host, pattern)
+                ),
+                None,
+            )
+            if configured is None:
+                return None
+        defaults = {
+            name: getattr(self, f'zarr_proxy_{name}')
+            for name in UpstreamHost.model_fields
+            if hasattr(self, f'zarr_proxy_{name}')
+        }
+        return UpstreamHost(
+            **{'url': f'https://{host}', **defaults, **configured.model_dump(exclude_unset=True)}
+        )
+
+    @pydantic.field_validator(
+        'zarr_proxy_payload_size_limit',
+        'zarr_proxy_decoded_size_limit',
+        'zarr_proxy_subset_source_size_limit',
+        'zarr_proxy_batch_payload_size_limit',
+        'zarr_proxy_chunk_cache_size',
+        'zarr_proxy_disk_cache_size',
+        'zarr_proxy_streaming_threshold',
+        'zarr_proxy_prefetch_buffer_size',
+        'zarr_proxy_multiscales_cache_size',
+        'zarr_proxy_partial_read_gap',
+        mode='before',
+    )
+    def _validate_byte_size(
+        cls, value: typing.Union[int, str], info: pydantic.ValidationInfo
+    ) -> int:
         if isinstance(value, int):
             return value
         if isinstance(value, str):
@@ -54,10 +231,22 @@ class Settings(pydantic_settings.BaseSettings):
                 if value.endswith(key):
                     return int(value[: -len(key)]) * byte_sizes[key]
             raise ValueError(
-                f"Invalid zarr_proxy_payload_size_limit: {value}. Must be an integer or a string with a unit (e.g. '1GB') and valid units are: {', '.join(byte_sizes.keys())}"
+                f"Invalid {info.field_name}: {value}. Must be an integer or a string with a unit (e.g. '1GB') and valid units are: {', '.join(byte_sizes.keys())}"
             )
 
 
+@functools.cache
 def get_settings() -> Settings:
+    """Return the settings, loading them from the environment on the first call only."""
     logger.info('Loading settings from environment variables')
     return Settings()
+
+
+def reload_settings() -> Settings:
+    """Load the settings from the environment again and return them.
+
+    Values read on every request (e.g. the payload size limit) take effect immediately. Caches,
+    pools and other objects created at import time keep the settings they were created with.
+    """
+    get_settings.cache_clear()
+    return get_settings()
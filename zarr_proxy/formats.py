@@ -0,0 +1,107 @@
+"""Self-describing output formats for chunks, negotiated with the Accept header"""
+
+import importlib.util
+import io
+import typing
+
+import numpy as np
+
+RAW = 'raw'
+NPY = 'npy'
+ARROW = 'arrow'
+
+# media types of the chunk formats. The first media type of each format is used in responses.
+MEDIA_TYPES = {
+    RAW: ('application/octet-stream',),
+    NPY: ('application/x-npy', 'application/npy'),
+    ARROW: ('application/vnd.apache.arrow.stream', 'application/x-arrow'),
+}
+_FORMATS_BY_MEDIA_TYPE = {
+    media_type: name for name, media_types in MEDIA_TYPES.items() for media_type in media_types
+}
+
+
+def negotiate_chunk_format(accept: typing.Optional[str]) -> str:
+    """Return the chunk format preferred by a client, given its Accept header.
+
+    Media types are ranked by their quality value, ties being broken by their order in the
+    header. Raw bytes are returned when no supported media type is acceptable, e.g. for "*/*".
+
+    Parameters
+    ----------
+    accept: str, optional
+        e.g. "application/vnd.apache.arrow.stream, application/x-npy;q=0.5"
+
+    Returns
+    -------
+    str
+        "raw", "npy" or "arrow"
+    """
+    if not accept:
+        return RAW
+    candidates = []
+    for position, item in enumerate(accept.split(',')):
+        media_type, *params = (part.strip() for part in item.split(';'))
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        name = _FORMATS_BY_MEDIA_TYPE.get(media_type.lower())
+        if name is not None and quality > 0:
+            candidates.append((-quality, position, name))
+    return min(candidates)[2] if candidates else RAW
+
+
+def check_chunk_format(name: str, *, dtype: np.dtype) -> None:
+    """Raise a ValueError if chunks of ``dtype`` cannot be sent in the format ``name``."""
+    if name == RAW:
+        return
+    if dtype.hasobject:
+        raise ValueError(f'Arrays of dtype {dtype} can only be sent as raw bytes')
+    if name == ARROW and importlib.util.find_spec('pyarrow') is None:
+        raise ValueError('Arrow output requires pyarrow, which is not installed on the server')
+
+
+def npy_header(*, shape: tuple[int, ...], dtype: np.dtype) -> bytes:
+    """Return the header of an NPY file holding a C-ordered array, to be followed by its bytes."""
+    header = {
+        'descr': np.lib.format.dtype_to_descr(dtype),
+        'fortran_order': False,
+        'shape': tuple(shape),
+    }
+    buffer = io.BytesIO()
+    np.lib.format.write_array_header_1_0(buffer, header)
+    return buffer.getvalue()
+
+
+def arrow_ipc(data: np.ndarray, *, name: str) -> memoryview:
+    """Return an array as an Arrow IPC stream with a single record batch.
+
+    The array is flattened in C order into one column named ``name``, whose shape is stored in the
+    schema metadata. The column wraps the array buffer without copying it, so the only copy is the
+    one made by the IPC writer.
+
+    Raises
+    ------
+    ImportError
+        If pyarrow is not installed.
+    """
+    import pyarrow as pa
+
+    if not data.dtype.isnative:
+        # Arrow only supports native byte order
+        data = data.astype(data.dtype.newbyteorder('='))
+    column = pa.array(data.reshape(-1))
+    schema = pa.schema(
+        [pa.field(name, column.type)],
+        metadata={'shape': ','.join(map(str, data.shape)), 'dtype': data.dtype.str},
+    )
+    batch = pa.record_batch([column], schema=schema)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        writer.write_batch(batch)
+    return memoryview(sink.getvalue())
@@ -1,11 +1,52 @@
+import asyncio
+import contextlib
+import copy
+import functools
+import hashlib
 import json
 import logging
+import random
+import time
 import traceback
+import typing
 
-import aiohttp.client_exceptions
-import zarr
-
+from .cache import DiskCache, LRUCache, SingleFlight
+from .config import UpstreamHost, get_settings
 from .exceptions import ZarrProxyHTTPException
+from .metrics import upstream_bytes, upstream_requests_coalesced
+
+if typing.TYPE_CHECKING:
+    # aiohttp, fsspec and zarr take a large share of the import time of the package, e.g. during
+    # the cold start of a serverless function. They are imported on first use instead.
+    import aiohttp
+    import fsspec
+    import fsspec.implementations.http
+    import zarr.storage
+
+settings = get_settings()
+
+# Process-wide registries of open stores (keyed by host and path) and filesystems (keyed by host).
+# Each filesystem owns its own aiohttp session, i.e. one connection pool per upstream host.
+store_cache = LRUCache(
+    maxsize=settings.zarr_proxy_store_cache_size, ttl=settings.zarr_proxy_store_cache_ttl
+)
+filesystem_cache = LRUCache(
+    maxsize=settings.zarr_proxy_store_cache_size, ttl=settings.zarr_proxy_store_cache_ttl
+)
+# Parsed metadata documents keyed by (store path, key), shared by all endpoints. Staleness is handled
+# by ``load_metadata_file`` so that expired entries can be revalidated instead of refetched.
+metadata_cache = LRUCache(maxsize=settings.zarr_proxy_metadata_cache_size)
+# Raw upstream chunk bytes, kept across restarts and shared between worker processes.
+disk_cache = (
+    DiskCache(
+        directory=settings.zarr_proxy_disk_cache_dir, maxbytes=settings.zarr_proxy_disk_cache_size
+    )
+    if settings.zarr_proxy_disk_cache_dir
+    else None
+)
+# Upstream requests currently in flight. Identical concurrent requests (e.g. many clients opening
+# the same dataset at once) share a single upstream request.
+inflight_requests = SingleFlight(on_coalesce=upstream_requests_coalesced.inc)
 
 
 def format_exception(exc: str) -> str:
@@ -20,30 +61,195 @@ def format_exception(exc: str) -> str:
     return exc.splitlines()[-1]
 
 
-def load_metadata_file(*, store: zarr.storage.FSStore, key: str, logger: logging.Logger) -> dict:
-    """Load the metadata file from the store.
+def make_etag(*parts: typing.Any) -> str:
+    """Return a strong ETag derived from the given parts."""
+    digest = hashlib.sha256('\0'.join(map(str, parts)).encode()).hexdigest()
+    return f'"{digest[:32]}"'
 
-    This function loads the metadata file from a given store and returns it as a dictionary.
 
-    Parameters
-    ----------
-    store : zarr.storage.FSStore
-        The store to load the metadata file from.
-    key : str
-        The key of the metadata file in the store.
-    logger : logging.Logger
-        The logger to use.
+def etag_matches(if_none_match: typing.Optional[str], etag: str) -> bool:
+    """Return whether an ``If-None-Match`` request header matches ``etag``."""
+    if if_none_match is None:
+        return False
+    candidates = {candidate.strip().removeprefix('W/') for candidate in if_none_match.split(',')}
+    return '*' in candidates or etag in candidates
 
-    Returns
-    -------
-    dict
-        The metadata file as a dictionary.
+
+class MetadataEntry:
+    """A parsed metadata document together with the upstream validator it was fetched with."""
+
+    def __init__(self, metadata: dict, validator: typing.Optional[str]):
+        self.metadata = metadata
+        self.validator = validator
+        self.fetched_at = time.monotonic()
+        # identifies this version of the upstream document, e.g. to derive ETags from
+        self.identity = (
+            validator or hashlib.sha256(json.dumps(metadata, sort_keys=True).encode()).hexdigest()
+        )
+
+    def is_fresh(self, ttl: float) -> bool:
+        return (time.monotonic() - self.fetched_at) <= ttl
+
+    def revalidate(self, validator: typing.Optional[str]) -> bool:
+        """Mark the entry as fresh again if the upstream validator did not change."""
+        if self.validator is None or self.validator != validator:
+            return False
+        self.fetched_at = time.monotonic()
+        return True
+
+
+async def call_filesystem(fs: 'fsspec.AbstractFileSystem', method: str, *args, **kwargs):
+    """Call a method of an fsspec filesystem without blocking the running event loop.
+
+    Async filesystems (e.g. HTTP) run their I/O on fsspec's own event loop in a background thread,
+    so the coroutine version of ``method`` is scheduled there and its result awaited from the
+    current loop. Blocking filesystems are called in a worker thread.
     """
+    if not fs.async_impl:
+        return await asyncio.to_thread(getattr(fs, method), *args, **kwargs)
+    return await _run_on_filesystem_loop(fs, getattr(fs, f'_{method}')(*args, **kwargs))
+
+
+async def _run_on_filesystem_loop(fs: 'fsspec.AbstractFileSystem', coroutine: typing.Awaitable):
+    """Await a coroutine of an async fsspec filesystem on the event loop the filesystem runs on."""
+    if fs.asynchronous:
+        return await coroutine
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, fs.loop))
+
+
+async def _cat_file(
+    fs: 'fsspec.AbstractFileSystem',
+    url: str,
+    *,
+    start: typing.Optional[int],
+    end: typing.Optional[int],
+) -> bytes:
+    value = await call_filesystem(fs, 'cat_file', url, start=start, end=end)
+    upstream_bytes.inc(len(value))
+    return value
+
+
+async def fetch_bytes(
+    *,
+    store: 'zarr.storage.FSStore',
+    key: str,
+    start: typing.Optional[int] = None,
+    end: typing.Optional[int] = None,
+) -> bytes:
+    """Fetch the raw bytes of ``key`` from ``store`` asynchronously.
+
+    Concurrent fetches of the same URL and byte range share a single upstream request.
+
+    Raises
+    ------
+    KeyError
+        If the key cannot be read, mirroring ``FSStore.__getitem__``.
+    """
+    url = f'{store.path}/{key}'
+    try:
+        return await inflight_requests.do(
+            ('cat_file', url, start, end),
+            functools.partial(_cat_file, store.fs, url, start=start, end=end),
+        )
+    except store.exceptions as exc:
+        raise KeyError(key) from exc
+
+
+async def fetch_chunk_bytes(
+    *, store: 'zarr.storage.FSStore', key: str, identity: typing.Optional[str] = None
+) -> bytes:
+    """Fetch the raw bytes of a chunk, going through the disk cache when one is configured.
+
+    ``identity`` is the version of the metadata of the array (see ``get_metadata_identity``), so
+    that bytes cached for a previous version of the array are not reused.
+
+    Raises
+    ------
+    KeyError
+        If the chunk does not exist upstream.
+    """
+    if disk_cache is None:
+        return await fetch_bytes(store=store, key=key)
+
+    cache_key = f'{store.path}/{key}' if identity is None else f'{store.path}/{key}@{identity}'
+    value = await asyncio.to_thread(disk_cache.get, cache_key)
+    if value is None:
+        value = await fetch_bytes(store=store, key=key)
+        await asyncio.to_thread(disk_cache.set, cache_key, value)
+    return value
+
+
+async def _get_validator(*, store: 'zarr.storage.FSStore', key: str) -> typing.Optional[str]:
+    """Return the ETag (or Last-Modified date) of ``key``, or ``None`` if the upstream has none."""
+    try:
+        info = await call_filesystem(store.fs, 'info', f'{store.path}/{key}')
+    except Exception:
+        return None
+    return info.get('ETag') or info.get('Last-Modified')
+
+
+async def _http_get(
+    fs: 'fsspec.implementations.http.HTTPFileSystem', url: str, *, validator: typing.Optional[str]
+) -> tuple[typing.Optional[bytes], typing.Optional[str]]:
+    """GET ``url``, conditionally on ``validator`` if there is one.
+
+    Return the body, or ``None`` if the upstream answered 304 Not Modified, and the validator of
+    the response.
+    """
+    kwargs = fs.kwargs.copy()
+    headers = dict(kwargs.pop('headers', None) or {})
+    if validator is not None:
+        # ETags are quoted, Last-Modified values are dates
+        headers['If-None-Match' if validator.endswith('"') else 'If-Modified-Since'] = validator
+    session = await fs.set_session()
+    async with session.get(fs.encode_url(url), headers=headers, **kwargs) as response:
+        if response.status == 304:
+            return None, validator
+        fs._raise_not_found_for_status(response, url)
+        body = await response.read()
+    upstream_bytes.inc(len(body))
+    return body, response.headers.get('ETag') or response.headers.get('Last-Modified')
+
+
+async def _fetch_metadata(
+    *, store: 'zarr.storage.FSStore', key: str, validator: typing.Optional[str] = None
+) -> tuple[typing.Optional[bytes], typing.Optional[str]]:
+    """Fetch a metadata file unless its upstream validator still is ``validator``.
+
+    Return the body, or ``None`` if it did not change, and its validator. HTTP upstreams answer a
+    single conditional GET, whose response carries both. Other filesystems are asked for the
+    validator first, so that it is never newer than the body fetched after it.
+
+    Raises
+    ------
+    KeyError
+        If the key cannot be read, mirroring ``FSStore.__getitem__``.
+    """
+    import fsspec.implementations.http
+
+    if isinstance(store.fs, fsspec.implementations.http.HTTPFileSystem):
+        try:
+            return await _run_on_filesystem_loop(
+                store.fs, _http_get(store.fs, f'{store.path}/{key}', validator=validator)
+            )
+        except store.exceptions as exc:
+            raise KeyError(key) from exc
+
+    current = await _get_validator(store=store, key=key)
+    if validator is not None and current == validator:
+        return None, validator
+    return await fetch_bytes(store=store, key=key), current
+
+
+@contextlib.contextmanager
+def _translate_metadata_errors(*, store: 'zarr.storage.FSStore', key: str, logger: logging.Logger):
+    """Turn errors raised while loading a metadata file into ``ZarrProxyHTTPException``."""
+    import aiohttp.client_exceptions
+
     details = {}
 
     try:
-        # Load the metadata file from the store and decode it from bytes to string, then parse it as JSON
-        return json.loads(store[key].decode())
+        yield
 
     except KeyError as exc:
         # If the specified key is not found in the store, raise an HTTPException with a 404 status code
@@ -77,7 +283,203 @@ def load_metadata_file(*, store: zarr.storage.FSStore, key: str, logger: logging
         raise ZarrProxyHTTPException(status_code=500, **details) from exc
 
 
-def open_store(*, host: str, path: str, logger: logging.Logger) -> zarr.storage.FSStore:
-    base_url = f'https://{host}/{path}'
-    logger.info(f'Opening store: {base_url}')
-    return zarr.storage.FSStore(base_url)
+def load_metadata_file(*, store: 'zarr.storage.FSStore', key: str, logger: logging.Logger) -> dict:
+    """Load the metadata file from the store.
+
+    This function loads the metadata file from a given store and returns it as a dictionary.
+    Parsed metadata is kept in ``metadata_cache``: fresh entries are served without contacting the
+    upstream, stale entries are revalidated against the upstream ETag/Last-Modified and only
+    fetched again if they changed. This is the blocking counterpart of
+    ``load_metadata_file_async``, and must not be called from a running event loop.
+
+    Parameters
+    ----------
+    store : zarr.storage.FSStore
+        The store to load the metadata file from.
+    key : str
+        The key of the metadata file in the store.
+    logger : logging.Logger
+        The logger to use.
+
+    Returns
+    -------
+    dict
+        The metadata file as a dictionary. Callers own the returned dictionary and may modify it.
+    """
+    return asyncio.run(load_metadata_file_async(store=store, key=key, logger=logger))
+
+
+async def _refresh_metadata_async(
+    *,
+    store: 'zarr.storage.FSStore',
+    key: str,
+    entry: typing.Optional[MetadataEntry],
+    logger: logging.Logger,
+) -> MetadataEntry:
+    validator = entry.validator if entry is not None else None
+    with _translate_metadata_errors(store=store, key=key, logger=logger):
+        body, validator = await _fetch_metadata(store=store, key=key, validator=validator)
+        if body is None:
+            # the upstream still has the cached version
+            entry.revalidate(validator)
+            return entry
+        metadata = json.loads(body)
+
+    entry = MetadataEntry(metadata, validator)
+    metadata_cache.set((store.path, key), entry)
+    return entry
+
+
+async def load_metadata_file_async(
+    *, store: 'zarr.storage.FSStore', key: str, logger: logging.Logger, readonly: bool = False
+) -> dict:
+    """Load the metadata file from the store without blocking the event loop.
+
+    This is the asynchronous counterpart of ``load_metadata_file`` and shares its cache. Concurrent
+    loads of a missing or stale entry share a single revalidation or fetch. With ``readonly`` the
+    cached document itself is returned instead of a copy, and must not be modified.
+    """
+    cache_key = (store.path, key)
+    entry = metadata_cache.get(cache_key)
+    if entry is None or not entry.is_fresh(get_settings().zarr_proxy_metadata_cache_ttl):
+        entry = await inflight_requests.do(
+            ('metadata', *cache_key),
+            functools.partial(
+                _refresh_metadata_async, store=store, key=key, entry=entry, logger=logger
+            ),
+        )
+    return entry.metadata if readonly else copy.deepcopy(entry.metadata)
+
+
+def get_metadata_identity(*, store: 'zarr.storage.FSStore', key: str) -> typing.Optional[str]:
+    """Return the identity of the cached version of a metadata file, if it is cached.
+
+    This is the upstream ETag/Last-Modified, or a digest of the document when the upstream has
+    neither.
+    """
+    entry = metadata_cache.peek((store.path, key))
+    return entry.identity if entry is not None else None
+
+
+# upstream statuses worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+def _retry_middleware(*, retries: int, backoff: float):
+    """Return an aiohttp client middleware retrying failed requests with exponential backoff.
+
+    Requests failing with a connection error, a timeout or one of ``RETRY_STATUSES`` are retried
+    up to ``retries`` times, waiting a random delay of up to ``backoff * 2 ** attempt`` seconds
+    before each retry so that clients don't retry in lockstep.
+    """
+    import aiohttp
+
+    async def middleware(request, handler):
+        for attempt in range(retries + 1):
+            last = attempt == retries
+            try:
+                response = await handler(request)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if last:
+                    raise
+            else:
+                if last or response.status not in RETRY_STATUSES:
+                    return response
+                response.release()
+            await asyncio.sleep(random.uniform(0, backoff * 2**attempt))
+
+    return middleware
+
+
+async def _get_client(*, upstream: UpstreamHost, **kwargs) -> 'aiohttp.ClientSession':
+    import aiohttp
+
+    connector = aiohttp.TCPConnector(
+        limit=upstream.connection_limit,
+        keepalive_timeout=upstream.keepalive_timeout,
+        ttl_dns_cache=upstream.dns_cache_ttl,
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=upstream.request_timeout,
+        connect=upstream.connect_timeout,
+        sock_read=upstream.read_timeout,
+    )
+    middlewares = (
+        (_retry_middleware(retries=upstream.retries, backoff=upstream.retry_backoff),)
+        if upstream.retries
+        else ()
+    )
+    return aiohttp.ClientSession(
+        connector=connector, timeout=timeout, middlewares=middlewares, **kwargs
+    )
+
+
+def get_upstream_host(host: str) -> UpstreamHost:
+    """Return the connection settings of ``host``.
+
+    Raises
+    ------
+    ZarrProxyHTTPException
+        With a 403 status code if ``host`` is not one of the allowed upstream hosts.
+    """
+    upstream = get_settings().get_upstream_host(host)
+    if upstream is None:
+        raise ZarrProxyHTTPException(
+            status_code=403, message=f'{host} is not an allowed upstream host'
+        )
+    return upstream
+
+
+def open_filesystem(*, host: str) -> 'fsspec.AbstractFileSystem':
+    """Return the filesystem, and hence the connection pool, shared by all stores on ``host``.
+
+    Hosts are read over HTTPS, unless they are mapped to the URL of another fsspec filesystem in
+    ``zarr_proxy_upstream_hosts``, e.g. an S3 bucket read with s3fs.
+    """
+    upstream = get_upstream_host(host)
+
+    def factory():
+        import fsspec
+        import fsspec.implementations.http
+
+        protocol = fsspec.utils.get_protocol(upstream.url)
+        if protocol in ('http', 'https'):
+            # skip fsspec's instance cache, otherwise all hosts would share a single session
+            return fsspec.implementations.http.HTTPFileSystem(
+                skip_instance_cache=True,
+                get_client=functools.partial(_get_client, upstream=upstream),
+                **upstream.storage_options,
+            )
+        try:
+            return fsspec.filesystem(protocol, **upstream.storage_options)
+        except ImportError as exc:
+            raise ZarrProxyHTTPException(
+                status_code=500, message=f'The {protocol} backend of {host} is not available: {exc}'
+            ) from exc
+
+    return filesystem_cache.get_or_create(host, factory)
+
+
+def open_store(*, host: str, path: str, logger: logging.Logger) -> 'zarr.storage.FSStore':
+    """Return a store for ``{url}/{path}``, reusing a recently opened one if possible.
+
+    ``url`` is ``https://{host}`` unless ``host`` is mapped to another URL, see
+    ``open_filesystem``.
+
+    Opening a store performs no I/O (sessions are created lazily on the filesystem's own event
+    loop), so this is safe to call from async request handlers. Hosts that are not allowed are
+    rejected with a 403 error, and paths with ``.``, ``..`` or empty segments, which could escape
+    the URL the host is mapped to, with a 400 error before anything is opened.
+    """
+    upstream = get_upstream_host(host)
+    if any(segment in ('', '.', '..') for segment in path.split('/')):
+        raise ZarrProxyHTTPException(status_code=400, message=f'Invalid path: {path}')
+
+    def factory():
+        import zarr.storage
+
+        base_url = f'{upstream.url.removesuffix("/")}/{path}'
+        logger.info(f'Opening store: {base_url}')
+        return zarr.storage.FSStore(base_url, fs=open_filesystem(host=host))
+
+    return store_cache.get_or_create((host, path), factory)
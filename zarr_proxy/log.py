@@ -1,16 +1,171 @@
+import atexit
+import contextvars
+import json
 import logging
+import logging.handlers
+import queue
+import random
 import sys
+import time
+import typing
 
+LOGGER_NAME = 'zarr-proxy'
+TEXT_FORMAT = '%(levelname)s:     %(asctime)s  - %(name)s - %(message)s'
 
-def get_logger() -> logging.Logger:
-    logger = logging.getLogger('zarr-proxy')
+# Fields describing the current request, collected by the handlers and written to the access log
+_access_log_fields: contextvars.ContextVar[typing.Optional[dict]] = contextvars.ContextVar(
+    'zarr_proxy_access_log_fields', default=None
+)
+_listener: typing.Optional[logging.handlers.QueueListener] = None
+
+
+class TextFormatter(logging.Formatter):
+    """The default log format, followed by the structured fields of the record, if any."""
+
+    def __init__(self):
+        super().__init__(TEXT_FORMAT)
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            message += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return message
+
+
+class JSONFormatter(logging.Formatter):
+    """Format records as one JSON object per line, e.g. for log aggregation services."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            **getattr(record, 'fields', {}),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+FORMATTERS = {'text': TextFormatter, 'json': JSONFormatter}
+
+
+def configure_logging(*, level: typing.Union[str, int] = 'INFO', format: str = 'text') -> None:
+    """Configure the logger of the package.
+
+    Records are put on a queue by the calling thread and written to stdout by a background
+    thread, so logging never blocks request handlers on I/O.
+
+    Parameters
+    ----------
+    level: str | int
+        The minimum level of the records to write, e.g. "INFO"
+    format: str
+        "text" for human readable lines or "json" for one JSON object per line
+    """
+    global _listener
+
+    if format not in FORMATTERS:
+        raise ValueError(
+            f'Invalid log format: {format}. Valid formats are: {", ".join(FORMATTERS)}'
+        )
+
+    logger = logging.getLogger(LOGGER_NAME)
+    if _listener is not None:
+        _listener.stop()
+    logger.handlers.clear()
 
     handler = logging.StreamHandler(stream=sys.stdout)
-    handler.setFormatter(
-        logging.Formatter('%(levelname)s:     %(asctime)s  - %(name)s - %(message)s'),
-    )
-    if logger.hasHandlers():
-        logger.handlers.clear()
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(handler)
+    handler.setFormatter(FORMATTERS[format]())
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.propagate = False
+
+
+def _stop_listener() -> None:
+    if _listener is not None:
+        # flush the records still on the queue
+        _listener.stop()
+
+
+atexit.register(_stop_listener)
+
+
+def get_logger() -> logging.Logger:
+    """Return the logger of the package, configuring it with the defaults on first use."""
+    logger = logging.getLogger(LOGGER_NAME)
+    if not logger.handlers:
+        configure_logging()
     return logger
+
+
+class Sampler:
+    """Decide whether to log a frequent event, e.g. once per chunk, keeping a fraction ``rate``."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+
+    def __call__(self) -> bool:
+        return self.rate >= 1 or (self.rate > 0 and random.random() < self.rate)
+
+
+def add_access_log_fields(**fields: typing.Any) -> None:
+    """Add fields to the access log line of the current request."""
+    current = _access_log_fields.get()
+    if current is not None:
+        current.update(fields)
+
+
+class AccessLogMiddleware:
+    """ASGI middleware writing one access log line per request.
+
+    The line holds the method, path, status, response size and duration of the request, together
+    with the fields added by the handler with ``add_access_log_fields``.
+    """
+
+    def __init__(self, app, *, logger: typing.Optional[logging.Logger] = None):
+        self.app = app
+        self.logger = logger or get_logger()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not self.logger.isEnabledFor(logging.INFO):
+            return await self.app(scope, receive, send)
+
+        status = 500
+        sent = 0
+
+        async def send_wrapper(message):
+            nonlocal status, sent
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                sent += len(message.get('body', b''))
+            await send(message)
+
+        fields = {}
+        token = _access_log_fields.set(fields)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _access_log_fields.reset(token)
+            duration = time.perf_counter() - start
+            self.logger.info(
+                '%s %s',
+                scope['method'],
+                scope['path'],
+                extra={
+                    'fields': {
+                        'status': status,
+                        'bytes': sent,
+                        'duration_ms': round(duration * 1000, 3),
+                        **fields,
+                    }
+                },
+            )
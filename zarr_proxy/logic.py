@@ -1,11 +1,52 @@
 """Logic for the zarr proxy"""
 
 import functools
+import itertools
 import math
 import operator
 import re
 import typing
 
+import numpy as np
+
+# Variable names can contain letters, digits, whitespace, underscores, dots and hyphens
+_VARIABLE_NAME = re.compile(r'[\w\s._-]+')
+
+
+def _parse_chunk_size(value: str) -> typing.Optional[int]:
+    value = value.strip()
+    if not (value.isascii() and value.isdigit()):
+        return None
+    return int(value) or None
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_chunks_header(chunks: str) -> tuple[tuple[str, tuple[int, ...]], ...]:
+    parsed = {}
+    name, sizes = None, None
+    for piece in chunks.split(','):
+        if '=' in piece:
+            # a new variable starts, which ends the previous one
+            if name is not None:
+                parsed[name] = tuple(sizes)
+            name, _, value = piece.partition('=')
+            name = name.strip()
+            size = _parse_chunk_size(value)
+            if size is None or not _VARIABLE_NAME.fullmatch(name):
+                name = None
+                continue
+            sizes = [size]
+        elif name is not None and piece.strip():
+            size = _parse_chunk_size(piece)
+            if size is None:
+                # an invalid size invalidates the whole variable
+                name = None
+                continue
+            sizes.append(size)
+    if name is not None:
+        parsed[name] = tuple(sizes)
+    return tuple(parsed.items())
+
 
 def parse_chunks_header(chunks: str) -> dict[str, tuple[int, ...]]:
     """Parse the chunks header into a dictionary of chunk keys and chunk sizes.
@@ -13,6 +54,11 @@ def parse_chunks_header(chunks: str) -> dict[str, tuple[int, ...]]:
     This turns a string like "bed=10,10,prec=20,20,lat=5" into a dictionary like
     {"bed": (10, 10), "prec": (20, 20), "lat": (5,)}.
 
+    The header is split on commas in a single pass. A piece of the form ``name=size`` starts a
+    new variable and the following bare sizes extend it. Variables with an invalid name, or with
+    a size that is not a positive integer, are skipped. Clients send the same header over and
+    over, so parsed headers are memoized.
+
     Parameters
     ----------
     chunks: str
@@ -25,18 +71,93 @@ def parse_chunks_header(chunks: str) -> dict[str, tuple[int, ...]]:
 
 
     """
+    return dict(_parse_chunks_header(chunks))
 
-    # This pattern matches one or more characters that are either lowercase or uppercase
-    # letters (\w), whitespace (\s), underscore (_), or hyphen (-), followed by
-    # the character = and then one or more digits (\d) or commas (,). The + following
-    # each character class means to match one or more of these characters. The \b at the
-    # end of the pattern is a word boundary and ensures that only complete words matching the pattern are returned.
-    parsed_list = re.findall(r'([\w\s\._-]+=[\d,]+)\b', chunks)
-    parsed_dict = {}
-    for item in parsed_list:
-        key, value = item.strip().split('=')
-        parsed_dict[key] = tuple(map(int, value.strip(',').split(',')))
-    return parsed_dict
+
+@functools.lru_cache(maxsize=1024)
+def canonical_chunks_header(chunks: str) -> str:
+    """Return a compact canonical form of the chunks header, e.g. for use in cache keys.
+
+    Headers that parse to the same chunks have the same canonical form: variables are sorted by
+    name, and whitespace around sizes and invalid variables are dropped.
+
+    Parameters
+    ----------
+    chunks: str
+        e.g. "prec=20, 20, bed=10,10"
+
+    Returns
+    -------
+    str
+        e.g. "bed=10,10,prec=20,20"
+    """
+    return ','.join(
+        f'{name}={",".join(map(str, sizes))}'
+        for name, sizes in sorted(_parse_chunks_header(chunks))
+    )
+
+
+# Codecs that clients can ask the proxy to compress chunks with, and the name, default value and
+# valid range of the codec's level parameter
+OUTPUT_CODECS = {
+    'zlib': ('level', 1, range(0, 10)),
+    'gzip': ('level', 1, range(0, 10)),
+    'zstd': ('level', 1, range(0, 23)),
+    # higher accelerations are clamped by lz4, larger values overflow numcodecs
+    'lz4': ('acceleration', 1, range(1, 65538)),
+    'blosc': ('clevel', 5, range(0, 10)),
+}
+BLOSC_CNAMES = ('lz4', 'lz4hc', 'blosclz', 'zstd', 'zlib')
+
+
+def parse_compressor_header(compressor: str) -> typing.Optional[dict]:
+    """Parse the compressor header into a numcodecs codec configuration.
+
+    The header is a codec name optionally followed by a level, e.g. "zstd", "zstd:5" or "zlib:9".
+    Blosc additionally accepts an inner compressor, e.g. "blosc:zstd:3". "none" disables compression.
+
+    Parameters
+    ----------
+    compressor: str
+        e.g. "blosc:lz4:5"
+
+    Returns
+    -------
+    dict | None
+        e.g. {"id": "blosc", "cname": "lz4", "clevel": 5, "shuffle": 1}
+
+    Raises
+    ------
+    ValueError
+        If the codec or its parameters are not supported.
+    """
+    codec_id, *params = compressor.strip().lower().split(':')
+    if codec_id in ('', 'none'):
+        return None
+    if codec_id not in OUTPUT_CODECS:
+        raise ValueError(
+            f'Unsupported compressor: {codec_id}. Valid compressors are: {", ".join(OUTPUT_CODECS)}'
+        )
+
+    config = {'id': codec_id}
+    if codec_id == 'blosc':
+        config.update(cname='lz4', shuffle=1)
+        if params and not params[0].isdigit():
+            config['cname'] = params.pop(0)
+        if config['cname'] not in BLOSC_CNAMES:
+            raise ValueError(
+                f'Unsupported blosc compressor: {config["cname"]}. Valid compressors are: {", ".join(BLOSC_CNAMES)}'
+            )
+
+    level_name, level, levels = OUTPUT_CODECS[codec_id]
+    if len(params) > 1 or (params and not params[0].isdigit()):
+        raise ValueError(f'Invalid compressor parameters: {compressor}')
+    config[level_name] = int(params[0]) if params else level
+    if config[level_name] not in levels:
+        raise ValueError(
+            f'Invalid {codec_id} {level_name}: {config[level_name]}. It must be between {levels.start} and {levels.stop - 1}'
+        )
+    return config
 
 
 def virtual_array_info(
@@ -137,23 +258,610 @@ def chunk_id_to_slice(
     tuple[slice]
         the slices to extract the chunk from the array
     """
-    # Convert the chunk key string to a tuple of integers
-    chunk_indices = tuple(int(chunk) for chunk in chunk_key.split(delimiter))
-
-    # TODO: more error handling maybe?
-    # Retrieve information about the virtual array
-    array_info = virtual_array_info(shape=shape, chunks=chunks)
-    validate_chunks_info(
-        shape=shape,
-        chunks=chunks,
-        chunk_index=chunk_indices,
-        chunks_block_shape=array_info['chunks_block_shape'],
-    )
-    # Generate slices for the given chunk indices
-    slices = tuple(
-        slice(
-            min(chunk_size * chunk_index, dim_size), min(chunk_size * (chunk_index + 1), dim_size)
+    grid = get_chunk_grid(shape=tuple(shape), chunks=tuple(chunks))
+    return grid.chunk_slice(grid.parse_key(chunk_key, delimiter=delimiter))
+
+
+@functools.lru_cache(maxsize=4096)
+def _dimension_intersections(
+    start: int, stop: int, chunk_size: int, step: int = 1
+) -> tuple[tuple[int, slice, slice], ...]:
+    """Return the ``(chunk_index, chunk_selection, out_selection)`` items of one dimension.
+
+    With a ``step``, only the source chunks holding one of the selected positions
+    ``start, start + step, ...`` are returned.
+    """
+    intersections = []
+    count = math.ceil((stop - start) / step)
+    for chunk_index in range(start // chunk_size, math.ceil(stop / chunk_size)):
+        chunk_start = chunk_index * chunk_size
+        # the first and last (exclusive) selected positions within this chunk
+        first = max(0, math.ceil((chunk_start - start) / step))
+        last = min(count, math.ceil((chunk_start + chunk_size - start) / step))
+        if first >= last:
+            continue
+        lower = start + first * step
+        upper = start + (last - 1) * step + 1
+        intersections.append(
+            (
+                chunk_index,
+                slice(lower - chunk_start, upper - chunk_start, step if step != 1 else None),
+                slice(first, last),
+            )
         )
-        for chunk_size, dim_size, chunk_index in zip(chunks, shape, chunk_indices)
+    return tuple(intersections)
+
+
+def _combine_intersections(
+    per_dimension: typing.Sequence[typing.Sequence[tuple[int, slice, slice]]],
+) -> list[tuple[tuple[int, ...], tuple[slice, ...], tuple[slice, ...]]]:
+    return [
+        tuple(tuple(item) for item in zip(*combination)) if combination else ((), (), ())
+        for combination in itertools.product(*per_dimension)
+    ]
+
+
+def source_chunk_selections(
+    data_slice: tuple[slice, ...], *, source_chunks: tuple[int, ...]
+) -> list[tuple[tuple[int, ...], tuple[slice, ...], tuple[slice, ...]]]:
+    """
+    Given a region of an array, return the source chunks that intersect it
+
+    Parameters
+    ----------
+    data_slice: tuple[slice]
+        the region of the array, e.g. as returned by ``chunk_id_to_slice``. Slices may have a
+        step, in which case only every ``step``-th element of the region is selected.
+    source_chunks: tuple
+        the chunking of the array in the upstream store
+
+    Returns
+    -------
+    list[tuple[tuple[int], tuple[slice], tuple[slice]]]
+        one ``(chunk_index, chunk_selection, out_selection)`` item per intersecting source chunk,
+        where ``chunk_selection`` is the part of the source chunk to read and ``out_selection`` is
+        where that part goes in the region
+    """
+    return _combine_intersections(
+        [
+            _dimension_intersections(
+                dim_slice.start, dim_slice.stop, chunk_size, dim_slice.step or 1
+            )
+            for dim_slice, chunk_size in zip(data_slice, source_chunks)
+        ]
     )
-    return slices
+
+
+def chunk_byte_ranges(
+    chunk_selection: tuple[slice, ...],
+    *,
+    chunks: tuple[int, ...],
+    itemsize: int,
+    order: str = 'C',
+    limit: typing.Optional[int] = None,
+) -> typing.Optional[np.ndarray]:
+    """
+    Return the contiguous byte ranges holding a selection of an uncompressed chunk
+
+    Parameters
+    ----------
+    chunk_selection: tuple[slice]
+        the part of the chunk to read, e.g. as returned by ``source_chunk_selections``
+    chunks: tuple[int]
+        the shape of the chunk
+    itemsize: int
+        the size in bytes of an element of the chunk
+    order: str
+        the memory layout of the chunk, "C" or "F"
+    limit: int, optional
+        the maximum number of ranges to return
+
+    Returns
+    -------
+    numpy.ndarray, optional
+        one ``(start, stop)`` row of byte offsets per range, or None if there are more than
+        ``limit`` ranges
+    """
+    if order == 'F':
+        chunk_selection, chunks = chunk_selection[::-1], chunks[::-1]
+    strides = [itemsize * math.prod(chunks[index + 1 :]) for index in range(len(chunks))]
+
+    # the trailing dimensions selected in full are contiguous
+    partial = len(chunks)
+    while partial > 0:
+        dim_slice = chunk_selection[partial - 1]
+        if (
+            (dim_slice.step or 1) != 1
+            or dim_slice.start != 0
+            or dim_slice.stop != chunks[partial - 1]
+        ):
+            break
+        partial -= 1
+    if partial == 0:
+        return np.array([[0, math.prod(chunks) * itemsize]], dtype=np.int64)
+
+    # so is the last partially selected dimension, unless it has a step
+    last = chunk_selection[partial - 1]
+    if (last.step or 1) == 1:
+        outer = chunk_selection[: partial - 1]
+        base = last.start * strides[partial - 1]
+        length = (last.stop - last.start) * strides[partial - 1]
+    else:
+        outer = chunk_selection[:partial]
+        base = 0
+        length = strides[partial - 1]
+
+    positions = [range(s.start, s.stop, s.step or 1) for s in outer]
+    if limit is not None and math.prod(map(len, positions)) > limit:
+        return None
+    starts = np.full(1, base, dtype=np.int64)
+    for dim_positions, stride in zip(positions, strides):
+        offsets = np.asarray(dim_positions, dtype=np.int64) * stride
+        starts = (starts[:, np.newaxis] + offsets[np.newaxis, :]).reshape(-1)
+    return np.stack([starts, starts + length], axis=1)
+
+
+def merge_byte_ranges(ranges: np.ndarray, *, gap: int = 0) -> list[tuple[int, int]]:
+    """Merge byte ranges that overlap or are at most ``gap`` bytes apart, sorting them by offset.
+
+    Reading a few bytes more is usually cheaper than making one more request.
+    """
+    if not len(ranges):
+        return []
+    ranges = ranges[np.argsort(ranges[:, 0], kind='stable')]
+    stops = np.maximum.accumulate(ranges[:, 1])
+    firsts = np.concatenate([[0], np.flatnonzero(ranges[1:, 0] - stops[:-1] > gap) + 1])
+    lasts = np.concatenate([firsts[1:] - 1, [len(ranges) - 1]])
+    return [(int(start), int(stop)) for start, stop in zip(ranges[firsts, 0], stops[lasts])]
+
+
+class ChunkGrid:
+    """The geometry of a virtual chunking of an array, shared by every request using it.
+
+    Parameters
+    ----------
+    shape: tuple[int]
+        The shape of the array
+    chunks: tuple[int]
+        The virtual chunking
+    source_chunks: tuple[int], optional
+        The chunking of the array in the upstream store, see ``selections``.
+
+    Raises
+    ------
+    IndexError
+        If the lengths of shape, chunks and source_chunks are inconsistent
+    """
+
+    def __init__(
+        self,
+        *,
+        shape: tuple[int, ...],
+        chunks: tuple[int, ...],
+        source_chunks: typing.Optional[tuple[int, ...]] = None,
+    ):
+        if len(shape) != len(chunks):
+            raise IndexError(f'The length of shape: {shape} and chunks: {chunks} must be the same.')
+        if source_chunks is not None and len(source_chunks) != len(shape):
+            raise IndexError(
+                f'The length of shape: {shape} and source chunks: {source_chunks} must be the same.'
+            )
+        self.shape = shape
+        self.chunks = chunks
+        self.source_chunks = source_chunks
+        self.ndim = len(shape)
+        self.chunks_block_shape = tuple(math.ceil(s / c) for s, c in zip(shape, chunks))
+        self.num_chunks = math.prod(self.chunks_block_shape)
+
+    def parse_key(self, chunk_key: str, *, delimiter: str = '.') -> tuple[int, ...]:
+        """Return the chunk index of a chunk key, e.g. "1.3.2" -> (1, 3, 2)
+
+        Raises
+        ------
+        IndexError
+            If the chunk key is out of bounds or does not have one index per dimension
+        ValueError
+            If the chunk key is not made of integers
+        """
+        chunk_index = tuple(map(int, chunk_key.split(delimiter)))
+        if self.ndim == 0 and chunk_index == (0,):
+            # zero-dimensional arrays have a single chunk with key "0"
+            return ()
+        if len(chunk_index) != self.ndim:
+            raise IndexError(
+                f'The length of chunk_index: {chunk_index} and chunks: {self.chunks} must be the same.'
+            )
+        for index, dim_size in zip(chunk_index, self.chunks_block_shape):
+            if index < 0 or index >= dim_size:
+                raise IndexError(
+                    f'The chunk_index: {chunk_index} must be less than the chunks block shape: {self.chunks_block_shape}'
+                )
+        return chunk_index
+
+    def chunk_slice(self, chunk_index: tuple[int, ...]) -> tuple[slice, ...]:
+        """Return the region of the array covered by a virtual chunk.
+
+        Like the rest of the geometry, it is computed on demand: the grid is chosen by the client
+        and may have far more chunks than are ever requested.
+        """
+        return tuple(
+            slice(index * chunk_size, min((index + 1) * chunk_size, dim_size))
+            for index, chunk_size, dim_size in zip(chunk_index, self.chunks, self.shape)
+        )
+
+    def selections(
+        self, chunk_index: tuple[int, ...]
+    ) -> list[tuple[tuple[int, ...], tuple[slice, ...], tuple[slice, ...]]]:
+        """Return the source chunks intersecting a virtual chunk, see ``source_chunk_selections``."""
+        if self.source_chunks is None:
+            raise ValueError('The source chunks of the grid are unknown')
+        return _combine_intersections(
+            [
+                _dimension_intersections(dim_slice.start, dim_slice.stop, chunk_size)
+                for dim_slice, chunk_size in zip(self.chunk_slice(chunk_index), self.source_chunks)
+            ]
+        )
+
+    def parse_keys(self, chunk_keys: typing.Sequence[str], *, delimiter: str = '.') -> np.ndarray:
+        """Return the chunk indices of many chunk keys as an array of shape (len(chunk_keys), ndim).
+
+        Raises
+        ------
+        IndexError
+            If any chunk key is out of bounds or does not have one index per dimension
+        ValueError
+            If any chunk key is not made of integers
+        """
+        if self.ndim == 0:
+            return np.array(
+                [self.parse_key(key, delimiter=delimiter) for key in chunk_keys]
+            ).reshape(len(chunk_keys), 0)
+        parts = [key.split(delimiter) for key in chunk_keys]
+        for key, key_parts in zip(chunk_keys, parts):
+            if len(key_parts) != self.ndim:
+                raise IndexError(
+                    f'The length of chunk_index: {key} and chunks: {self.chunks} must be the same.'
+                )
+        try:
+            indices = np.array(parts, dtype=np.int64).reshape(len(chunk_keys), self.ndim)
+        except OverflowError as exc:
+            # indices that don't fit in 64 bits are out of bounds of any array
+            raise IndexError(
+                f'The chunk indices must be less than the chunks block shape: {self.chunks_block_shape}'
+            ) from exc
+        invalid = ((indices < 0) | (indices >= np.array(self.chunks_block_shape))).any(axis=1)
+        if invalid.any():
+            chunk_index = tuple(indices[invalid.argmax()].tolist())
+            raise IndexError(
+                f'The chunk_index: {chunk_index} must be less than the chunks block shape: {self.chunks_block_shape}'
+            )
+        return indices
+
+    def chunk_slices(
+        self, chunk_keys: typing.Sequence[str], *, delimiter: str = '.'
+    ) -> list[tuple[slice, ...]]:
+        """Return the regions of the array covered by many virtual chunks at once."""
+        indices = self.parse_keys(chunk_keys, delimiter=delimiter)
+        if self.ndim == 0:
+            return [() for _ in chunk_keys]
+        starts = indices * np.array(self.chunks, dtype=np.int64)
+        stops = np.minimum(starts + np.array(self.chunks), np.array(self.shape))
+        return [
+            tuple(map(slice, start, stop)) for start, stop in zip(starts.tolist(), stops.tolist())
+        ]
+
+
+@functools.lru_cache(maxsize=1024)
+def get_chunk_grid(
+    *,
+    shape: tuple[int, ...],
+    chunks: tuple[int, ...],
+    source_chunks: typing.Optional[tuple[int, ...]] = None,
+) -> ChunkGrid:
+    """Return the ``ChunkGrid`` of an array, reusing it across requests."""
+    return ChunkGrid(shape=shape, chunks=chunks, source_chunks=source_chunks)
+
+
+def parse_region(region: typing.Optional[str], *, shape: tuple[int, ...]) -> tuple[slice, ...]:
+    """Parse a region of an array given as one ``start:stop`` range per dimension.
+
+    Omitted bounds default to the bounds of the array, and stops past the end of the array are
+    clipped to it.
+
+    Parameters
+    ----------
+    region: str, optional
+        e.g. "0:100,:,10:". ``None`` or an empty string selects the whole array.
+    shape: tuple[int]
+        the shape of the array
+
+    Returns
+    -------
+    tuple[slice]
+        e.g. (slice(0, 100), slice(0, 30), slice(10, 20))
+
+    Raises
+    ------
+    ValueError
+        If the region does not have one range per dimension or a range is empty or invalid.
+    """
+    if not region:
+        return tuple(slice(0, size) for size in shape)
+    ranges = region.split(',')
+    if len(ranges) != len(shape):
+        raise ValueError(f'The region {region} must have one range per dimension of {shape}')
+    slices = []
+    for dim_range, size in zip(ranges, shape):
+        start, separator, stop = dim_range.strip().partition(':')
+        try:
+            start = int(start) if start.strip() else 0
+            stop = min(int(stop), size) if stop.strip() else size
+        except ValueError:
+            raise ValueError(f'Invalid range {dim_range} in region {region}') from None
+        if not separator or start < 0 or start >= stop:
+            raise ValueError(f'Invalid range {dim_range} in region {region} of shape {shape}')
+        slices.append(slice(start, stop))
+    return tuple(slices)
+
+
+def parse_step(step: typing.Optional[str], *, ndim: int) -> tuple[int, ...]:
+    """Parse a step (or reduction factor) given once for all dimensions or once per dimension.
+
+    Parameters
+    ----------
+    step: str, optional
+        e.g. "4" or "1,4,4". ``None`` or an empty string means a step of 1.
+    ndim: int
+        the number of dimensions of the array
+
+    Returns
+    -------
+    tuple[int]
+        e.g. (1, 4, 4)
+
+    Raises
+    ------
+    ValueError
+        If the steps are not positive integers, or there are neither one nor ``ndim`` of them.
+    """
+    if not step:
+        return (1,) * ndim
+    try:
+        steps = tuple(int(value) for value in step.split(','))
+    except ValueError:
+        raise ValueError(f'Invalid step: {step}') from None
+    if len(steps) == 1:
+        steps *= ndim
+    if len(steps) != ndim or any(value < 1 for value in steps):
+        raise ValueError(f'The step {step} must be one or {ndim} positive integers')
+    return steps
+
+
+def source_chunk_key(
+    chunk_index: tuple[int, ...], *, delimiter: str = '.', prefix: str = ''
+) -> str:
+    """
+    Return the Zarr chunk key of a source chunk, e.g. (1, 3, 2) -> "1.3.2"
+
+    Parameters
+    ----------
+    chunk_index: tuple[int]
+        the index of the chunk in the chunk grid
+    delimiter: str
+        chunk separator character
+    prefix: str
+        prefix of the chunk keys, e.g. "c" for the default chunk key encoding of Zarr v3, which
+        gives (1, 3, 2) -> "c/1/3/2"
+
+    Returns
+    -------
+    str
+        the chunk key. Zero-dimensional arrays have a single chunk with key "0", or the prefix.
+    """
+    if prefix:
+        return delimiter.join((prefix, *map(str, chunk_index)))
+    return delimiter.join(map(str, chunk_index)) or '0'
+
+
+# Zarr v3 names of the blosc shuffle modes of numcodecs
+BLOSC_SHUFFLES = ('noshuffle', 'shuffle', 'bitshuffle')
+
+
+def chunk_key_encoding_v3(metadata: dict) -> tuple[str, str]:
+    """Return the prefix and the separator of the chunk keys of a Zarr v3 array.
+
+    Parameters
+    ----------
+    metadata: dict
+        the ``zarr.json`` of the array
+
+    Returns
+    -------
+    tuple[str, str]
+        ("c", "/") for the default encoding, ("", ".") for the v2 encoding
+
+    Raises
+    ------
+    ValueError
+        If the chunk key encoding is not supported.
+    """
+    encoding = metadata.get('chunk_key_encoding', {'name': 'default'})
+    separator = encoding.get('configuration', {}).get('separator')
+    if encoding['name'] == 'default':
+        return 'c', separator or '/'
+    if encoding['name'] == 'v2':
+        return '', separator or '.'
+    raise ValueError(f'Unsupported chunk key encoding: {encoding["name"]}')
+
+
+def parse_codecs_v3(codecs: list[dict]) -> dict:
+    """Split the codec pipeline of a Zarr v3 array into its parts.
+
+    Parameters
+    ----------
+    codecs: list[dict]
+        e.g. [{"name": "bytes", "configuration": {"endian": "little"}}, {"name": "zstd", ...}]
+
+    Returns
+    -------
+    dict
+        ``order``: the memory order of the chunks, "C", or "F" for a reversed transpose.
+        ``endian``: the byte order of the bytes codec ("little", "big" or None).
+        ``codecs``: the configurations of the bytes-to-bytes codecs, in encoding order.
+        ``sharding``: the configuration of the sharding codec, or None.
+
+    Raises
+    ------
+    ValueError
+        If the pipeline holds a codec other than transpose, bytes, sharding and bytes-to-bytes
+        codecs, e.g. the variable-length string codecs.
+    """
+    parts = {'order': 'C', 'endian': None, 'codecs': [], 'sharding': None}
+    for codec in codecs:
+        if isinstance(codec, str):
+            codec = {'name': codec}
+        name, configuration = codec['name'], codec.get('configuration', {})
+        if name == 'transpose':
+            order = list(configuration['order'])
+            if order == sorted(order, reverse=True):
+                parts['order'] = 'F'
+            elif order != sorted(order):
+                raise ValueError(f'Unsupported transpose order: {order}')
+        elif name == 'bytes':
+            parts['endian'] = configuration.get('endian')
+        elif name == 'sharding_indexed':
+            parts['sharding'] = configuration
+        elif name in ('gzip', 'zstd', 'blosc', 'crc32c') or name.startswith('numcodecs.'):
+            parts['codecs'].append({'name': name, 'configuration': configuration})
+        else:
+            raise ValueError(f'Unsupported codec: {name}')
+    return parts
+
+
+def chunk_shape_v3(metadata: dict) -> tuple[int, ...]:
+    """Return the shape of the chunks a Zarr v3 array is read by: its inner chunks if sharded.
+
+    Raises
+    ------
+    ValueError
+        If the array does not have a regular chunk grid.
+    """
+    grid = metadata['chunk_grid']
+    if grid['name'] != 'regular':
+        raise ValueError(f'Unsupported chunk grid: {grid["name"]}')
+    sharding = parse_codecs_v3(metadata['codecs'])['sharding']
+    if sharding is not None:
+        return tuple(sharding['chunk_shape'])
+    return tuple(grid['configuration']['chunk_shape'])
+
+
+def compressor_codec_v3(compressor: dict, *, itemsize: int) -> dict:
+    """Return the Zarr v3 codec of a numcodecs compressor configuration.
+
+    Parameters
+    ----------
+    compressor: dict
+        e.g. {"id": "blosc", "cname": "lz4", "clevel": 5, "shuffle": 1}, see
+        ``parse_compressor_header``
+    itemsize: int
+        the size in bytes of the elements of the array, which blosc shuffles by
+
+    Returns
+    -------
+    dict
+        e.g. {"name": "blosc", "configuration": {"cname": "lz4", "clevel": 5, ...}}. Codecs
+        without a v3 specification use the "numcodecs." names of zarr-python.
+    """
+    config = {key: value for key, value in compressor.items() if key != 'id'}
+    if compressor['id'] == 'zstd':
+        return {'name': 'zstd', 'configuration': {**config, 'checksum': False}}
+    if compressor['id'] == 'gzip':
+        return {'name': 'gzip', 'configuration': config}
+    if compressor['id'] == 'blosc':
+        configuration = {
+            'cname': config['cname'],
+            'clevel': config['clevel'],
+            'shuffle': BLOSC_SHUFFLES[config['shuffle']],
+            'typesize': itemsize,
+            'blocksize': 0,
+        }
+        return {'name': 'blosc', 'configuration': configuration}
+    return {'name': f'numcodecs.{compressor["id"]}', 'configuration': config}
+
+
+def virtual_zarr_json(
+    metadata: dict, *, chunks: typing.Optional[tuple[int, ...]], compressor: typing.Optional[dict]
+) -> dict:
+    """Return the ``zarr.json`` of a Zarr v3 array as served by the proxy.
+
+    Chunks are served decoded and unsharded, in C order, with the default chunk key encoding,
+    and optionally compressed with the codec requested by the client.
+
+    Parameters
+    ----------
+    metadata: dict
+        the ``zarr.json`` of the source array
+    chunks: tuple[int] | None
+        the chunks requested by the client, defaults to the chunks the source is read by
+    compressor: dict | None
+        the numcodecs configuration of the compressor requested by the client
+
+    Raises
+    ------
+    ValueError
+        If the array cannot be served, see ``parse_codecs_v3``.
+    """
+    parts = parse_codecs_v3(metadata['codecs'])
+    if parts['sharding'] is not None:
+        parts = parse_codecs_v3(parts['sharding']['codecs'])
+    chunks = chunks or chunk_shape_v3(metadata)
+    codecs = [{'name': 'bytes', 'configuration': {'endian': parts['endian'] or 'little'}}]
+    if compressor is not None:
+        itemsize = np.dtype(metadata['data_type']).itemsize
+        codecs.append(compressor_codec_v3(compressor, itemsize=itemsize))
+    return {
+        **metadata,
+        'chunk_grid': {'name': 'regular', 'configuration': {'chunk_shape': list(chunks)}},
+        'chunk_key_encoding': {'name': 'default', 'configuration': {'separator': '/'}},
+        'codecs': codecs,
+    }
+
+
+def virtual_group_zarr_json(
+    metadata: dict,
+    *,
+    chunks: dict[str, tuple[int, ...]],
+    compressor: typing.Optional[dict],
+) -> dict:
+    """Return the ``zarr.json`` of a Zarr v3 group as served by the proxy.
+
+    The arrays of the consolidated metadata of the group, if any, are rewritten like
+    ``virtual_zarr_json``, with the chunks of ``chunks`` keyed by their path in the group.
+
+    Raises
+    ------
+    ValueError
+        If ``chunks`` holds variables that are not arrays of the consolidated metadata.
+    """
+    consolidated = metadata.get('consolidated_metadata') or {}
+    arrays = {
+        key: value
+        for key, value in (consolidated.get('metadata') or {}).items()
+        if value.get('node_type') == 'array'
+    }
+    if not arrays.keys() >= chunks.keys():
+        raise ValueError(
+            f'Invalid chunks header. Variables {sorted(chunks.keys() - arrays.keys())} not found in the consolidated metadata: {sorted(arrays)}'
+        )
+    if not arrays:
+        return metadata
+    rewritten = {}
+    for key, value in consolidated['metadata'].items():
+        if key in arrays:
+            try:
+                value = virtual_zarr_json(value, chunks=chunks.get(key), compressor=compressor)
+            except ValueError:
+                # arrays the proxy can't serve are listed as they are, and fail when read
+                pass
+        rewritten[key] = value
+    return {**metadata, 'consolidated_metadata': {**consolidated, 'metadata': rewritten}}
@@ -1,14 +1,26 @@
 from fastapi import FastAPI
 
+from .config import get_settings
 from .exceptions import ZarrProxyHTTPException, zarr_proxy_http_exception_handler
-from .log import get_logger
+from .log import AccessLogMiddleware, configure_logging, get_logger
+from .metrics import MetricsMiddleware
+from .multiscales import router as multiscales_router
 from .store import router as store_router
+from .warmup import warm_up
 
 
 def create_application() -> FastAPI:
+    settings = get_settings()
+    configure_logging(level=settings.zarr_proxy_log_level, format=settings.zarr_proxy_log_format)
+
     application = FastAPI()
+    # before the store routes, which would match the paths of the multiscale groups too
+    application.include_router(multiscales_router, tags=['multiscales'])
     application.include_router(store_router, tags=['main'])
     application.add_exception_handler(ZarrProxyHTTPException, zarr_proxy_http_exception_handler)
+    application.add_middleware(MetricsMiddleware)
+    if settings.zarr_proxy_access_log:
+        application.add_middleware(AccessLogMiddleware)
 
     return application
 
@@ -20,6 +32,13 @@ app = create_application()
 async def startup_event():
     logger = get_logger()
     logger.info('Application startup...')
+    settings = get_settings()
+    if settings.zarr_proxy_warmup_datasets or settings.zarr_proxy_warmup_imports:
+        await warm_up(
+            settings.zarr_proxy_warmup_datasets,
+            import_modules=settings.zarr_proxy_warmup_imports,
+            logger=logger,
+        )
 
 
 @app.on_event('shutdown')
@@ -0,0 +1,305 @@
+"""Metrics of the zarr proxy, exposed in the Prometheus text format"""
+
+import contextlib
+import math
+import threading
+import time
+import typing
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(
+            name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        )
+        for name, value in labels.items()
+    )
+    return f'{{{pairs}}}'
+
+
+class Metric:
+    """A named metric with an optional set of labels.
+
+    Parameters
+    ----------
+    name: str
+        The name of the metric, e.g. "zarr_proxy_requests_total"
+    documentation: str
+        A one-line description of the metric
+    labelnames: tuple[str]
+        The names of the labels every sample of the metric has
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, *, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: dict[tuple[str, ...], typing.Any] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, typing.Any]) -> tuple[str, ...]:
+        if labels.keys() != set(self.labelnames):
+            raise ValueError(
+                f'{self.name} expects the labels {self.labelnames}, got {tuple(labels)}'
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self) -> typing.Iterator[tuple[str, dict[str, str], float]]:
+        with self._lock:
+            values = dict(self._values)
+        for key, value in values.items():
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+    def render(self) -> str:
+        """Return the metric in the Prometheus text exposition format."""
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(
+            f'{name}{_format_labels(labels)} {_format_value(value)}'
+            for name, labels, value in self._samples()
+        )
+        return '\n'.join(lines)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    """A value that only goes up, e.g. a number of requests."""
+
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """A value that goes up and down, e.g. a number of requests in flight."""
+
+    kind = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+class Histogram(Metric):
+    """The distribution of observed values, e.g. request durations in seconds.
+
+    Parameters
+    ----------
+    buckets: tuple[float]
+        The upper bounds of the buckets, in increasing order
+    """
+
+    kind = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        *,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames=labelnames)
+        self.buckets = (*buckets, math.inf)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0.0)
+            for index, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    counts[index] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels) -> typing.Iterator[None]:
+        """Observe the duration of the ``with`` block, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        counts, _ = self._values.get(self._key(labels)) or ([0], 0.0)
+        return sum(counts)
+
+    def _samples(self) -> typing.Iterator[tuple[str, dict[str, str], float]]:
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        for key, (counts, total) in values.items():
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield (
+                    f'{self.name}_bucket',
+                    {**labels, 'le': _format_value(upper_bound)},
+                    cumulative,
+                )
+            yield f'{self.name}_sum', labels, total
+            yield f'{self.name}_count', labels, cumulative
+
+
+class Registry:
+    """A collection of metrics rendered together."""
+
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f'A metric named {metric.name} is already registered')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Return all metrics in the Prometheus text exposition format."""
+        return '\n'.join(metric.render() for metric in self._metrics.values()) + '\n'
+
+    def clear(self) -> None:
+        for metric in self._metrics.values():
+            metric.clear()
+
+
+registry = Registry()
+
+requests_total = registry.register(
+    Counter(
+        'zarr_proxy_requests_total',
+        'Number of HTTP requests handled',
+        labelnames=('endpoint', 'method', 'status'),
+    )
+)
+request_duration = registry.register(
+    Histogram(
+        'zarr_proxy_request_duration_seconds',
+        'Time spent handling HTTP requests, until the last byte of the response is sent',
+        labelnames=('endpoint',),
+    )
+)
+requests_in_flight = registry.register(
+    Gauge('zarr_proxy_requests_in_flight', 'Number of HTTP requests being handled')
+)
+response_bytes = registry.register(
+    Counter(
+        'zarr_proxy_response_bytes_total',
+        'Number of bytes sent to clients',
+        labelnames=('endpoint',),
+    )
+)
+stage_duration = registry.register(
+    Histogram(
+        'zarr_proxy_stage_duration_seconds',
+        'Time spent in each stage of reading chunks: fetch, decode, slice, reduce and serialize',
+        labelnames=('stage',),
+    )
+)
+upstream_bytes = registry.register(
+    Counter('zarr_proxy_upstream_bytes_total', 'Number of bytes fetched from upstream stores')
+)
+upstream_requests_in_flight = registry.register(
+    Gauge('zarr_proxy_upstream_requests_in_flight', 'Number of upstream requests in flight')
+)
+upstream_requests_coalesced = registry.register(
+    Counter(
+        'zarr_proxy_upstream_requests_coalesced_total',
+        'Number of upstream requests answered by an identical request already in flight',
+    )
+)
+partial_reads = registry.register(
+    Counter(
+        'zarr_proxy_partial_reads_total',
+        'Number of uncompressed source chunks read in part with byte-range requests',
+    )
+)
+payload_limit_rejections = registry.register(
+    Counter(
+        'zarr_proxy_payload_limit_rejections_total',
+        'Number of chunks rejected for exceeding the payload size limit',
+    )
+)
+cache_hits = registry.register(
+    Gauge('zarr_proxy_cache_hits', 'Number of cache hits', labelnames=('cache',))
+)
+cache_misses = registry.register(
+    Gauge('zarr_proxy_cache_misses', 'Number of cache misses', labelnames=('cache',))
+)
+cache_hit_ratio = registry.register(
+    Gauge(
+        'zarr_proxy_cache_hit_ratio', 'Ratio of cache lookups that were hits', labelnames=('cache',)
+    )
+)
+cache_bytes = registry.register(
+    Gauge('zarr_proxy_cache_bytes', 'Size of the cached values in bytes', labelnames=('cache',))
+)
+
+
+class MetricsMiddleware:
+    """ASGI middleware counting and timing HTTP requests per endpoint.
+
+    Requests are labelled with the name of the endpoint function that handled them, which keeps the
+    number of label values bounded whatever paths clients request.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        status = 500
+        sent = 0
+
+        async def send_wrapper(message):
+            nonlocal status, sent
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                sent += len(message.get('body', b''))
+            await send(message)
+
+        requests_in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            requests_in_flight.dec()
+            endpoint = getattr(scope.get('endpoint'), '__name__', 'unmatched')
+            request_duration.observe(time.perf_counter() - start, endpoint=endpoint)
+            requests_total.inc(endpoint=endpoint, method=scope['method'], status=status)
+            response_bytes.inc(sent, endpoint=endpoint)
@@ -0,0 +1,301 @@
+"""Virtual multiscale pyramids of datasets, computed on demand by block reduction"""
+
+import functools
+import math
+import typing
+
+import numpy as np
+from fastapi import APIRouter, Depends, Header
+from starlette.responses import JSONResponse, Response
+
+from .cache import LRUCache
+from .config import Settings, get_settings
+from .exceptions import ZarrProxyHTTPException
+from .helpers import (
+    get_metadata_identity,
+    inflight_requests,
+    load_metadata_file_async,
+    open_store,
+)
+from .log import add_access_log_fields, get_logger
+from .logic import get_chunk_grid
+from .reader import as_buffer, level_cache, pad_chunk
+from .store import (
+    _translate_chunk_key_errors,
+    cache_headers,
+    check_payload_size,
+    not_modified,
+    open_source_array,
+)
+
+if typing.TYPE_CHECKING:
+    import zarr.storage
+
+router = APIRouter()
+logger = get_logger()
+
+# Each level halves the size of the spatial dimensions of the level before it
+LEVEL_FACTOR = 2
+
+# Pyramids and the spatial dimensions they coarsen, keyed by (store path, identity of the source
+# ``.zmetadata``, number of levels, payload size limit). A new version of the source metadata gets a new entry.
+pyramid_cache = LRUCache(maxsize=get_settings().zarr_proxy_metadata_cache_size)
+
+
+def _array_dimensions(zmetadata: dict, variable: str) -> typing.Optional[list[str]]:
+    zattrs = zmetadata['metadata'].get(f'{variable}/.zattrs', {})
+    return zattrs.get('_ARRAY_DIMENSIONS')
+
+
+def dataset_variables(zmetadata: dict) -> list[str]:
+    """Return the names of the arrays at the root of a consolidated dataset."""
+    return [
+        key[: -len('/.zarray')]
+        for key in zmetadata['metadata']
+        if key.endswith('/.zarray') and key.count('/') == 1
+    ]
+
+
+def spatial_dimensions(zmetadata: dict) -> set[str]:
+    """Return the dimensions coarsened by the pyramid: the last two of every 2+ dimensional array."""
+    dims = set()
+    for variable in dataset_variables(zmetadata):
+        variable_dims = _array_dimensions(zmetadata, variable)
+        if variable_dims is not None and len(variable_dims) >= 2:
+            dims.update(variable_dims[-2:])
+    return dims
+
+
+def level_factors(
+    zmetadata: dict, variable: str, level: int, *, spatial: typing.Optional[set[str]] = None
+) -> tuple[int, ...]:
+    """Return the reduction factor of each dimension of an array at a level of the pyramid.
+
+    ``spatial`` is the result of ``spatial_dimensions``, computed from ``zmetadata`` if not given.
+    """
+    ndim = len(zmetadata['metadata'][f'{variable}/.zarray']['shape'])
+    dims = _array_dimensions(zmetadata, variable)
+    if dims is None:
+        # without dimension names, the last two dimensions are assumed to be spatial
+        coarsened = [index >= ndim - 2 and ndim >= 2 for index in range(ndim)]
+    else:
+        if spatial is None:
+            spatial = spatial_dimensions(zmetadata)
+        coarsened = [dim in spatial for dim in dims]
+    return tuple(LEVEL_FACTOR**level if flag else 1 for flag in coarsened)
+
+
+def fit_chunks(chunks: list[int], *, itemsize: int, max_nbytes: int) -> list[int]:
+    """Return ``chunks`` with their largest dimensions halved until a chunk fits in ``max_nbytes``."""
+    chunks = list(chunks)
+    while math.prod(chunks) * itemsize > max_nbytes and max(chunks) > 1:
+        dim = chunks.index(max(chunks))
+        chunks[dim] = math.ceil(chunks[dim] / 2)
+    return chunks
+
+
+def level_zarray(
+    zarray: dict, factors: tuple[int, ...], *, max_nbytes: typing.Optional[int] = None
+) -> typing.Optional[dict]:
+    """Return the ``.zarray`` of an array reduced by ``factors``, or ``None`` if it can't be.
+
+    The level keeps the chunks of the source array, made smaller if needed for its chunks to fit in
+    ``max_nbytes``.
+    """
+    dtype = np.dtype(zarray['dtype']) if isinstance(zarray['dtype'], str) else None
+    if dtype is None or dtype.hasobject:
+        # levels are served uncompressed and unfiltered, which variable-length types can't be
+        return None
+    if all(factor == 1 for factor in factors):
+        level_dtype, fill_value = zarray['dtype'], zarray['fill_value']
+    elif dtype.kind in 'biuf':
+        # reduced arrays hold means, see ``block_mean``
+        level_dtype = dtype.str if dtype.kind == 'f' else '<f8'
+        fill_value = 'NaN'
+    else:
+        return None
+    shape = [math.ceil(size / factor) for size, factor in zip(zarray['shape'], factors)]
+    chunks = [min(chunk, max(size, 1)) for chunk, size in zip(zarray['chunks'], shape)]
+    if max_nbytes and chunks:
+        chunks = fit_chunks(chunks, itemsize=np.dtype(level_dtype).itemsize, max_nbytes=max_nbytes)
+    return {
+        **zarray,
+        'shape': shape,
+        'chunks': chunks,
+        'dtype': level_dtype,
+        'fill_value': fill_value,
+        'order': 'C',
+        'compressor': None,
+        'filters': None,
+        'dimension_separator': '.',
+    }
+
+
+def pyramid_zmetadata(
+    zmetadata: dict, *, levels: int, max_nbytes: typing.Optional[int] = None
+) -> dict:
+    """Return the consolidated metadata of the virtual multiscale group of a dataset.
+
+    Level ``n`` is a group holding every array of the dataset, with its spatial dimensions
+    reduced by ``2 ** n``. Arrays that cannot be averaged (e.g. strings) are left out of the
+    levels in which they would be reduced. The root ``.zattrs`` lists the levels under the
+    ``multiscales`` key. Chunks of the levels are at most ``max_nbytes``, see ``level_zarray``.
+    """
+    source = zmetadata['metadata']
+    spatial = spatial_dimensions(zmetadata)
+    variables = dataset_variables(zmetadata)
+    metadata = {
+        '.zgroup': {'zarr_format': 2},
+        '.zattrs': {
+            **source.get('.zattrs', {}),
+            'multiscales': [
+                {
+                    'datasets': [
+                        {'path': str(level), 'level': level, 'factor': LEVEL_FACTOR**level}
+                        for level in range(levels)
+                    ],
+                    'type': 'mean',
+                    'metadata': {'spatial_dimensions': sorted(spatial)},
+                }
+            ],
+        },
+    }
+    for level in range(levels):
+        metadata[f'{level}/.zgroup'] = {'zarr_format': 2}
+        metadata[f'{level}/.zattrs'] = {}
+        for variable in variables:
+            zarray = level_zarray(
+                source[f'{variable}/.zarray'],
+                level_factors(zmetadata, variable, level, spatial=spatial),
+                max_nbytes=max_nbytes,
+            )
+            if zarray is None:
+                continue
+            metadata[f'{level}/{variable}/.zarray'] = zarray
+            metadata[f'{level}/{variable}/.zattrs'] = source.get(f'{variable}/.zattrs', {})
+    return {'zarr_consolidated_format': 1, 'metadata': metadata}
+
+
+def _get_pyramid(
+    *, store: 'zarr.storage.FSStore', source: dict, levels: int, max_nbytes: int
+) -> tuple[dict, set[str]]:
+    """Return the pyramid of the loaded source ``.zmetadata`` of a store and its spatial dimensions.
+
+    Pyramids are built once per version of the source metadata, see ``pyramid_cache``.
+    """
+    identity = get_metadata_identity(store=store, key='.zmetadata')
+    cache_key = (store.path, identity, levels, max_nbytes)
+    pyramid = pyramid_cache.get(cache_key) if identity is not None else None
+    if pyramid is None:
+        zmetadata = pyramid_zmetadata(source, levels=levels, max_nbytes=max_nbytes)
+        pyramid = zmetadata, spatial_dimensions(source)
+        if identity is not None:
+            pyramid_cache.set(cache_key, pyramid)
+    return pyramid
+
+
+async def _read_level_chunk(
+    *,
+    host: str,
+    path: str,
+    source_slice: tuple[slice, ...],
+    factors: tuple[int, ...],
+    zarray: dict,
+) -> np.ndarray:
+    _, arr = await open_source_array(host=host, path=path)
+    if all(factor == 1 for factor in factors):
+        data = await arr.read(source_slice)
+    else:
+        data = await arr.read_block_mean(
+            source_slice, factors, band_nbytes=get_settings().zarr_proxy_streaming_threshold
+        )
+    # zarr clients expect the chunks at the edges of the array to be padded to the full chunk shape
+    fill_value = zarray['fill_value']
+    return pad_chunk(
+        data.astype(zarray['dtype'], copy=False),
+        tuple(zarray['chunks']),
+        fill_value=np.nan if fill_value == 'NaN' else fill_value,
+    )
+
+
+@router.get('/{host}/{path:path}/.multiscales/{key:path}')
+async def get_multiscales(
+    host: str,
+    path: str,
+    key: str,
+    if_none_match: typing.Optional[str] = Header(default=None),
+    settings: Settings = Depends(get_settings),
+) -> Response:
+    """Return a metadata document or a chunk of the virtual multiscale group of a dataset.
+
+    The group lives at ``/{host}/{path}/.multiscales`` and can be opened by any zarr client
+    supporting consolidated metadata. Chunks of a level are computed on first use by averaging
+    blocks of the source array, and kept in ``level_cache``.
+    """
+    store = open_store(host=host, path=path, logger=logger)
+    # the source metadata is only read, and the pyramid is built once per version of it
+    source = await load_metadata_file_async(
+        store=store, key='.zmetadata', logger=logger, readonly=True
+    )
+    levels = settings.zarr_proxy_multiscales_levels
+    max_nbytes = settings.zarr_proxy_payload_size_limit
+    zmetadata, spatial = _get_pyramid(
+        store=store, source=source, levels=levels, max_nbytes=max_nbytes
+    )
+    headers = cache_headers(
+        store=store,
+        key='.zmetadata',
+        settings=settings,
+        variant=('multiscales', levels, max_nbytes, key),
+    )
+    if cached := not_modified(if_none_match, headers):
+        return cached
+
+    if key == '.zmetadata':
+        return JSONResponse(zmetadata, headers=headers)
+    if key in zmetadata['metadata']:
+        return JSONResponse(zmetadata['metadata'][key], headers=headers)
+
+    array_path, _, chunk_key = key.rpartition('/')
+    zarray = zmetadata['metadata'].get(f'{array_path}/.zarray')
+    if zarray is None or chunk_key.startswith('.'):
+        raise ZarrProxyHTTPException(
+            status_code=404, message=f'{key} not found in the multiscales of {store.path}'
+        )
+    level, _, variable = array_path.partition('/')
+    add_access_log_fields(level=level, variable=variable, chunk_key=chunk_key)
+
+    grid = get_chunk_grid(shape=tuple(zarray['shape']), chunks=tuple(zarray['chunks']))
+    with _translate_chunk_key_errors():
+        level_slice = grid.chunk_slice(grid.parse_key(chunk_key))
+    check_payload_size(
+        math.prod(zarray['chunks']) * np.dtype(zarray['dtype']).itemsize,
+        variable_chunks=tuple(zarray['chunks']),
+        settings=settings,
+    )
+
+    identity = get_metadata_identity(store=store, key='.zmetadata')
+    cache_key = (store.path, identity, levels, max_nbytes, array_path, chunk_key)
+    data = level_cache.get(cache_key)
+    if data is None:
+        factors = level_factors(source, variable, int(level), spatial=spatial)
+        source_shape = source['metadata'][f'{variable}/.zarray']['shape']
+        source_slice = tuple(
+            slice(s.start * factor, min(s.stop * factor, size))
+            for s, factor, size in zip(level_slice, factors, source_shape)
+        )
+        data = await inflight_requests.do(
+            ('multiscales', *cache_key),
+            functools.partial(
+                _read_level_chunk,
+                host=host,
+                path=f'{path}/{variable}',
+                source_slice=source_slice,
+                factors=factors,
+                zarray=zarray,
+            ),
+        )
+        # level chunks are shared between requests
+        data.flags.writeable = False
+        level_cache.set(cache_key, data)
+    return Response(as_buffer(data), media_type='application/octet-stream', headers=headers)
@@ -0,0 +1,106 @@
+"""Read ahead the chunks that clients are likely to request next"""
+
+import asyncio
+import typing
+
+from .cache import LRUCache
+from .config import get_settings
+from .log import get_logger
+from .logic import ChunkGrid
+from .reader import SourceArray, prefetch_buffer
+
+logger = get_logger()
+settings = get_settings()
+
+
+class Prefetcher:
+    """Detect strided access to the chunks of an array and read the next chunks in the background.
+
+    Clients panning a map or stepping through time request chunks in a predictable order, e.g.
+    incrementing the last index of the chunk key. For every array and virtual chunking, the
+    prefetcher remembers the last requested chunk and the step from the chunk before it. When two
+    consecutive requests move by the same step, the source chunks of the next ``depth`` chunks
+    along that step are read into ``prefetch_buffer``.
+
+    Parameters
+    ----------
+    depth: int
+        The number of chunks to read ahead. 0 disables prefetching.
+    concurrency: int
+        The maximum number of source chunks being prefetched at once. Further chunks are skipped
+        rather than queued, so prefetching never holds up requests.
+    history_size: int
+        The number of (array, chunking) access patterns to remember.
+    """
+
+    def __init__(self, *, depth: int, concurrency: int, history_size: int = 1024):
+        self.depth = depth
+        self.concurrency = concurrency
+        self._history = LRUCache(maxsize=history_size)
+        self._pending: dict[tuple[str, tuple[int, ...]], asyncio.Task] = {}
+        self.scheduled = 0
+        self.skipped = 0
+
+    def observe(self, arr: SourceArray, grid: ChunkGrid, chunk_index: tuple[int, ...]) -> None:
+        """Record a request for a chunk and start prefetching if a stride is detected."""
+        if self.depth <= 0 or not chunk_index:
+            return
+        history_key = (arr.store.path, grid.chunks)
+        previous = self._history.peek(history_key)
+        stride = (
+            tuple(index - last for index, last in zip(chunk_index, previous[0]))
+            if previous is not None
+            else None
+        )
+        self._history.set(history_key, (chunk_index, stride))
+        if previous is None or stride != previous[1] or not any(stride):
+            return
+
+        for step in range(1, self.depth + 1):
+            next_index = tuple(index + step * delta for index, delta in zip(chunk_index, stride))
+            if not all(
+                0 <= index < size for index, size in zip(next_index, grid.chunks_block_shape)
+            ):
+                break
+            for source_index, _, _ in grid.selections(next_index):
+                self._schedule(arr, source_index)
+
+    def _schedule(self, arr: SourceArray, source_index: tuple[int, ...]) -> None:
+        key = (arr.store.path, source_index)
+        if key in self._pending:
+            return
+        if len(self._pending) >= self.concurrency:
+            self.skipped += 1
+            return
+        self.scheduled += 1
+        task = asyncio.ensure_future(self._prefetch(arr, source_index))
+        self._pending[key] = task
+        task.add_done_callback(lambda _: self._pending.pop(key, None))
+
+    @staticmethod
+    async def _prefetch(arr: SourceArray, source_index: tuple[int, ...]) -> None:
+        try:
+            await arr.prefetch_chunk(source_index)
+        except Exception as exc:
+            # prefetching is best effort, the chunk will be read again if it is requested
+            logger.debug('Failed to prefetch chunk %s of %s: %s', source_index, arr.store.path, exc)
+
+    def clear(self) -> None:
+        """Forget the access patterns and reset the counters."""
+        self._history.clear()
+        self.scheduled = self.skipped = 0
+
+    def stats(self) -> dict[str, typing.Any]:
+        """Return the counters, e.g. for the health endpoint."""
+        return {
+            'depth': self.depth,
+            'inflight': len(self._pending),
+            'scheduled': self.scheduled,
+            'skipped': self.skipped,
+            'buffer': prefetch_buffer.stats(),
+        }
+
+
+prefetcher = Prefetcher(
+    depth=settings.zarr_proxy_prefetch_depth, concurrency=settings.zarr_proxy_prefetch_concurrency
+)
@@ -0,0 +1,554 @@
+"""Read regions of upstream arrays by fetching only the source chunks they intersect"""
+
+import asyncio
+import collections
+import concurrent.futures
+import math
+import typing
+
+import numpy as np
+
+from .cache import LRUCache
+from .config import get_settings
+from .helpers import fetch_bytes, fetch_chunk_bytes, get_metadata_identity
+from .logic import (
+    BLOSC_SHUFFLES,
+    chunk_byte_ranges,
+    chunk_key_encoding_v3,
+    chunk_shape_v3,
+    merge_byte_ranges,
+    parse_codecs_v3,
+    source_chunk_key,
+    source_chunk_selections,
+)
+from .metrics import partial_reads, stage_duration
+
+if typing.TYPE_CHECKING:
+    # imported on first use, see ``helpers``
+    import numcodecs.abc
+    import zarr.storage
+
+settings = get_settings()
+
+# Decoding, copying and encoding are CPU bound. They run on a dedicated pool so they neither block
+# the event loop nor compete with Starlette's threadpool; numcodecs releases the GIL while
+# (de)compressing.
+codec_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=settings.zarr_proxy_codec_workers, thread_name_prefix='zarr-proxy-codec'
+)
+
+# Decoded source chunks shared by all requests, keyed by (store path, metadata identity, source
+# chunk key), see ``SourceArray.cache_key``. The store path identifies both the dataset and the
+# variable, and the identity of its metadata the version of the array.
+chunk_cache = LRUCache(
+    maxbytes=settings.zarr_proxy_chunk_cache_size,
+    ttl=settings.zarr_proxy_chunk_cache_ttl,
+    sizeof=lambda chunk: chunk.nbytes,
+)
+# Decoded source chunks read ahead of time by the prefetcher, kept apart from ``chunk_cache`` so
+# that speculative reads never evict chunks that were actually requested. Chunks move to
+# ``chunk_cache`` on their first use.
+prefetch_buffer = LRUCache(
+    maxbytes=settings.zarr_proxy_prefetch_buffer_size,
+    ttl=settings.zarr_proxy_chunk_cache_ttl,
+    sizeof=lambda chunk: chunk.nbytes,
+)
+# Chunks of the levels of virtual multiscale pyramids, keyed by (store path, identity of the source
+# ``.zmetadata``, number of levels, payload size limit, level path, chunk key)
+level_cache = LRUCache(
+    maxbytes=settings.zarr_proxy_multiscales_cache_size,
+    ttl=settings.zarr_proxy_chunk_cache_ttl,
+    sizeof=lambda chunk: chunk.nbytes,
+)
+
+# Offset and size of the chunks missing from a Zarr v3 shard, in the index of the shard
+EMPTY_SHARD_CHUNK = 2**64 - 1
+
+
+class SourceArray:
+    """An upstream array described by its ``.zarray`` metadata, or its Zarr v3 ``zarr.json``.
+
+    Parameters
+    ----------
+    store: zarr.storage.FSStore
+        The store holding the array.
+    zarray: dict
+        The ``.zarray`` or ``zarr.json`` metadata of the array.
+    """
+
+    def __init__(self, *, store: 'zarr.storage.FSStore', zarray: dict):
+        self.store = store
+        # the version of the metadata the array was opened with, if it came from the metadata cache
+        self.identity = get_metadata_identity(
+            store=store, key='zarr.json' if zarray.get('zarr_format') == 3 else '.zarray'
+        )
+        # the prefix of the chunk keys, and the shape of the shards of sharded (v3) arrays
+        self.key_prefix = ''
+        self.shards = None
+        if zarray.get('zarr_format') == 3:
+            self._init_v3(zarray)
+        else:
+            self._init_v2(zarray)
+        # chunks stored as raw bytes can be read in part with byte-range requests
+        self.byte_addressable = (
+            self.compressor is None
+            and not self.filters
+            and self.shards is None
+            and not self.dtype.hasobject
+        )
+
+    def _init_v2(self, zarray: dict) -> None:
+        import zarr.meta
+
+        meta = zarr.meta.Metadata2.decode_array_metadata(zarray)
+        self.shape = meta['shape']
+        self.chunks = meta['chunks']
+        self.dtype = meta['dtype']
+        self.order = meta['order']
+        self.fill_value = meta['fill_value']
+        self.dimension_separator = meta.get('dimension_separator', '.')
+        self.compressor = get_codec(meta['compressor']) if meta['compressor'] else None
+        self.filters = [get_codec(config) for config in meta['filters'] or []]
+
+    def _init_v3(self, metadata: dict) -> None:
+        if metadata.get('node_type', 'array') != 'array':
+            raise ValueError(f'Not an array: {self.store.path}')
+        self.shape = tuple(metadata['shape'])
+        self.chunks = chunk_shape_v3(metadata)
+        self.key_prefix, self.dimension_separator = chunk_key_encoding_v3(metadata)
+        parts = parse_codecs_v3(metadata['codecs'])
+        sharding = parts['sharding']
+        if sharding is not None:
+            self.shards = tuple(metadata['chunk_grid']['configuration']['chunk_shape'])
+            if any(shard % chunk for shard, chunk in zip(self.shards, self.chunks)):
+                raise ValueError(f'Shards {self.shards} are not made of chunks {self.chunks}')
+            parts = parse_codecs_v3(sharding['codecs'])
+            index = parse_codecs_v3(sharding.get('index_codecs', ['bytes', 'crc32c']))
+            if parts['sharding'] is not None or index['sharding'] is not None:
+                raise ValueError('Nested sharding is not supported')
+            if any(codec['name'] != 'crc32c' for codec in index['codecs']):
+                raise ValueError(f'Unsupported shard index codecs: {index["codecs"]}')
+            self.index_location = sharding.get('index_location', 'end')
+            self.index_dtype = np.dtype('>u8' if index['endian'] == 'big' else '<u8')
+            self.index_checksum = bool(index['codecs'])
+        try:
+            dtype = np.dtype(metadata['data_type'])
+        except TypeError as exc:
+            raise ValueError(f'Unsupported data type: {metadata["data_type"]}') from exc
+        if parts['endian'] is not None:
+            dtype = dtype.newbyteorder('<' if parts['endian'] == 'little' else '>')
+        self.dtype = dtype
+        self.order = parts['order']
+        self.fill_value = fill_value_v3(metadata['fill_value'], dtype=dtype)
+        # bytes-to-bytes codecs, decoded in reverse order like v2 filters
+        self.compressor = None
+        self.filters = [get_codec_v3(codec) for codec in parts['codecs']]
+
+    def chunk_key(self, chunk_index: tuple[int, ...]) -> str:
+        """Return the key of a source chunk, e.g. (1, 3) -> "1.3" or "c/1/3"."""
+        return source_chunk_key(
+            chunk_index, delimiter=self.dimension_separator, prefix=self.key_prefix
+        )
+
+    def cache_key(self, key: str) -> tuple:
+        """Return the key of a source chunk in ``chunk_cache`` and ``prefetch_buffer``.
+
+        Chunks cached for a previous version of the array's metadata are not reused.
+        """
+        return (self.store.path, self.identity, key)
+
+    async def _read_shard_index(self, shard_key: str, chunks_per_shard: tuple[int, ...]):
+        """Return the (offset, nbytes) of every chunk of a shard, read with one range request."""
+        cache_key = (*self.cache_key(shard_key), 'index')
+        index = chunk_cache.get(cache_key)
+        if index is None:
+            size = math.prod(chunks_per_shard) * 16
+            nbytes = size + 4 * self.index_checksum
+            if self.index_location == 'start':
+                raw = await fetch_bytes(store=self.store, key=shard_key, start=0, end=nbytes)
+                raw = raw[:nbytes]
+            else:
+                raw = await fetch_bytes(store=self.store, key=shard_key, start=-nbytes)
+                # the upstream may ignore the Range header and send the whole shard
+                raw = raw[-nbytes:]
+            # the checksum is not verified, as the chunks themselves aren't
+            index = np.frombuffer(raw[:size], dtype=self.index_dtype)
+            index = index.reshape(*chunks_per_shard, 2)
+            chunk_cache.set(cache_key, index)
+        return index
+
+    async def fetch_chunk(self, chunk_index: tuple[int, ...]) -> bytes:
+        """Fetch the encoded bytes of a source chunk.
+
+        The chunks of sharded arrays are read with a range request, after the index of their
+        shard, so only the chunks needed are transferred.
+
+        Raises
+        ------
+        KeyError
+            If the chunk does not exist upstream.
+        """
+        if self.shards is None:
+            return await fetch_chunk_bytes(
+                store=self.store, key=self.chunk_key(chunk_index), identity=self.identity
+            )
+        chunks_per_shard = tuple(shard // chunk for shard, chunk in zip(self.shards, self.chunks))
+        shard_index = tuple(index // count for index, count in zip(chunk_index, chunks_per_shard))
+        position = tuple(index % count for index, count in zip(chunk_index, chunks_per_shard))
+        shard_key = self.chunk_key(shard_index)
+        offsets = await self._read_shard_index(shard_key, chunks_per_shard)
+        offset, nbytes = map(int, offsets[position])
+        if offset == nbytes == EMPTY_SHARD_CHUNK:
+            raise KeyError(self.chunk_key(chunk_index))
+        raw = await fetch_bytes(store=self.store, key=shard_key, start=offset, end=offset + nbytes)
+        if len(raw) != nbytes:
+            # the upstream ignored the Range header and sent the whole shard
+            raw = raw[offset : offset + nbytes]
+        return raw
+
+    def nbytes(self, data_slice: tuple[slice, ...]) -> int:
+        """Return the size in bytes of the given region."""
+        return math.prod(region_shape(data_slice)) * self.dtype.itemsize
+
+    def source_nbytes(self, data_slice: tuple[slice, ...]) -> int:
+        """Return the decoded size of the source chunks holding an element of the given region."""
+        counts = []
+        for s, chunk in zip(data_slice, self.chunks):
+            step = s.step or 1
+            if s.stop <= s.start:
+                return 0
+            last = s.start + (s.stop - s.start - 1) // step * step
+            # steps of a chunk or more select each chunk at most once, smaller ones skip none
+            counts.append(
+                len(range(s.start, s.stop, step))
+                if step >= chunk
+                else last // chunk - s.start // chunk + 1
+            )
+        return math.prod(counts) * math.prod(self.chunks) * self.dtype.itemsize
+
+    def decode_chunk(self, raw: bytes) -> np.ndarray:
+        """Decompress and unfilter the bytes of a source chunk."""
+        from numcodecs.compat import ensure_ndarray_like
+
+        chunk = self.compressor.decode(raw) if self.compressor else raw
+        for codec in reversed(self.filters):
+            chunk = codec.decode(chunk)
+        chunk = ensure_ndarray_like(chunk)
+        if not self.dtype.hasobject:
+            chunk = chunk.view(self.dtype)
+        return chunk.reshape(self.chunks, order=self.order)
+
+    @staticmethod
+    def _copy_into(chunk, targets) -> None:
+        with stage_duration.time(stage='slice'):
+            for out, chunk_selection, out_selection in targets:
+                out[out_selection] = chunk[chunk_selection]
+
+    def _decode_into(self, raw, targets) -> np.ndarray:
+        with stage_duration.time(stage='decode'):
+            chunk = self.decode_chunk(raw)
+        # cached chunks are shared between requests
+        chunk.flags.writeable = False
+        self._copy_into(chunk, targets)
+        return chunk
+
+    def plan_byte_ranges(self, targets) -> typing.Optional[list[tuple[int, int]]]:
+        """Return the byte ranges of a source chunk holding the selections of ``targets``.
+
+        None is returned when the whole chunk should be read instead: when the chunk is
+        compressed, or when the ranges would cover too much of it or take too many requests.
+        """
+        settings = get_settings()
+        if not self.byte_addressable or settings.zarr_proxy_partial_read_ratio <= 0:
+            return None
+        max_ranges = settings.zarr_proxy_partial_read_max_ranges
+        runs = []
+        for _, chunk_selection, _ in targets:
+            chunk_runs = chunk_byte_ranges(
+                chunk_selection,
+                chunks=self.chunks,
+                itemsize=self.dtype.itemsize,
+                order=self.order,
+                # runs closer than the gap are merged, so there may be more runs than ranges
+                limit=max_ranges * 64,
+            )
+            if chunk_runs is None:
+                return None
+            runs.append(chunk_runs)
+        ranges = merge_byte_ranges(np.concatenate(runs), gap=settings.zarr_proxy_partial_read_gap)
+        chunk_nbytes = math.prod(self.chunks) * self.dtype.itemsize
+        if (
+            len(ranges) > max_ranges
+            or sum(stop - start for start, stop in ranges)
+            >= settings.zarr_proxy_partial_read_ratio * chunk_nbytes
+        ):
+            return None
+        return ranges
+
+    def _fill(self, targets) -> None:
+        # missing chunks are read as the fill value, like zarr does
+        if self.fill_value is not None:
+            for out, _, out_selection in targets:
+                out[out_selection] = self.fill_value
+
+    async def _read_ranges_into(self, semaphore, key, ranges, targets) -> None:
+        """Read byte ranges of an uncompressed source chunk and copy them into ``targets``."""
+
+        async def fetch(start, stop):
+            async with semaphore:
+                return await fetch_bytes(store=self.store, key=key, start=start, end=stop)
+
+        try:
+            with stage_duration.time(stage='fetch'):
+                parts = await asyncio.gather(*(fetch(start, stop) for start, stop in ranges))
+        except KeyError:
+            self._fill(targets)
+            return
+        partial_reads.inc()
+
+        # only the bytes of the ranges are set, which are the only ones the targets read
+        buffer = np.empty(math.prod(self.chunks) * self.dtype.itemsize, dtype=np.uint8)
+        for (start, stop), part in zip(ranges, parts):
+            if len(part) == len(buffer) and len(part) != stop - start:
+                # the upstream ignored the Range header and sent the whole chunk
+                buffer = np.frombuffer(part, dtype=np.uint8)
+                break
+            buffer[start:stop] = np.frombuffer(part, dtype=np.uint8)
+        chunk = buffer.view(self.dtype).reshape(self.chunks, order=self.order)
+        await asyncio.get_running_loop().run_in_executor(
+            codec_executor, self._copy_into, chunk, targets
+        )
+
+    async def _read_chunk_into(self, semaphore, chunk_index, targets) -> None:
+        """Read one source chunk and copy it into every ``(out, chunk_selection, out_selection)``."""
+        key = self.chunk_key(chunk_index)
+        loop = asyncio.get_running_loop()
+        cache_key = self.cache_key(key)
+        chunk = chunk_cache.get(cache_key)
+        if chunk is None and prefetch_buffer.get(cache_key) is not None:
+            chunk = prefetch_buffer.pop(cache_key)
+            chunk_cache.set(cache_key, chunk)
+        if chunk is not None:
+            await loop.run_in_executor(codec_executor, self._copy_into, chunk, targets)
+            return
+
+        ranges = self.plan_byte_ranges(targets)
+        if ranges is not None:
+            await self._read_ranges_into(semaphore, key, ranges, targets)
+            return
+
+        try:
+            async with semaphore:
+                with stage_duration.time(stage='fetch'):
+                    raw = await self.fetch_chunk(chunk_index)
+        except KeyError:
+            self._fill(targets)
+            return
+        chunk = await loop.run_in_executor(codec_executor, self._decode_into, raw, targets)
+        chunk_cache.set(cache_key, chunk)
+
+    async def prefetch_chunk(self, chunk_index: tuple[int, ...]) -> None:
+        """Read a source chunk into ``prefetch_buffer`` unless it is already cached."""
+        cache_key = self.cache_key(self.chunk_key(chunk_index))
+        if cache_key in chunk_cache or cache_key in prefetch_buffer:
+            return
+        try:
+            raw = await self.fetch_chunk(chunk_index)
+        except KeyError:
+            return
+        chunk = await asyncio.get_running_loop().run_in_executor(
+            codec_executor, self._decode_into, raw, []
+        )
+        prefetch_buffer.set(cache_key, chunk)
+
+    async def read_many(self, data_slices: list[tuple[slice, ...]]) -> list[np.ndarray]:
+        """Read several regions of the array.
+
+        The source chunks intersecting any of the regions are planned together, so a source chunk
+        shared by several regions is fetched and decoded only once. Source chunks found in
+        ``chunk_cache`` are reused, the others are fetched concurrently (at most
+        ``zarr_proxy_fetch_concurrency`` at a time) and each one is decoded on the codec executor
+        as soon as it arrives, so the latency of a read is that of the slowest source chunk rather
+        than the sum over all of them.
+        """
+        outs = [np.empty(region_shape(data_slice), dtype=self.dtype) for data_slice in data_slices]
+        plan = collections.defaultdict(list)
+        for out, data_slice in zip(outs, data_slices):
+            for chunk_index, chunk_selection, out_selection in source_chunk_selections(
+                data_slice, source_chunks=self.chunks
+            ):
+                plan[chunk_index].append((out, chunk_selection, out_selection))
+
+        semaphore = asyncio.Semaphore(get_settings().zarr_proxy_fetch_concurrency)
+        await asyncio.gather(
+            *(
+                self._read_chunk_into(semaphore, chunk_index, targets)
+                for chunk_index, targets in plan.items()
+            )
+        )
+        return outs
+
+    async def read(self, data_slice: tuple[slice, ...]) -> np.ndarray:
+        """Read a region of the array, see ``read_many``."""
+        (out,) = await self.read_many([data_slice])
+        return out
+
+    async def read_block_mean(
+        self, data_slice: tuple[slice, ...], factors: tuple[int, ...], *, band_nbytes: int
+    ) -> np.ndarray:
+        """Read a region of the array reduced by the mean of ``factors``-sized blocks.
+
+        Blocks at the end of a dimension may be smaller than the factor, and NaNs are ignored.
+        The region is read in bands along the first dimension, each a multiple of the first
+        factor and at most about ``band_nbytes`` large, so memory stays bounded.
+        """
+        if not data_slice:
+            return block_mean(await self.read(data_slice), factors)
+        rows, rest = data_slice[0], data_slice[1:]
+        row_nbytes = self.nbytes((slice(0, 1), *rest))
+        band_rows = factors[0] * max(1, band_nbytes // (factors[0] * row_nbytes))
+        bands = []
+        for start in range(rows.start, rows.stop, band_rows):
+            band = await self.read((slice(start, min(start + band_rows, rows.stop)), *rest))
+            bands.append(
+                await asyncio.get_running_loop().run_in_executor(
+                    codec_executor, block_mean, band, factors
+                )
+            )
+        return np.concatenate(bands) if len(bands) > 1 else bands[0]
+
+    async def iter_slabs(self, data_slice: tuple[slice, ...]) -> typing.AsyncIterator[np.ndarray]:
+        """Read a region of the array as consecutive slabs along the first dimension.
+
+        Each slab covers the rows of one source chunk, so concatenating the slabs gives the region
+        in C order. The next slab is read while the current one is being consumed, which bounds the
+        memory used to about two slabs regardless of the size of the region.
+        """
+        if not data_slice:
+            yield await self.read(data_slice)
+            return
+
+        rows, rest = data_slice[0], data_slice[1:]
+        size = self.chunks[0]
+        slab_slices = [
+            (slice(max(rows.start, index * size), min(rows.stop, (index + 1) * size)), *rest)
+            for index in range(rows.start // size, math.ceil(rows.stop / size))
+        ]
+        pending = None
+        try:
+            for index, slab_slice in enumerate(slab_slices):
+                slab = await (pending or self.read(slab_slice))
+                pending = (
+                    asyncio.ensure_future(self.read(slab_slices[index + 1]))
+                    if index + 1 < len(slab_slices)
+                    else None
+                )
+                yield slab
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+
+def get_codec(config: dict) -> 'numcodecs.abc.Codec':
+    """Return the codec described by ``config``, e.g. ``{'id': 'zlib', 'level': 1}``."""
+    import numcodecs
+
+    return numcodecs.get_codec(config)
+
+
+class CRC32C:
+    """Decoder of the crc32c codec of Zarr v3, which drops the checksum ending a chunk.
+
+    The checksum is not verified: numcodecs only ships a CRC32C codec from version 0.16.
+    """
+
+    def decode(self, buf, out=None):
+        return memoryview(buf)[:-4]
+
+
+def get_codec_v3(codec: dict) -> typing.Union['numcodecs.abc.Codec', CRC32C]:
+    """Return the numcodecs codec of a bytes-to-bytes codec of Zarr v3, e.g. ``{'name': 'zstd'}``."""
+    name, configuration = codec['name'], dict(codec.get('configuration', {}))
+    if name == 'crc32c':
+        return CRC32C()
+    if name.startswith('numcodecs.'):
+        return get_codec({'id': name[len('numcodecs.') :], **configuration})
+    if name == 'zstd':
+        configuration.pop('checksum', None)
+    elif name == 'blosc':
+        configuration.pop('typesize', None)
+        shuffle = configuration.get('shuffle', 'noshuffle')
+        configuration['shuffle'] = (
+            BLOSC_SHUFFLES.index(shuffle) if isinstance(shuffle, str) else shuffle
+        )
+    return get_codec({'id': name, **configuration})
+
+
+def fill_value_v3(value, *, dtype: np.dtype):
+    """Return the fill value of a Zarr v3 array as a scalar of ``dtype``."""
+    if value is None:
+        return None
+    if isinstance(value, list) and dtype.kind == 'c':
+        return np.array(
+            complex(*(fill_value_v3(part, dtype=np.dtype('f8')) for part in value)), dtype=dtype
+        )[()]
+    if isinstance(value, str) and value.startswith('0x'):
+        # the bytes of the fill value, in big-endian order
+        (value,) = np.frombuffer(bytes.fromhex(value[2:]), dtype=dtype.newbyteorder('>'))
+        return value.astype(dtype)
+    if isinstance(value, str):
+        # "NaN", "Infinity" and "-Infinity" are accepted by float
+        value = float(value)
+    return np.array(value, dtype=dtype)[()]
+
+
+def region_shape(data_slice: tuple[slice, ...]) -> tuple[int, ...]:
+    """Return the shape of a region, taking the step of its slices into account."""
+    return tuple(len(range(s.start, s.stop, s.step or 1)) for s in data_slice)
+
+
+def pad_chunk(data: np.ndarray, chunk_shape: tuple[int, ...], *, fill_value) -> np.ndarray:
+    """Return ``data`` padded with ``fill_value`` to ``chunk_shape``, like zarr stores the chunks
+    at the edges of an array."""
+    if data.shape == tuple(chunk_shape):
+        return data
+    chunk = np.full(chunk_shape, 0 if fill_value is None else fill_value, dtype=data.dtype)
+    chunk[tuple(slice(0, size) for size in data.shape)] = data
+    return chunk
+
+
+def block_mean(data: np.ndarray, factors: tuple[int, ...]) -> np.ndarray:
+    """Reduce an array by the mean of ``factors``-sized blocks, ignoring NaNs.
+
+    Blocks at the end of a dimension may be smaller than the factor. Floating point arrays keep
+    their dtype, other arrays are reduced to float64.
+    """
+    dtype = data.dtype if data.dtype.kind == 'f' else np.dtype('f8')
+    with stage_duration.time(stage='reduce'):
+        values = data.astype('f8')
+        valid = ~np.isnan(values)
+        values[~valid] = 0
+        counts = valid.astype('f8')
+        for axis, factor in enumerate(factors):
+            if factor == 1:
+                continue
+            starts = np.arange(0, data.shape[axis], factor)
+            values = np.add.reduceat(values, starts, axis=axis)
+            counts = np.add.reduceat(counts, starts, axis=axis)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (values / counts).astype(dtype, copy=False)
+
+
+def as_buffer(data: np.ndarray) -> memoryview:
+    """Return the bytes of a C-contiguous array without copying them."""
+    return memoryview(data.reshape(-1).view(np.uint8))
+
+
+async def encode(data: np.ndarray, codec: 'numcodecs.abc.Codec') -> bytes:
+    """Compress an array with ``codec`` on the codec executor."""
+    return await asyncio.get_running_loop().run_in_executor(codec_executor, _encode, data, codec)
+
+
+def _encode(data: np.ndarray, codec: 'numcodecs.abc.Codec') -> bytes:
+    with stage_duration.time(stage='serialize'):
+        return codec.encode(data)
@@ -1,19 +1,222 @@
+import asyncio
+import contextlib
+import functools
+import math
+import struct
 import traceback
 import typing
 
-import zarr
-import zarr.errors
-from fastapi import APIRouter, Depends, Header
-from starlette.responses import Response
+import numpy as np
+from fastapi import APIRouter, Body, Depends, Header
+from starlette.responses import Response, StreamingResponse
 
+from . import formats, metrics
+from .cache import LRUCache
 from .config import Settings, format_bytes, get_settings
 from .exceptions import ZarrProxyHTTPException
-from .helpers import format_exception, load_metadata_file, open_store
-from .log import get_logger
-from .logic import chunk_id_to_slice, parse_chunks_header
+from .formats import arrow_ipc, check_chunk_format, negotiate_chunk_format, npy_header
+from .helpers import (
+    disk_cache,
+    etag_matches,
+    filesystem_cache,
+    format_exception,
+    get_metadata_identity,
+    inflight_requests,
+    load_metadata_file_async,
+    make_etag,
+    metadata_cache,
+    open_store,
+    store_cache,
+)
+from .log import Sampler, add_access_log_fields, get_logger
+from .logic import (
+    canonical_chunks_header,
+    get_chunk_grid,
+    parse_chunks_header,
+    parse_compressor_header,
+    parse_region,
+    parse_step,
+    virtual_group_zarr_json,
+    virtual_zarr_json,
+)
+from .prefetch import prefetcher
+from .reader import (
+    SourceArray,
+    as_buffer,
+    chunk_cache,
+    codec_executor,
+    encode,
+    get_codec,
+    level_cache,
+    pad_chunk,
+    prefetch_buffer,
+    region_shape,
+)
+
+if typing.TYPE_CHECKING:
+    # imported on first use, see ``helpers``
+    import numcodecs.abc
+    import zarr.storage
 
 router = APIRouter()
 logger = get_logger()
+# per-chunk debug events are sampled, logging every one of them is too costly
+sample_chunk_log = Sampler(get_settings().zarr_proxy_log_sample_rate)
+# Store paths known to have no zarr.json, i.e. "c" groups or arrays of Zarr v2 datasets, so that
+# their chunks are not looked up as Zarr v3 chunks on every request
+missing_zarr_json = LRUCache(
+    maxsize=get_settings().zarr_proxy_metadata_cache_size,
+    ttl=get_settings().zarr_proxy_metadata_cache_ttl,
+)
+
+
+def get_output_compressor(compressor: typing.Union[list[str], None]) -> typing.Optional[dict]:
+    """Return the codec configuration requested with the compressor header, if any."""
+    if compressor is None:
+        return None
+    try:
+        config = parse_compressor_header(compressor[0])
+        # make sure the codec is available before advertising it
+        if config is not None:
+            get_codec(config)
+        return config
+    except ValueError as exc:
+        details = {'message': str(exc), 'stack_trace': format_exception(traceback.format_exc())}
+        raise ZarrProxyHTTPException(status_code=400, **details) from exc
+
+
+def check_payload_size(size: int, *, variable_chunks: tuple[int, ...], settings: Settings) -> None:
+    """Raise a 400 error if a chunk of ``size`` bytes exceeds the payload size limit."""
+    if settings.zarr_proxy_payload_size_limit and (size > settings.zarr_proxy_payload_size_limit):
+        metrics.payload_limit_rejections.inc()
+        message = f"Chunk with {format_bytes(size)} and shape {variable_chunks} exceeds server's payload size limit of {format_bytes(settings.zarr_proxy_payload_size_limit)}"
+        logger.error(message)
+        details = {'message': message}
+        raise ZarrProxyHTTPException(status_code=400, **details)
+
+
+def check_decoded_size(size: int, *, variable_chunks: tuple[int, ...], settings: Settings) -> None:
+    """Raise a 400 error if a chunk to compress, of ``size`` bytes, exceeds the decoded size limit."""
+    if settings.zarr_proxy_decoded_size_limit and (size > settings.zarr_proxy_decoded_size_limit):
+        metrics.payload_limit_rejections.inc()
+        message = f"Chunk with {format_bytes(size)} and shape {variable_chunks} exceeds server's decoded size limit of {format_bytes(settings.zarr_proxy_decoded_size_limit)}"
+        logger.error(message)
+        raise ZarrProxyHTTPException(status_code=400, message=message)
+
+
+async def get_compressed_chunk(
+    arr: SourceArray,
+    data_slice: tuple[slice, ...],
+    *,
+    codec: 'numcodecs.abc.Codec',
+    variable_chunks: tuple[int, ...],
+    settings: Settings,
+    headers: dict[str, str],
+    chunk_shape: typing.Optional[tuple[int, ...]] = None,
+) -> Response:
+    """Read a chunk and compress it with the codec requested by the client.
+
+    The chunk is padded to ``chunk_shape``, if given. The decoded size limit applies to the chunk
+    before it is read, and the payload size limit to the compressed chunk.
+    """
+    decoded_size = (
+        arr.nbytes(data_slice)
+        if chunk_shape is None
+        else math.prod(chunk_shape) * arr.dtype.itemsize
+    )
+    check_decoded_size(decoded_size, variable_chunks=variable_chunks, settings=settings)
+    data = await arr.read(data_slice)
+    if chunk_shape is not None:
+        data = pad_chunk(data, chunk_shape, fill_value=arr.fill_value)
+    encoded = await encode(data, codec)
+    check_payload_size(len(encoded), variable_chunks=variable_chunks, settings=settings)
+    return Response(encoded, media_type='application/octet-stream', headers=headers)
+
+
+# Request headers the body of metadata and chunk responses depends on, sent in their Vary header
+# so that shared caches don't serve a response to a client that sent different headers
+VARY_METADATA = ('chunks', 'compressor')
+VARY_CHUNK = ('chunks', 'compressor', 'Accept')
+
+
+def cache_headers(
+    *,
+    store: 'zarr.storage.FSStore',
+    key: str,
+    settings: Settings,
+    variant: tuple = (),
+    vary: tuple[str, ...] = (),
+) -> dict[str, str]:
+    """Return the HTTP caching headers of a response derived from the metadata file ``key``.
+
+    The ETag combines the identity of the cached upstream metadata with ``variant``, i.e. the
+    values of the request headers the response depends on, which are listed in ``vary``.
+    """
+    headers = {'Cache-Control': settings.zarr_proxy_cache_control}
+    if vary:
+        headers['Vary'] = ', '.join(vary)
+    identity = get_metadata_identity(store=store, key=key)
+    if identity is not None:
+        headers['ETag'] = make_etag(store.path, key, identity, *variant)
+    return headers
+
+
+def not_modified(
+    if_none_match: typing.Optional[str], headers: dict[str, str]
+) -> typing.Optional[Response]:
+    """Return a 304 response if the client already has the current version of a response."""
+    if 'ETag' in headers and etag_matches(if_none_match, headers['ETag']):
+        return Response(status_code=304, headers=headers)
+    return None
+
+
+async def open_source_array(
+    *, host: str, path: str, zarr_format: int = 2
+) -> tuple['zarr.storage.FSStore', SourceArray]:
+    """Open the upstream array at ``path``, described by its ``.zarray``, or its ``zarr.json``
+    if ``zarr_format`` is 3."""
+    store = open_store(host=host, path=path, logger=logger)
+    # metadata comes from the shared metadata cache, so only the data itself is read from upstream
+    key = 'zarr.json' if zarr_format == 3 else '.zarray'
+    zarray = await load_metadata_file_async(store=store, key=key, logger=logger)
+    try:
+        arr = SourceArray(store=store, zarray=zarray)
+    except (KeyError, ValueError) as exc:
+        if zarr_format != 3:
+            raise
+        message = f'Unsupported Zarr v3 array {store.path}: {exc}'
+        raise ZarrProxyHTTPException(status_code=501, message=message) from exc
+    return store, arr
+
+
+@contextlib.contextmanager
+def _translate_chunk_key_errors():
+    """Turn an invalid chunk key or chunks header into a 400 error."""
+    try:
+        yield
+    except (IndexError, ValueError, ZeroDivisionError) as exc:
+        # The chunk key is not valid or the chunks are not valid
+        logger.error(exc)
+        details = {
+            'message': 'Invalid chunk key or chunks',
+            'stack_trace': format_exception(traceback.format_exc()),
+        }
+        raise ZarrProxyHTTPException(status_code=400, **details)
+
+
+async def iterate(items: typing.Iterable) -> typing.AsyncIterator:
+    for item in items:
+        yield item
+
+
+async def iter_chunk_body(
+    arr: SourceArray, data_slice: tuple[slice, ...], *, prefix: bytes = b''
+) -> typing.AsyncIterator[typing.Union[bytes, memoryview]]:
+    """Yield ``prefix`` followed by the bytes of a region of ``arr``, slab by slab."""
+    if prefix:
+        yield prefix
+    async for slab in arr.iter_slabs(data_slice):
+        yield as_buffer(slab)
 
 
 @router.get('/health')
@@ -21,18 +224,71 @@ def ping(settings: Settings = Depends(get_settings)) -> dict:
     return {
         'ping': 'pong',
         'zarr_proxy_payload_size_limit': format_bytes(settings.zarr_proxy_payload_size_limit),
+        'caches': {
+            'stores': store_cache.stats(),
+            'filesystems': filesystem_cache.stats(),
+            'metadata': metadata_cache.stats(),
+            'chunks': chunk_cache.stats(),
+            'multiscales': level_cache.stats(),
+            'disk': disk_cache.stats() if disk_cache is not None else None,
+        },
+        'inflight_requests': inflight_requests.stats(),
+        'prefetch': prefetcher.stats(),
+    }
+
+
+@router.get('/metrics')
+def get_metrics() -> Response:
+    """Return the metrics of the proxy in the Prometheus text format."""
+    caches = {
+        'stores': store_cache,
+        'filesystems': filesystem_cache,
+        'metadata': metadata_cache,
+        'chunks': chunk_cache,
+        'prefetch': prefetch_buffer,
+        'multiscales': level_cache,
     }
+    if disk_cache is not None:
+        caches['disk'] = disk_cache
+    for name, cache in caches.items():
+        stats = cache.stats()
+        metrics.cache_hits.set(stats['hits'], cache=name)
+        metrics.cache_misses.set(stats['misses'], cache=name)
+        metrics.cache_hit_ratio.set(stats['hit_ratio'], cache=name)
+        metrics.cache_bytes.set(stats['nbytes'], cache=name)
+    metrics.upstream_requests_in_flight.set(len(inflight_requests))
+    return Response(
+        metrics.registry.render(), media_type='text/plain; version=0.0.4; charset=utf-8'
+    )
 
 
 @router.get('/{host}/{path:path}/.zmetadata')
-def get_zmetadata(
-    host: str, path: str, chunks: typing.Union[list[str], None] = Header(default=None)
+async def get_zmetadata(
+    host: str,
+    path: str,
+    response: Response,
+    chunks: typing.Union[list[str], None] = Header(default=None),
+    compressor: typing.Union[list[str], None] = Header(default=None),
+    if_none_match: typing.Optional[str] = Header(default=None),
+    settings: Settings = Depends(get_settings),
 ) -> dict:
-    chunks = parse_chunks_header(chunks[0]) if chunks is not None else {}
+    chunks_header = chunks[0] if chunks is not None else ''
+    chunks = parse_chunks_header(chunks_header)
+    compressor = get_output_compressor(compressor)
     store = open_store(host=host, path=path, logger=logger)
-    zmetadata = load_metadata_file(store=store, key='.zmetadata', logger=logger)
+    zmetadata = await load_metadata_file_async(store=store, key='.zmetadata', logger=logger)
+    headers = cache_headers(
+        store=store,
+        key='.zmetadata',
+        settings=settings,
+        variant=(canonical_chunks_header(chunks_header), compressor),
+        vary=VARY_METADATA,
+    )
+    if cached := not_modified(if_none_match, headers):
+        return cached
 
-    # Rewrite chunks and compressor in zmetadata
+    # Rewrite chunks, compressor and filters in zmetadata: chunks are served decoded, optionally
+    # compressed with the codec requested by the client
     # TODO: we should probably add more validation here to make sure the specified variables
     # in the chunks header are actually in the zmetadata
     zmetadata_variables = set()
@@ -42,7 +298,8 @@ def get_zmetadata(
             zmetadata_variables.add(variable)
             variable_chunks = chunks.get(variable, zmetadata['metadata'][item]['chunks'])
             zmetadata['metadata'][item]['chunks'] = variable_chunks
-            zmetadata['metadata'][item]['compressor'] = None
+            zmetadata['metadata'][item]['compressor'] = compressor
+            zmetadata['metadata'][item]['filters'] = None
 
     # Check that all variables in the chunks header are in the zmetadata
     if not zmetadata_variables.issuperset(chunks.keys()):
@@ -50,101 +307,479 @@ def get_zmetadata(
         details = {'message': message}
         raise ZarrProxyHTTPException(status_code=400, **details)
 
+    response.headers.update(headers)
     return zmetadata
 
 
 @router.get('/{host}/{path:path}/.zattrs')
-def get_zattrs(host: str, path: str) -> dict:
+async def get_zattrs(
+    host: str,
+    path: str,
+    response: Response,
+    if_none_match: typing.Optional[str] = Header(default=None),
+    settings: Settings = Depends(get_settings),
+) -> dict:
     store = open_store(host=host, path=path, logger=logger)
-    return load_metadata_file(store=store, key='.zattrs', logger=logger)
+    zattrs = await load_metadata_file_async(store=store, key='.zattrs', logger=logger)
+    headers = cache_headers(store=store, key='.zattrs', settings=settings)
+    if cached := not_modified(if_none_match, headers):
+        return cached
+    response.headers.update(headers)
+    return zattrs
 
 
 @router.get('/{host}/{path:path}/.zgroup')
-def get_zgroup(host: str, path: str) -> dict:
+async def get_zgroup(
+    host: str,
+    path: str,
+    response: Response,
+    if_none_match: typing.Optional[str] = Header(default=None),
+    settings: Settings = Depends(get_settings),
+) -> dict:
     store = open_store(host=host, path=path, logger=logger)
-    return load_metadata_file(store=store, key='.zgroup', logger=logger)
+    zgroup = await load_metadata_file_async(store=store, key='.zgroup', logger=logger)
+    headers = cache_headers(store=store, key='.zgroup', settings=settings)
+    if cached := not_modified(if_none_match, headers):
+        return cached
+    response.headers.update(headers)
+    return zgroup
 
 
 @router.get('/{host}/{path:path}/.zarray')
-def get_zarray(
-    host: str, path: str, chunks: typing.Union[list[str], None] = Header(default=None)
+async def get_zarray(
+    host: str,
+    path: str,
+    response: Response,
+    chunks: typing.Union[list[str], None] = Header(default=None),
+    compressor: typing.Union[list[str], None] = Header(default=None),
+    if_none_match: typing.Optional[str] = Header(default=None),
+    settings: Settings = Depends(get_settings),
 ) -> dict:
     store = open_store(host=host, path=path, logger=logger)
     # Rewrite chunks
-    meta = load_metadata_file(store=store, key='.zarray', logger=logger)
+    meta = await load_metadata_file_async(store=store, key='.zarray', logger=logger)
     chunks = parse_chunks_header(chunks[0]) if chunks is not None else {}
+    compressor = get_output_compressor(compressor)
     variable = path.split('/')[-1]
     variable_chunks = chunks.get(variable, meta['chunks'])
+    headers = cache_headers(
+        store=store,
+        key='.zarray',
+        settings=settings,
+        variant=(tuple(variable_chunks), compressor),
+        vary=VARY_METADATA,
+    )
+    if cached := not_modified(if_none_match, headers):
+        return cached
     meta['chunks'] = variable_chunks
-    meta['compressor'] = None
+    meta['compressor'] = compressor
     meta['filters'] = []
+    response.headers.update(headers)
     return meta
 
 
-@router.get('/{host}/{path:path}/{chunk_key}')
-def get_chunk(
+@router.get('/{host}/{path:path}/zarr.json')
+async def get_zarr_json(
     host: str,
     path: str,
-    chunk_key: str,
+    response: Response,
     chunks: typing.Union[list[str], None] = Header(default=None),
+    compressor: typing.Union[list[str], None] = Header(default=None),
+    if_none_match: typing.Optional[str] = Header(default=None),
     settings: Settings = Depends(get_settings),
-) -> bytes:
-    logger.info('Getting chunk: %s', chunk_key)
-    logger.info('Chunks: %s', chunks)
-    logger.info('Host: %s, Path: %s', host, path)
-    logger.info('Settings: %s', settings)
+) -> dict:
+    """Return the Zarr v3 metadata of an array or a group.
+
+    Like ``.zarray`` and ``.zmetadata``, the chunks and codecs of arrays, including those of the
+    consolidated metadata of groups, are rewritten: chunks are served decoded and unsharded,
+    optionally compressed with the codec requested by the client.
+    """
+    chunks_header = chunks[0] if chunks is not None else ''
+    chunks = parse_chunks_header(chunks_header)
+    compressor = get_output_compressor(compressor)
+    store = open_store(host=host, path=path, logger=logger)
+    metadata = await load_metadata_file_async(store=store, key='zarr.json', logger=logger)
+    headers = cache_headers(
+        store=store,
+        key='zarr.json',
+        settings=settings,
+        variant=(canonical_chunks_header(chunks_header), compressor),
+        vary=VARY_METADATA,
+    )
+    if cached := not_modified(if_none_match, headers):
+        return cached
+
+    if metadata.get('node_type') == 'array':
+        try:
+            metadata = virtual_zarr_json(
+                metadata, chunks=chunks.get(path.split('/')[-1]), compressor=compressor
+            )
+        except (KeyError, ValueError) as exc:
+            message = f'Unsupported Zarr v3 array {store.path}: {exc}'
+            raise ZarrProxyHTTPException(status_code=501, message=message) from exc
+    else:
+        try:
+            metadata = virtual_group_zarr_json(metadata, chunks=chunks, compressor=compressor)
+        except ValueError as exc:
+            raise ZarrProxyHTTPException(status_code=400, message=str(exc)) from exc
+
+    response.headers.update(headers)
+    return metadata
+
+
+@router.post('/{host}/{path:path}/.batch')
+async def get_chunk_batch(
+    host: str,
+    path: str,
+    chunk_keys: list[str] = Body(...),
+    chunks: typing.Union[list[str], None] = Header(default=None),
+    compressor: typing.Union[list[str], None] = Header(default=None),
+    settings: Settings = Depends(get_settings),
+) -> Response:
+    """Return several chunks of one array in a single response.
+
+    The request body is a JSON list of chunk keys. The source chunks needed by all of them are
+    planned together, so each one is fetched and decoded once. The response holds one frame per
+    chunk key, in request order: the big-endian uint32 length of the chunk key, the UTF-8 chunk
+    key, the big-endian uint64 length of the chunk, and the chunk bytes. The decoded size of all
+    chunks together is limited before any of them is read.
+    """
+    if len(chunk_keys) > settings.zarr_proxy_batch_size_limit:
+        message = f'Too many chunk keys: {len(chunk_keys)}. At most {settings.zarr_proxy_batch_size_limit} chunks can be requested at once.'
+        raise ZarrProxyHTTPException(status_code=400, message=message)
 
     chunks = parse_chunks_header(chunks[0]) if chunks is not None else {}
+    compressor = get_output_compressor(compressor)
+    store, arr = await open_source_array(host=host, path=path)
+    variable_chunks = chunks.get(path.split('/')[-1], arr.chunks)
+    with _translate_chunk_key_errors():
+        grid = get_chunk_grid(shape=arr.shape, chunks=variable_chunks, source_chunks=arr.chunks)
+        data_slices = grid.chunk_slices(chunk_keys)
+
+    sizes = [arr.nbytes(data_slice) for data_slice in data_slices]
+    limit = settings.zarr_proxy_batch_payload_size_limit
+    if limit and sum(sizes) > limit:
+        metrics.payload_limit_rejections.inc()
+        message = f"Batch of {len(chunk_keys)} chunks with {format_bytes(sum(sizes))} exceeds server's batch payload size limit of {format_bytes(limit)}"
+        logger.error(message)
+        raise ZarrProxyHTTPException(status_code=400, message=message)
+
+    if compressor is None:
+        for size in sizes:
+            check_payload_size(size, variable_chunks=variable_chunks, settings=settings)
+        payloads = [as_buffer(data) for data in await arr.read_many(data_slices)]
+    else:
+        for size in sizes:
+            check_decoded_size(size, variable_chunks=variable_chunks, settings=settings)
+        codec = get_codec(compressor)
+        data = await arr.read_many(data_slices)
+        payloads = await asyncio.gather(*(encode(item, codec) for item in data))
+        for payload in payloads:
+            check_payload_size(len(payload), variable_chunks=variable_chunks, settings=settings)
+
+    frames = []
+    for chunk_key, payload in zip(chunk_keys, payloads):
+        encoded_key = chunk_key.encode()
+        frames.append(
+            struct.pack('>I', len(encoded_key)) + encoded_key + struct.pack('>Q', len(payload))
+        )
+        frames.append(payload)
+    return StreamingResponse(
+        iterate(frames),
+        media_type='application/x-zarr-proxy-batch',
+        headers={'Content-Length': str(sum(len(frame) for frame in frames))},
+    )
+
+
+@router.get('/{host}/{path:path}/.subset')
+async def get_subset(
+    host: str,
+    path: str,
+    region: typing.Optional[str] = None,
+    step: typing.Optional[str] = None,
+    method: typing.Literal['stride', 'mean'] = 'stride',
+    accept: typing.Optional[str] = Header(default=None),
+    if_none_match: typing.Optional[str] = Header(default=None),
+    settings: Settings = Depends(get_settings),
+) -> Response:
+    """Return a region of an array, downsampled by ``step`` along each dimension.
+
+    With ``method=stride`` every ``step``-th element is kept and only the source chunks holding
+    one of them are read. With ``method=mean`` each ``step``-sized block is replaced by its mean.
+    The region is given as one ``start:stop`` range per dimension, e.g. ``0:100,:``, and defaults
+    to the whole array. The shape and dtype of the result are sent in the ``X-Zarr-Shape`` and
+    ``X-Zarr-Dtype`` headers, or the result can be requested in a self-describing format with the
+    ``Accept`` header, as for chunks.
+    """
+    output_format = negotiate_chunk_format(accept)
     variable = path.split('/')[-1]
-    variable_chunks = chunks.get(variable, None)
+    store, arr = await open_source_array(host=host, path=path)
+    try:
+        data_slice = parse_region(region, shape=arr.shape)
+        steps = parse_step(step, ndim=len(arr.shape))
+    except ValueError as exc:
+        raise ZarrProxyHTTPException(status_code=400, message=str(exc)) from exc
 
-    store = open_store(host=host, path=path, logger=logger)
+    if method == 'stride':
+        data_slice = tuple(slice(s.start, s.stop, factor) for s, factor in zip(data_slice, steps))
+        shape = region_shape(data_slice)
+        dtype = arr.dtype
+    else:
+        shape = tuple(
+            math.ceil((s.stop - s.start) / factor) for s, factor in zip(data_slice, steps)
+        )
+        dtype = arr.dtype if arr.dtype.kind == 'f' else np.dtype('f8')
+    check_payload_size(math.prod(shape) * dtype.itemsize, variable_chunks=shape, settings=settings)
+    # a small result can still be the reduction of the whole array
+    source_nbytes = arr.source_nbytes(data_slice)
+    limit = settings.zarr_proxy_subset_source_size_limit
+    if limit and source_nbytes > limit:
+        metrics.payload_limit_rejections.inc()
+        message = f"Subset reading {format_bytes(source_nbytes)} of source chunks exceeds server's subset source size limit of {format_bytes(limit)}"
+        logger.error(message)
+        raise ZarrProxyHTTPException(status_code=400, message=message)
+
+    headers = cache_headers(
+        store=store,
+        key='.zarray',
+        settings=settings,
+        variant=('subset', data_slice, steps, method, output_format),
+        vary=('Accept',),
+    )
+    if cached := not_modified(if_none_match, headers):
+        return cached
     try:
-        arr = zarr.open(store, mode='r')
-    except zarr.errors.PathNotFoundError as exc:
-        logger.error(exc)
-        details = {
-            'message': f'Path not found: {store.path}',
-            'stack_trace': format_exception(traceback.format_exc()),
-        }
-        raise ZarrProxyHTTPException(status_code=404, **details) from exc
-    if variable_chunks is None:
-        logger.info('No chunks provided, using the default chunks: %s', arr.chunks)
-        variable_chunks = arr.chunks
+        check_chunk_format(output_format, dtype=dtype)
+    except ValueError as exc:
+        raise ZarrProxyHTTPException(status_code=406, message=str(exc)) from exc
 
+    if method == 'stride':
+        data = await arr.read(data_slice)
     else:
-        logger.info('Using chunks provided: %s', variable_chunks)
+        data = await arr.read_block_mean(
+            data_slice, steps, band_nbytes=settings.zarr_proxy_streaming_threshold
+        )
+
+    media_type = formats.MEDIA_TYPES[output_format][0]
+    if output_format == formats.ARROW:
+        body = await asyncio.get_running_loop().run_in_executor(
+            codec_executor, functools.partial(arrow_ipc, data, name=variable)
+        )
+        return Response(body, media_type=media_type, headers=headers)
+    headers.update({'X-Zarr-Shape': ','.join(map(str, shape)), 'X-Zarr-Dtype': dtype.str})
+    if output_format == formats.NPY:
+        prefix = npy_header(shape=shape, dtype=dtype)
+        return StreamingResponse(
+            iterate([prefix, as_buffer(data)]),
+            media_type=media_type,
+            headers={**headers, 'Content-Length': str(len(prefix) + data.nbytes)},
+        )
+    return Response(as_buffer(data), media_type=media_type, headers=headers)
+
+
+@router.get('/{host}/{path:path}/c/{chunk_key:path}')
+@router.get('/{host}/{path:path}/c')
+async def get_chunk_v3(
+    host: str,
+    path: str,
+    chunk_key: str = '',
+    chunks: typing.Union[list[str], None] = Header(default=None),
+    compressor: typing.Union[list[str], None] = Header(default=None),
+    accept: typing.Optional[str] = Header(default=None),
+    if_none_match: typing.Optional[str] = Header(default=None),
+    settings: Settings = Depends(get_settings),
+) -> bytes:
+    """Return a chunk of a Zarr v3 array, whose keys are "c/{i}/{j}/..."
+
+    The path could also be a chunk of a Zarr v2 array under a group or an array named "c", which
+    is served as such when there is no ``zarr.json`` at ``path``.
+    """
+    kwargs = dict(
+        host=host,
+        chunks=chunks,
+        compressor=compressor,
+        accept=accept,
+        if_none_match=if_none_match,
+        settings=settings,
+    )
+    v2_path, _, v2_chunk_key = f'{path}/c/{chunk_key}'.rstrip('/').rpartition('/')
+    if await _is_zarr_v3(host=host, path=path, v2_path=v2_path):
+        return await _get_chunk(path=path, chunk_key=chunk_key, zarr_format=3, **kwargs)
+    return await _get_chunk(path=v2_path, chunk_key=v2_chunk_key, **kwargs)
 
+
+async def _is_zarr_v3(*, host: str, path: str, v2_path: str) -> bool:
+    """Return whether a chunk URL with a "c" segment is a chunk of the Zarr v3 array at ``path``
+    rather than one of the Zarr v2 array at ``v2_path``.
+
+    Cached metadata decides when there is some, otherwise ``zarr.json`` is looked up once, and its
+    absence remembered in ``missing_zarr_json``.
+    """
+    store = open_store(host=host, path=path, logger=logger)
+    if (store.path, 'zarr.json') in metadata_cache:
+        return True
+    v2_store = open_store(host=host, path=v2_path, logger=logger)
+    if store.path in missing_zarr_json or (v2_store.path, '.zarray') in metadata_cache:
+        return False
     try:
-        logger.info(
+        await load_metadata_file_async(store=store, key='zarr.json', logger=logger, readonly=True)
+    except ZarrProxyHTTPException as exc:
+        # S3 answers 403 rather than 404 for missing keys of buckets that can't be listed
+        if exc.status_code not in (403, 404):
+            raise
+        missing_zarr_json.set(store.path, True)
+        return False
+    return True
+
+
+@router.get('/{host}/{path:path}/{chunk_key}')
+async def get_chunk(
+    host: str,
+    path: str,
+    chunk_key: str,
+    chunks: typing.Union[list[str], None] = Header(default=None),
+    compressor: typing.Union[list[str], None] = Header(default=None),
+    accept: typing.Optional[str] = Header(default=None),
+    if_none_match: typing.Optional[str] = Header(default=None),
+    settings: Settings = Depends(get_settings),
+) -> bytes:
+    return await _get_chunk(
+        host=host,
+        path=path,
+        chunk_key=chunk_key,
+        chunks=chunks,
+        compressor=compressor,
+        accept=accept,
+        if_none_match=if_none_match,
+        settings=settings,
+    )
+
+
+async def _get_chunk(
+    *,
+    host: str,
+    path: str,
+    chunk_key: str,
+    chunks: typing.Union[list[str], None],
+    compressor: typing.Union[list[str], None],
+    accept: typing.Optional[str],
+    if_none_match: typing.Optional[str],
+    settings: Settings,
+    zarr_format: int = 2,
+) -> Response:
+    chunks = parse_chunks_header(chunks[0]) if chunks is not None else {}
+    compressor = get_output_compressor(compressor)
+    output_format = negotiate_chunk_format(accept)
+    if output_format != formats.RAW and compressor is not None:
+        message = f'The compressor header cannot be used with {formats.MEDIA_TYPES[output_format][0]} responses'
+        raise ZarrProxyHTTPException(status_code=400, message=message)
+    variable = path.split('/')[-1]
+    store, arr = await open_source_array(host=host, path=path, zarr_format=zarr_format)
+    # default to the chunks of the source array
+    variable_chunks = chunks.get(variable, arr.chunks)
+
+    add_access_log_fields(chunk_key=chunk_key, chunks=variable_chunks)
+    if sample_chunk_log():
+        logger.debug(
             'Getting chunk: %s with chunks: %s from array with shape: %s',
             chunk_key,
             variable_chunks,
             arr.shape,
+            extra={'fields': {'host': host, 'path': path, 'compressor': compressor}},
+        )
+    with _translate_chunk_key_errors():
+        grid = get_chunk_grid(shape=arr.shape, chunks=variable_chunks, source_chunks=arr.chunks)
+        # the proxy serves v3 chunks with the default chunk key encoding, e.g. "c/1/3"
+        chunk_index = (
+            grid.parse_key(chunk_key or '0', delimiter='/')
+            if zarr_format == 3
+            else grid.parse_key(chunk_key)
+        )
+        data_slice = grid.chunk_slice(chunk_index)
+
+    # the ETag only depends on cached metadata, so repeat requests are answered without any I/O
+    headers = cache_headers(
+        store=store,
+        key='zarr.json' if zarr_format == 3 else '.zarray',
+        settings=settings,
+        variant=(chunk_key, tuple(variable_chunks), compressor, output_format),
+        # the same URL serves several chunkings, compressions and formats
+        vary=VARY_CHUNK,
+    )
+    if cached := not_modified(if_none_match, headers):
+        return cached
+
+    try:
+        check_chunk_format(output_format, dtype=arr.dtype)
+    except ValueError as exc:
+        raise ZarrProxyHTTPException(status_code=406, message=str(exc)) from exc
+
+    # zarr v3 clients expect the chunks at the edges of the array to be padded to the full shape
+    chunk_shape = (
+        tuple(variable_chunks)
+        if zarr_format == 3
+        and output_format == formats.RAW
+        and region_shape(data_slice) != tuple(variable_chunks)
+        else None
+    )
+    size = arr.nbytes(data_slice)
+    # check the size of the chunk before fetching anything: the payload size limit applies to
+    # uncompressed chunks, the decoded size limit to chunks compressed on request
+    check_size = check_payload_size if compressor is None else check_decoded_size
+    check_size(
+        size if chunk_shape is None else math.prod(chunk_shape) * arr.dtype.itemsize,
+        variable_chunks=variable_chunks,
+        settings=settings,
+    )
+    # only chunks that are actually read feed the prefetcher, not revalidations or rejections
+    prefetcher.observe(arr, grid, chunk_index)
+
+    if compressor is not None:
+        return await get_compressed_chunk(
+            arr,
+            data_slice,
+            codec=get_codec(compressor),
+            variable_chunks=variable_chunks,
+            settings=settings,
+            headers=headers,
+            chunk_shape=chunk_shape,
+        )
+    if chunk_shape is not None:
+        data = pad_chunk(await arr.read(data_slice), chunk_shape, fill_value=arr.fill_value)
+        return Response(as_buffer(data), media_type='application/octet-stream', headers=headers)
+
+    media_type = formats.MEDIA_TYPES[output_format][0]
+    # NPY responses are the raw bytes preceded by a header describing the array
+    prefix = (
+        npy_header(shape=tuple(s.stop - s.start for s in data_slice), dtype=arr.dtype)
+        if output_format == formats.NPY
+        else b''
+    )
+
+    if output_format != formats.ARROW and size > settings.zarr_proxy_streaming_threshold:
+        # send large chunks slab by slab as their source chunks arrive, so memory stays bounded
+        return StreamingResponse(
+            iter_chunk_body(arr, data_slice, prefix=prefix),
+            media_type=media_type,
+            headers={**headers, 'Content-Length': str(len(prefix) + size)},
         )
-        data_slice = chunk_id_to_slice(chunk_key, chunks=variable_chunks, shape=arr.shape)
-    except IndexError as exc:
-        # The chunk key is not valid or the chunks are not valid
-        logger.error(exc)
-        details = {
-            'message': 'Invalid chunk key or chunks',
-            'stack_trace': format_exception(traceback.format_exc()),
-        }
-        raise ZarrProxyHTTPException(status_code=400, **details)
 
     try:
-        data = arr[data_slice]
-        size = data.nbytes
-        # check that the size of the data does not exceed the maximum payload size
-        if settings.zarr_proxy_payload_size_limit and (
-            size > settings.zarr_proxy_payload_size_limit
-        ):
-            message = f"Chunk with {format_bytes(size)} and shape {variable_chunks} exceeds server's payload size limit of {format_bytes(settings.zarr_proxy_payload_size_limit)}"
-            logger.error(message)
-            details = {'message': message}
-            raise ZarrProxyHTTPException(status_code=400, **details)
-
-        return Response(data.tobytes(), media_type='application/octet-stream')
+        # only the source chunks intersecting the slice are fetched, concurrently
+        data = await arr.read(data_slice)
+        if output_format == formats.ARROW:
+            body = await asyncio.get_running_loop().run_in_executor(
+                codec_executor, functools.partial(arrow_ipc, data, name=variable)
+            )
+            return Response(body, media_type=media_type, headers=headers)
+        if prefix:
+            # send the header and the array buffer one after the other rather than concatenating them
+            return StreamingResponse(
+                iterate([prefix, as_buffer(data)]),
+                media_type=media_type,
+                headers={**headers, 'Content-Length': str(len(prefix) + size)},
+            )
+        return Response(as_buffer(data), media_type=media_type, headers=headers)
 
     except ValueError as exc:
         message = f'Error getting chunk: {chunk_key} with chunks: {variable_chunks} from array with shape: {arr.shape}. Slice used: {data_slice}'
@@ -0,0 +1,70 @@
+"""Warm up a fresh process, e.g. during the cold start of a serverless function"""
+
+import asyncio
+import importlib
+import logging
+import typing
+
+from .helpers import load_metadata_file_async, open_store
+from .log import get_logger
+from .reader import SourceArray
+
+# The modules the package imports on first use, see ``helpers``
+LAZY_MODULES = ('aiohttp', 'fsspec.implementations.http', 'numcodecs', 'zarr.meta', 'zarr.storage')
+
+# datasets already warmed up by this process
+_warm_datasets: set[str] = set()
+
+
+async def _warm_up_dataset(dataset: str, *, logger: logging.Logger) -> None:
+    host, _, path = dataset.strip('/').partition('/')
+    store = open_store(host=host, path=path, logger=logger)
+    zmetadata = await load_metadata_file_async(store=store, key='.zmetadata', logger=logger)
+    for key, zarray in zmetadata['metadata'].items():
+        if key.endswith('/.zarray') and key.count('/') == 1:
+            variable = key[: -len('/.zarray')]
+            # opens the store of the variable and instantiates its codecs
+            SourceArray(
+                store=open_store(host=host, path=f'{path}/{variable}', logger=logger), zarray=zarray
+            )
+
+
+async def warm_up(
+    datasets: typing.Iterable[str] = (),
+    *,
+    import_modules: bool = False,
+    logger: typing.Optional[logging.Logger] = None,
+) -> None:
+    """Pre-open ``datasets``, and import the modules loaded on first use if ``import_modules``.
+
+    Opening a dataset creates the connection pool of its host, connects to it, and loads the
+    consolidated metadata of the dataset into the metadata cache, so the first requests for it
+    don't pay for any of this. Datasets already warmed up by the process are skipped, and errors
+    are logged rather than raised: a dataset that is down must not prevent the proxy from
+    starting.
+
+    Parameters
+    ----------
+    datasets: list[str]
+        e.g. ["storage.googleapis.com/carbonplan-share/air_temperature.zarr"]
+    import_modules: bool
+        import ``LAZY_MODULES``, which opening a dataset imports anyway
+    """
+    logger = logger or get_logger()
+    if import_modules:
+        for module in LAZY_MODULES:
+            importlib.import_module(module)
+
+    datasets = [dataset for dataset in dict.fromkeys(datasets) if dataset not in _warm_datasets]
+    results = await asyncio.gather(
+        *(_warm_up_dataset(dataset, logger=logger) for dataset in datasets),
+        return_exceptions=True,
+    )
+    for dataset, result in zip(datasets, results):
+        if isinstance(result, Exception):
+            logger.warning(
+                'Failed to warm up %s: %s', dataset, getattr(result, 'message', None) or result
+            )
+        else:
+            _warm_datasets.add(dataset)
+            logger.info('Warmed up %s', dataset)